@@ -3,17 +3,26 @@
 """
 import os
 import re
+import io
+import time
+import logging
 import uuid
+import asyncio
 import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from datetime import datetime, timedelta, date
-from typing import Dict, Optional, Tuple, List
+from typing import Dict, Optional, Tuple, List, Iterable
 from openpyxl import Workbook
-from difflib import SequenceMatcher
 from decimal import Decimal
+from itertools import chain
 
+from rapidfuzz import fuzz, process as rapidfuzz_process
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
@@ -38,17 +47,219 @@ from utils import (
     format_operations_list
 )
 
+logger = logging.getLogger(__name__)
 
-# Состояния пользователя
-USER_STATES = {}
+
+# Состояния пользователя по ключу (id бота, id пользователя) - несколько ботов
+# в одном процессе не делят состояние (порядок - от давно активных к недавним)
+USER_STATES: "OrderedDict[Tuple[int, int], UserState]" = OrderedDict()
+
+# Состояния неактивных пользователей удаляются (активный режим ввода теряется,
+# вход сотрудника восстанавливается из БД при следующем сообщении)
+USER_STATE_TTL = 12 * 60 * 60  # секунд без сообщений
+MAX_USER_STATES = 1000
+USER_STATES_PRUNE_INTERVAL = 5 * 60
+_user_states_pruned_at = time.monotonic()
 
 # Пин-код для удаления всех данных
 RESET_PIN_CODE = "6002147"
 
+# Сколько потоков одновременно работают с БД и генерацией отчётов
+DB_EXECUTOR_WORKERS = 4
+
+# Сколько сообщений удалять одновременно при "завершить" (без упора в лимиты Telegram)
+DELETE_MESSAGES_CONCURRENCY = 5
+
+# Длина одной части длинного списка в сообщении (лимит Telegram - 4096 символов)
+TELEGRAM_CHUNK_SIZE = 3500
+
+# Сколько имён группы СБ показывать в списке в чате (полный список - в файле)
+SB_GROUP_NAMES_SHOWN = 30
+
+# Сколько апдейтов (от разных пользователей) обрабатывается одновременно
+MAX_CONCURRENT_UPDATES = 64
+
+# Типы апдейтов, которые запрашиваем у Telegram: обработчики есть только для сообщений и кнопок
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Команды и режимы личного кабинета сотрудника
+EMPLOYEE_ALLOWED_COMMANDS = frozenset({
+    'выход', '❌ выход',
+    'моя зп', '💰 моя зп',
+    'история выплат', '💵 история выплат',
+    'отмена', '❌ отмена'
+})
+EMPLOYEE_ALLOWED_MODES = frozenset({'employee_awaiting_date', 'employee_awaiting_period'})
+
+# Режимы, в которых работает ОТМЕНА
+CANCELABLE_MODES = frozenset({
+    'awaiting_preview_date', 'awaiting_preview_action', 'awaiting_edit_line_number', 'awaiting_edit_line_data',
+    'awaiting_edit_params', 'awaiting_edit_data', 'awaiting_delete_choice',
+    'awaiting_report_club', 'awaiting_report_period', 'awaiting_duplicate_confirm', 'awaiting_sb_merge_confirm',
+    'awaiting_export_club', 'awaiting_export_period',
+    'awaiting_merge_confirm', 'awaiting_list_club', 'awaiting_list_date', 'awaiting_payments_input', 'awaiting_salary_input',
+    'awaiting_delete_mass_club', 'awaiting_delete_mass_period', 'awaiting_delete_mass_confirm',
+    'awaiting_delete_employee_input',
+    'awaiting_upload_club', 'awaiting_upload_date', 'awaiting_upload_file', 'awaiting_upload_confirm',
+    'awaiting_payments_upload_club', 'awaiting_payments_upload_date', 'awaiting_payments_upload_file',
+    'awaiting_stylist_period', 'awaiting_stylist_data', 'awaiting_stylist_confirm',
+    'awaiting_stylist_edit_number', 'awaiting_stylist_edit_data', 'awaiting_stylist_clarification',
+    'awaiting_employee_edit_select', 'awaiting_emp_code', 'awaiting_add_employee',
+    'awaiting_emp_name', 'awaiting_emp_phone', 'awaiting_emp_tg', 'awaiting_emp_birth',
+    'employee_awaiting_date', 'employee_awaiting_period',
+    'нал', 'безнал'
+})
+
+# Команды, доступные ТОЛЬКО при полном доступе (при быстром доступе - пароль 0001 - запрещены)
+RESTRICTED_COMMANDS = frozenset({
+    'нал', 'безнал', 'готово', 'загрузить файл', 'загрузить зп',
+    'отчет', 'список', 'экспорт',
+    'исправить', 'удалить', 'обнулить',
+    'сотрудники', 'объединить', 'самозанятые', 'стилисты',
+    'помощь', 'старт москвич', 'старт анора'
+})
+
+# Кнопки клавиатуры -> текстовые команды
+BUTTON_COMMANDS = {
+    '🏢 старт москвич': 'старт москвич',
+    '🏢 старт анора': 'старт анора',
+    '📥 нал': 'нал',
+    '📥 безнал': 'безнал',
+    '📎 загрузить файл': 'загрузить файл',
+    '💰 загрузить зп': 'загрузить зп',
+    '✅ готово': 'готово',
+    '❌ отмена': 'отмена',
+    '📊 отчёт': 'отчет',
+    '📊 отчет': 'отчет',
+    '💰 выплаты': 'выплаты',
+    '💵 зп': 'зп',
+    '📋 список': 'список',
+    '📤 экспорт': 'экспорт',
+    '✏️ исправить': 'исправить',
+    '🗑️ удалить': 'удалить',
+    '📜 журнал': 'журнал',
+    '👔 самозанятые': 'самозанятые',
+    '👥 сотрудники': 'сотрудники',
+    '💄 стилисты': 'стилисты',
+    '❓ помощь': 'помощь',
+    '🚪 завершить': 'завершить'
+}
+
+# В режиме ввода НАЛ/БЕЗНАЛ: текст с этими префиксами или командами не разбирается как данные
+EMOJI_BUTTON_PREFIXES = ('📥', '✅', '❌', '📊', '💰', '📋', '📤', '✏️', '🗑️', '❓', '🚪')
+DATA_INPUT_COMMANDS = frozenset({'отмена', 'готово', 'отчет', 'список', 'экспорт', 'помощь'})
+
+# Название клуба в тексте команды
+_CLUB_RE = re.compile(r'москвич|анора|anora')
+CLUB_BY_ALIAS = {'москвич': 'Москвич', 'анора': 'Анора', 'anora': 'Анора'}
+
+# Подтверждение загрузки файла: "записать", "записать 1 2", "записать без 3"
+_SAVE_MERGES_RE = re.compile(r'записать\s*(без)?(.*)')
+
+
+# Текст справки (команда ПОМОЩЬ)
+HELP_TEXT = (
+    "📋 ПОЛНАЯ СПРАВКА ПО КОМАНДАМ\n\n"
+    "🏢 НАЧАЛО РАБОТЫ:\n"
+    "• Выберите клуб: СТАРТ МОСКВИЧ / СТАРТ АНОРА\n"
+    "• После выбора используйте кнопки меню\n\n"
+    "💰 ВВОД ДАННЫХ:\n"
+    "1️⃣ Нажмите НАЛ или БЕЗНАЛ\n"
+    "2️⃣ Вставьте список данных\n"
+    "3️⃣ Нажмите ГОТОВО → предпросмотр\n"
+    "4️⃣ Укажите дату (например: 3,10)\n"
+    "5️⃣ Проверьте данные в предпросмотре\n"
+    "6️⃣ ЗАПИСАТЬ - сохранить в базу\n\n"
+    "🔍 ПРЕДПРОСМОТР:\n"
+    "После ГОТОВО вы увидите все данные с номерами строк\n"
+    "• ЗАПИСАТЬ → сохранить данные\n"
+    "• ИЗМЕНИТЬ → редактировать строку (укажите номер)\n"
+    "• ОТМЕНА → отменить ввод\n"
+    "• Если есть дубликаты → команды для объединения\n\n"
+    "🔄 ОБЪЕДИНЕНИЕ ДУБЛИКАТОВ:\n"
+    "Если найдены записи с одним кодом (с именем и без):\n"
+    "• ОК → объединить все\n"
+    "• ОК 1 → объединить только пункт 1\n"
+    "• ОК 1 2 → объединить пункты 1 и 2\n"
+    "• НЕ 1 → НЕ объединять пункт 1 (остальные да)\n"
+    "• НЕ 1 2 → НЕ объединять пункты 1 и 2\n\n"
+    "📊 ОТЧЁТЫ:\n"
+    "• ОТЧЁТ → выбрать клуб → указать период\n"
+    "• ВЫПЛАТЫ → код + период (Д7 3,10-5,11)\n"
+    "• Получите Excel файл с отчётом\n\n"
+    "📝 ПРОСМОТР И РЕДАКТИРОВАНИЕ:\n"
+    "• СПИСОК → клуб → дата (посмотреть все записи)\n"
+    "• ИСПРАВИТЬ → код + дата (Д7 3,10)\n"
+    "• УДАЛИТЬ → код + дата (Д7 3,10)\n"
+    "• УДАЛИТЬ ВСЕ → клуб → дата/период (массовое удаление)\n\n"
+    "📤 ЭКСПОРТ:\n"
+    "• ЭКСПОРТ → клуб → период → Excel файл\n\n"
+    "📜 ЖУРНАЛ ИЗМЕНЕНИЙ:\n"
+    "• ЖУРНАЛ → последние 20 изменений\n"
+    "• ЖУРНАЛ 50 → последние 50 изменений\n"
+    "• ЖУРНАЛ Д7 → все изменения по коду Д7\n"
+    "• ЖУРНАЛ 3,10 → все изменения за дату\n"
+    "Показывает: объединения, исправления, удаления\n\n"
+    "🔧 ДОПОЛНИТЕЛЬНО:\n"
+    "• ОБНУЛИТЬ → удалить все данные (нужен пин)\n"
+    "• ЗАВЕРШИТЬ → выход (очистка истории)\n\n"
+    "📖 ФОРМАТЫ ДАТ:\n"
+    "• 3,10 = 03.10.2025\n"
+    "• 30,10 = 30.10.2025\n"
+    "• 3,10-5,11 = период с 3.10 по 5.11\n\n"
+    "📝 ФОРМАТЫ ДАННЫХ:\n"
+    "• Д7 Надя 6800 или Д7 Надя-6800\n"
+    "• Юля Д17 1000\n"
+    "• СБ Дмитрий 4000\n"
+    "• Уборщица-2000\n"
+    "• Суммы: 40,000 или 40.000 → 40000 ✅\n\n"
+    "✨ АВТОМАТИЧЕСКАЯ ОЧИСТКА:\n"
+    "• Дубли из Excel очищаются автоматически\n"
+    "• Разделители тысяч (точки/запятые) удаляются\n"
+    "• В предпросмотре видно что было изменено"
+)
+
+# Подсказка при входе в режим ввода НАЛ / БЕЗНАЛ
+CASH_MODE_PROMPT = (
+    "📥 РЕЖИМ ВВОДА: {mode}\n\n"
+    "🏢 Клуб: {club}\n\n"
+    "📝 Вставьте список данных:\n"
+    "Примеры форматов:\n"
+    "  • Д7 Юля 1000\n"
+    "  • Д7 Юля-1000\n"
+    "  • Юля Д7 1000\n\n"
+    "⏭️ После ввода всех данных (НАЛ и БЕЗНАЛ)\n"
+    "   нажмите: ГОТОВО"
+)
+
 
 class UserState:
     """Класс для хранения состояния пользователя"""
     
+    # Только перечисленные атрибуты, без __dict__ у каждого состояния
+    __slots__ = (
+        'club', 'mode', 'temp_nal_data', 'temp_beznal_data', 'current_date', 'limited_access',
+        'report_club', 'pending_report_period', 'report_operations_cache', 'edit_code', 'edit_date',
+        'edit_current_data', 'delete_code', 'delete_date', 'delete_records', 'delete_mass_club',
+        'delete_mass_date_from', 'delete_mass_date_to', 'delete_mass_preview', 'export_club',
+        'list_club', 'merge_candidates', 'merge_period', 'duplicate_check_data', 'sb_merge_data',
+        'sb_merges_moskvich', 'sb_merges_anora', 'employees_list', 'employees_club',
+        'merge_employee_indices', 'edit_employees_list', 'edit_employees_club',
+        'edit_employee_selected', 'add_employee_club', 'employee_mode', 'employee_code',
+        'employee_club', 'employee_name', 'owner_mode', 'preview_date', 'preview_duplicates',
+        'preview_dup_cache', 'edit_line_number', 'upload_file_club', 'upload_file_date',
+        'upload_file_data', 'payments_upload_club', 'payments_upload_date', 'payments_upload_data',
+        'payments_preview_data', 'payments_name_changes', 'payments_new_employees',
+        'name_changes_data', 'name_changes_index', 'uploaded_file_bytes', 'stylist_club',
+        'stylist_period_from', 'stylist_period_to', 'stylist_expenses', 'stylist_errors',
+        'stylist_edit_index', 'stylist_clarification_queue', 'stylist_clarification_index',
+        'stylist_view_club', 'stylist_view_from', 'stylist_view_to', 'final_report_date',
+        'final_report_files', 'final_report_file_id', 'final_report_club', 'period_summary',
+        'period_start_date', 'period_end_date', 'period_club', 'bot_messages', 'last_seen',
+        # Задаются по ходу работы (проверяются через hasattr/getattr)
+        'processed_clubs_for_report', 'sb_cross_club_matches', 'stylist_view_edit_index',
+    )
+    
     def __init__(self):
         self.club: Optional[str] = None
         self.mode: Optional[str] = None
@@ -60,6 +271,7 @@ class UserState:
         # Для команды отчет
         self.report_club: Optional[str] = None
         self.pending_report_period: Optional[tuple] = None  # Для хранения периода при обработке "оба"
+        self.report_operations_cache: dict = {}  # Операции клубов на время обработки "оба"
         
         # Для команды исправить
         self.edit_code: Optional[str] = None
@@ -120,6 +332,7 @@ class UserState:
         # Для предпросмотра данных
         self.preview_date: Optional[str] = None
         self.preview_duplicates: Optional[list] = None
+        self.preview_dup_cache: Optional[tuple] = None  # (сигнатура строк, строки, дубликаты)
         self.edit_line_number: Optional[int] = None
         
         # Для загрузки файла Excel
@@ -166,7 +379,10 @@ class UserState:
         self.period_club: Optional[str] = None
         
         # ID сообщений бота для удаления
-        self.bot_messages: list = []
+        self.bot_messages: deque = deque(maxlen=100)  # последние 100 сообщений бота
+        
+        # Время последнего обращения (time.monotonic) - для удаления неактивных состояний
+        self.last_seen: float = time.monotonic()
     
     def reset_input(self):
         """Сброс блочного ввода"""
@@ -175,6 +391,7 @@ class UserState:
         self.temp_beznal_data = []
         self.preview_date = None
         self.preview_duplicates = None
+        self.preview_dup_cache = None
         self.edit_line_number = None
         self.delete_mass_club = None
         self.delete_mass_date_from = None
@@ -189,28 +406,154 @@ class UserState:
         self.employee_club = None
         self.employee_name = None
     
+    def clear_transient(self):
+        """Сброс всех незавершённых операций по ОТМЕНЕ (клуб остаётся)"""
+        self.reset_input()
+        self.duplicate_check_data = None
+        self.sb_merge_data = None
+        self.report_club = None
+        self.export_club = None
+        self.list_club = None
+        self.edit_code = None
+        self.edit_date = None
+        self.edit_current_data = None
+        self.delete_code = None
+        self.delete_date = None
+        self.delete_records = None
+        self.merge_candidates = None
+        self.merge_period = None
+        self.upload_file_club = None
+        self.upload_file_date = None
+        self.upload_file_data = None
+        self.payments_upload_club = None
+        self.payments_upload_date = None
+        self.payments_upload_data = None
+        self.payments_preview_data = None
+        self.payments_name_changes = None
+        self.stylist_club = None
+        self.stylist_period_from = None
+        self.stylist_period_to = None
+        self.stylist_expenses = None
+        self.stylist_errors = None
+    
     def has_data(self) -> bool:
         """Проверка наличия данных"""
-        return len(self.temp_nal_data) > 0 or len(self.temp_beznal_data) > 0
+        return bool(self.temp_nal_data or self.temp_beznal_data)
 
 
-def get_user_state(user_id: int) -> UserState:
-    """Получить состояние пользователя"""
-    if user_id not in USER_STATES:
-        USER_STATES[user_id] = UserState()
-    return USER_STATES[user_id]
+def get_user_state(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> UserState:
+    """Получить состояние пользователя для бота из context"""
+    global _user_states_pruned_at
+    now = time.monotonic()
+    
+    key = (context.bot.id, user_id)
+    state = USER_STATES.get(key)
+    if state is None:
+        state = USER_STATES[key] = UserState()
+        if len(USER_STATES) > MAX_USER_STATES:
+            USER_STATES.popitem(last=False)
+    else:
+        USER_STATES.move_to_end(key)
+    state.last_seen = now
+    
+    # Периодически удаляем давно неактивных: они в начале словаря
+    if now - _user_states_pruned_at > USER_STATES_PRUNE_INTERVAL:
+        _user_states_pruned_at = now
+        while USER_STATES:
+            oldest = next(iter(USER_STATES.values()))
+            if now - oldest.last_seen <= USER_STATE_TTL:
+                break
+            USER_STATES.popitem(last=False)
+    
+    return state
 
 
 async def send_and_save(update: Update, state: UserState, text: str, **kwargs):
     """Отправить сообщение и сохранить его ID для возможного удаления"""
     msg = await update.message.reply_text(text, **kwargs)
+    # deque(maxlen=100) сам вытесняет старые ID
     state.bot_messages.append(msg.message_id)
-    # Ограничиваем список (храним только последние 100 сообщений)
-    if len(state.bot_messages) > 100:
-        state.bot_messages = state.bot_messages[-100:]
     return msg
 
 
+def chunk_records(records: List[str], header: str, max_length: int = TELEGRAM_CHUNK_SIZE) -> List[str]:
+    """
+    Раскладка готовых записей списка по сообщениям до max_length символов
+    header: заголовок каждого сообщения с полями {start}, {end}, {total}
+    """
+    chunks = []
+    total = len(records)
+    chunk_start = 0
+    length = 0
+    
+    for i, record in enumerate(records):
+        # Запись не помещается - закрываем текущее сообщение
+        if length + len(record) > max_length and i > chunk_start:
+            chunks.append(header.format(start=chunk_start + 1, end=i, total=total) + ''.join(records[chunk_start:i]))
+            chunk_start = i
+            length = 0
+        length += len(record)
+    
+    if chunk_start < total:
+        chunks.append(header.format(start=chunk_start + 1, end=total, total=total) + ''.join(records[chunk_start:]))
+    
+    return chunks
+
+
+async def reply_text_chunks(message, chunks: List[str]):
+    """
+    Отправка частей длинного списка
+    Части уходят по очереди: параллельные отправки в один чат могут прийти не по порядку
+    """
+    for chunk in chunks:
+        await message.reply_text(chunk)
+
+
+async def reply_lines_chunked(message, lines: Iterable[str], max_length: int = 4000):
+    """
+    Отправка строк сообщениями до max_length символов (строки соединяются через '\n').
+    Каждая часть уходит сразу, как только заполнена, - без промежуточного списка частей
+    """
+    current = []
+    current_len = 0  # длина '\n'.join(current)
+    
+    for line in lines:
+        if current and current_len + 1 + len(line) > max_length:
+            await message.reply_text('\n'.join(current))
+            current = [line]
+            current_len = len(line)
+        else:
+            current_len += len(line) + (1 if current else 0)
+            current.append(line)
+    
+    if current:
+        await message.reply_text('\n'.join(current))
+
+
+async def delete_messages_limited(bot, chat_id: int, message_ids: Iterable[int]) -> int:
+    """
+    Удалить сообщения, не больше DELETE_MESSAGES_CONCURRENCY запросов одновременно.
+    Ошибки (сообщение уже удалено или слишком старое) пропускаем; возвращает число удалённых
+    """
+    semaphore = asyncio.Semaphore(DELETE_MESSAGES_CONCURRENCY)
+    
+    async def delete(message_id: int):
+        async with semaphore:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    
+    results = await asyncio.gather(*(delete(message_id) for message_id in message_ids), return_exceptions=True)
+    return sum(1 for result in results if not isinstance(result, BaseException))
+
+
+async def reply_document_from_disk(message, path: str, **kwargs):
+    """
+    Отправить файл с диска ответом на сообщение
+    Файл читается в рабочем потоке, чтобы не блокировать event loop
+    """
+    content = await asyncio.to_thread(Path(path).read_bytes)
+    return await message.reply_document(document=content, **kwargs)
+
+
 def get_main_keyboard():
     """Главная клавиатура с основными командами"""
     keyboard = [
@@ -570,11 +913,74 @@ def get_merge_confirmation_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
+# Неизменяемые клавиатуры создаём один раз при загрузке модуля
+MAIN_KEYBOARD = get_main_keyboard()
+CLUB_REPORT_KEYBOARD = get_club_report_keyboard()
+SELF_EMPLOYED_KEYBOARD = get_self_employed_action_keyboard()
+MERGE_CONFIRM_KEYBOARD = get_merge_confirmation_keyboard()
+CLUB_KEYBOARD = get_club_keyboard()
+CLUB_CHOICE_KEYBOARD = get_club_choice_keyboard()
+EMPLOYEE_MENU_KEYBOARD = get_employee_menu_keyboard()
+OWNER_MENU_KEYBOARD = get_owner_menu_keyboard()
+CLUB_EMPLOYEES_KEYBOARD = get_club_employees_keyboard()
+EMPLOYEES_MENU_KEYBOARD = get_employees_menu_keyboard()
+DELETE_KEYBOARD = get_delete_keyboard()
+DELETE_MODE_KEYBOARD = get_delete_mode_keyboard()
+DELETE_MASS_CONFIRM_KEYBOARD = get_delete_mass_confirm_keyboard()
+
+
 def make_processed_key(code: str, name: Optional[str]) -> Tuple[str, str]:
     """Нормализованный ключ для отслеживания уже обработанных записей"""
     return code, (name or "").strip()
 
 
+def format_salary_message(header: str, stavka, lm_3, percent_5, promo, crz, cons, tips, fines,
+                          total_shift, debt, debt_nal, to_pay,
+                          wide_rule: bool = False, brief_totals: bool = False) -> str:
+    """
+    Текст начисления ЗП за смену: заголовок + начисления + итоги и «К выплате»
+    wide_rule: длинная черта перед итогами (уведомление о ЗП и «Последняя ЗП»)
+    brief_totals: только «ИТОГО» и «К выплате», без долгов (ввод «ЗП за дату» текстом)
+    """
+    # 10% вычет с долга БН, к выплате - без стилистов
+    vychet_10 = round(debt * 0.1)
+    k_vyplate = round(debt_nal + debt - vychet_10)
+    
+    msg_parts = [
+        header,
+        f"━━━━━━━━━━━━━━━━━━━\n"
+        f"💵 Ставка: {int(stavka)}\n"
+        f"📊 3% ЛМ: {int(lm_3)}\n"
+        f"📊 5%: {int(percent_5)}\n"
+        f"🎉 Промо: {int(promo)}\n"
+        f"🍽 CRZ: {int(crz)}\n"
+        f"🥂 Cons: {int(cons)}\n"
+        f"💸 Чаевые: {int(tips)}\n"
+    ]
+    
+    if fines:
+        msg_parts.append(f"⚠️ Штрафы: {int(fines)}\n")
+    
+    msg_parts.append("━━━━━━━━━━━━━━━━━━━━━\n" if wide_rule else "━━━━━━━━━━━━━━━━━━━\n")
+    
+    if brief_totals:
+        msg_parts.append(
+            f"💰 ИТОГО: {int(total_shift)}\n"
+            f"💎 К ВЫПЛАТЕ: {k_vyplate} ₽\n"
+        )
+        return ''.join(msg_parts)
+    
+    msg_parts.append(
+        f"💰 ИТОГО выплат: {int(total_shift)}\n"
+        f"💵 Получила на смене: {int(to_pay)}\n"
+        f"📋 Долг БН: {int(debt)}\n"
+        f"📋 Долг НАЛ: {int(debt_nal)}\n"
+        f"━━━━━━━━━━━━━━━━━━━\n"
+        f"💎 К ВЫПЛАТЕ: {k_vyplate} ₽\n"
+    )
+    return ''.join(msg_parts)
+
+
 async def send_salary_notifications(bot, uploaded_payments: List[Dict], club: str, date: str):
     """
     Автоматическая рассылка уведомлений о ЗП сотрудникам при загрузке файла
@@ -631,50 +1037,17 @@ async def send_salary_notifications(bot, uploaded_payments: List[Dict], club: st
             print(f"DEBUG: Sending notification to {code} ({full_name}), TG_ID: {telegram_user_id}, club: {club}, date: {date}")
             
             # Формируем сообщение в формате "Последняя ЗП"
-            stavka = payment.get('stavka', 0)
-            lm_3 = payment.get('lm_3', 0)
-            percent_5 = payment.get('percent_5', 0)
-            promo = payment.get('promo', 0)
-            crz = payment.get('crz', 0)
-            cons = payment.get('cons', 0)
-            tips = payment.get('tips', 0)
-            fines = payment.get('fines', 0)
-            total_shift = payment.get('total_shift', 0)
-            debt = payment.get('debt', 0)
-            debt_nal = payment.get('debt_nal', 0)
-            to_pay = payment.get('to_pay', 0)
-            
-            # Пересчитываем К выплате
-            vychet_10 = round(debt * 0.1) if debt else 0
-            k_vyplate = round((debt_nal or 0) + (debt or 0) - vychet_10)
-            
-            msg = (
+            msg = format_salary_message(
                 f"💰 ВАША ЗП НАЧИСЛЕНА\n\n"
                 f"📅 Дата: {date}\n"
                 f"💼 Код: {code}\n"
                 f"👤 {full_name or code}\n"
-                f"🏢 Клуб: {club}\n\n"
-                f"━━━━━━━━━━━━━━━━━━━\n"
-                f"💵 Ставка: {int(stavka)}\n"
-                f"📊 3% ЛМ: {int(lm_3)}\n"
-                f"📊 5%: {int(percent_5)}\n"
-                f"🎉 Промо: {int(promo)}\n"
-                f"🍽 CRZ: {int(crz)}\n"
-                f"🥂 Cons: {int(cons)}\n"
-                f"💸 Чаевые: {int(tips)}\n"
-            )
-            
-            if fines:
-                msg += f"⚠️ Штрафы: {int(fines)}\n"
-            
-            msg += (
-                f"━━━━━━━━━━━━━━━━━━━━━\n"
-                f"💰 ИТОГО выплат: {int(total_shift)}\n"
-                f"💵 Получила на смене: {int(to_pay or 0)}\n"
-                f"📋 Долг БН: {int(debt or 0)}\n"
-                f"📋 Долг НАЛ: {int(debt_nal or 0)}\n"
-                f"━━━━━━━━━━━━━━━━━━━\n"
-                f"💎 К ВЫПЛАТЕ: {k_vyplate} ₽\n"
+                f"🏢 Клуб: {club}\n\n",
+                payment.get('stavka', 0), payment.get('lm_3', 0), payment.get('percent_5', 0),
+                payment.get('promo', 0), payment.get('crz', 0), payment.get('cons', 0),
+                payment.get('tips', 0), payment.get('fines', 0), payment.get('total_shift', 0),
+                payment.get('debt') or 0, payment.get('debt_nal') or 0, payment.get('to_pay') or 0,
+                wide_rule=True
             )
             
             # Отправляем уведомление (игнорируем ошибки)
@@ -952,10 +1325,19 @@ def decimal_to_float(value):
         return None
 
 
+# Разделитель тысяч - пробел вместо запятой (1,234,567 -> 1 234 567)
+_SPACE_TRANS = str.maketrans(',', ' ')
+
+
+def format_amount(value) -> str:
+    """Сумма без дробной части с пробелами между разрядами"""
+    return format(value, ',.0f').translate(_SPACE_TRANS)
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start и старт"""
     user_id = update.effective_user.id
-    state = get_user_state(user_id)
+    state = get_user_state(context, user_id)
     
     # Проверка: админ, владелец или сотрудник?
     if db.is_admin(user_id):
@@ -970,7 +1352,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• 📊 ОТЧЁТ - просмотр отчётов по клубам\n"
             "• 💵 ЗП - просмотр зарплат сотрудников\n\n"
             "Используйте кнопки меню:",
-            reply_markup=get_owner_menu_keyboard()
+            reply_markup=OWNER_MENU_KEYBOARD
         )
         return
     else:
@@ -988,7 +1370,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🏢 Клуб: {state.employee_club}\n"
                 f"💼 Код: {state.employee_code}\n\n"
                 f"Используйте кнопки меню:",
-                reply_markup=get_employee_menu_keyboard()
+                reply_markup=EMPLOYEE_MENU_KEYBOARD
             )
             return
         else:
@@ -1014,21 +1396,18 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text.strip() == '/start':
         await update.message.reply_text(
             "Выберите клуб:",
-            reply_markup=get_club_choice_keyboard()
+            reply_markup=CLUB_CHOICE_KEYBOARD
         )
         return
     
     # Определяем клуб
-    club = None
-    if 'москвич' in text:
-        club = 'Москвич'
-    elif 'анора' in text or 'anora' in text:
-        club = 'Анора'
+    match = _CLUB_RE.search(text)
+    club = CLUB_BY_ALIAS[match.group()] if match else None
     
     if not club:
         await update.message.reply_text(
             "Выберите клуб, нажав на кнопку ниже:",
-            reply_markup=get_club_choice_keyboard()
+            reply_markup=CLUB_CHOICE_KEYBOARD
         )
         return
     
@@ -1054,18 +1433,28 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"   • Нажмите ОТЧЁТ, ВЫПЛАТЫ или СПИСОК\n\n"
         f"❓ Полная справка: нажмите ПОМОЩЬ\n\n"
         f"Используйте кнопки меню ⬇️",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка текстовых сообщений"""
     user_id = update.effective_user.id
-    state = get_user_state(user_id)
     text = update.message.text.strip()
+    
+    # Посторонних (не админ, не сотрудник, не владелец, не из QUICK_ACCESS_USER_IDS)
+    # отсекаем сразу: без разбора команды и без создания состояния
+    known = USER_STATES.get((context.bot.id, user_id))
+    if ((known is None or not (known.employee_mode or known.owner_mode))
+            and user_id not in config.QUICK_ACCESS_USER_IDS
+            and not db.is_admin(user_id)
+            and not db.get_employee_by_telegram_id(user_id)):
+        return
+    
+    state = get_user_state(context, user_id)
     text_lower = normalize_command(text)
     
-    print(f"DEBUG: Получена команда: '{text}', mode={state.mode}, limited_access={state.limited_access}")
+    logger.debug("Получена команда: %r, mode=%s, limited_access=%s", text, state.mode, state.limited_access)
     
     # Проверка: если сотрудник был авторизован, но доступ удален - сбрасываем сессию
     if state.employee_mode:
@@ -1139,10 +1528,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Пропускаем - пусть обработают специализированные обработчики режимов ниже
             pass
     
-    # Проверка авторизации
-    if not db.is_admin(user_id) and not state.employee_mode and not state.owner_mode:
-        # Специальный код для limited_access
-        if text == "0001":
+    # Проверка авторизации (сессия быстрого доступа уже прошла её при вводе кода)
+    if not db.is_admin(user_id) and not state.employee_mode and not state.owner_mode and not state.limited_access:
+        # Специальный код для limited_access - только для QUICK_ACCESS_USER_IDS
+        if text == "0001" and user_id in config.QUICK_ACCESS_USER_IDS:
             state.limited_access = True
             
             keyboard = [[InlineKeyboardButton("❌ Выход", callback_data="quick_exit")]]
@@ -1175,7 +1564,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"🏢 Клуб: {state.employee_club}\n"
                     f"💼 Код: {state.employee_code}\n\n"
                     f"Используйте кнопки меню:",
-                    reply_markup=get_employee_menu_keyboard()
+                    reply_markup=EMPLOYEE_MENU_KEYBOARD
                 )
                 return
             else:
@@ -1191,250 +1580,38 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_employee_only = employee and not db.is_admin(user_id) and not state.owner_mode
     
     if is_employee_only:
-        # Список разрешённых команд для сотрудников (личный кабинет)
-        allowed_employee_commands = [
-            'выход', '❌ выход',
-            'моя зп', '💰 моя зп',
-            'история выплат', '💵 история выплат',
-            'отмена', '❌ отмена'
-        ]
-        
-        # Разрешены также вводы дат в режимах личного кабинета
-        allowed_modes = [
-            'employee_awaiting_date',
-            'employee_awaiting_period'
-        ]
-        
         # Если команда не из списка разрешённых И не в режиме ввода даты
-        if (text_lower not in [cmd.lower() for cmd in allowed_employee_commands] and 
-            state.mode not in allowed_modes):
+        if (text_lower not in EMPLOYEE_ALLOWED_COMMANDS and 
+            state.mode not in EMPLOYEE_ALLOWED_MODES):
             
             # Игнорируем команду (не реагируем)
             print(f"[SECURITY] Заблокирована попытка сотрудника {user_id} выполнить команду: {text}")
             return
     
+    # Ограниченный доступ (код 0001) - всё сообщение обрабатывает отдельный обработчик
+    if state.limited_access:
+        await handle_limited_access_message(update, context, state, text, text_lower)
+        return
+    
     # УНИВЕРСАЛЬНАЯ КНОПКА ОТМЕНА - работает на ЛЮБОМ этапе!
     # Проверяем ПЕРЕД всеми режимами
     if text_lower == 'отмена' or text_lower == '❌ отмена':
-        # Список режимов где ОТМЕНА должна работать
-        cancelable_modes = [
-            'awaiting_preview_date', 'awaiting_preview_action', 'awaiting_edit_line_number', 'awaiting_edit_line_data',
-            'awaiting_edit_params', 'awaiting_edit_data', 'awaiting_delete_choice',
-            'awaiting_report_club', 'awaiting_report_period', 'awaiting_duplicate_confirm', 'awaiting_sb_merge_confirm',
-            'awaiting_export_club', 'awaiting_export_period',
-            'awaiting_merge_confirm', 'awaiting_list_club', 'awaiting_list_date', 'awaiting_payments_input', 'awaiting_salary_input',
-            'awaiting_delete_mass_club', 'awaiting_delete_mass_period', 'awaiting_delete_mass_confirm',
-            'awaiting_delete_employee_input',
-            'awaiting_upload_club', 'awaiting_upload_date', 'awaiting_upload_file', 'awaiting_upload_confirm',
-            'awaiting_payments_upload_club', 'awaiting_payments_upload_date', 'awaiting_payments_upload_file',
-            'awaiting_stylist_period', 'awaiting_stylist_data', 'awaiting_stylist_confirm', 
-            'awaiting_stylist_edit_number', 'awaiting_stylist_edit_data', 'awaiting_stylist_clarification',
-            'awaiting_employee_edit_select', 'awaiting_emp_code', 'awaiting_add_employee',
-            'awaiting_emp_name', 'awaiting_emp_phone', 'awaiting_emp_tg', 'awaiting_emp_birth',
-            'employee_awaiting_date', 'employee_awaiting_period',
-            'нал', 'безнал'
-        ]
-        
-        if state.mode in cancelable_modes or state.has_data():
-            # Если ограниченный доступ - выходим полностью
-            if state.limited_access:
-                state.__init__()
-                state.limited_access = False
-                await update.message.reply_text(
-                    "❌ Сессия завершена\n\n"
-                    "Для начала работы введите /start"
-                )
-                return
-            
+        if state.mode in CANCELABLE_MODES or state.has_data():
             # Полная очистка (но клуб остаётся!)
-            saved_club = state.club  # Сохраняем клуб
-            state.reset_input()
-            state.mode = None
-            state.duplicate_check_data = None
-            state.sb_merge_data = None
-            state.report_club = None
-            state.export_club = None
-            state.list_club = None
-            state.edit_code = None
-            state.edit_date = None
-            state.edit_current_data = None
-            state.delete_code = None
-            state.delete_date = None
-            state.delete_records = None
-            state.merge_candidates = None
-            state.merge_period = None
-            state.upload_file_club = None
-            state.upload_file_date = None
-            state.upload_file_data = None
-            state.payments_upload_club = None
-            state.payments_upload_date = None
-            state.payments_upload_data = None
-            state.payments_preview_data = None
-            state.payments_name_changes = None
-            state.stylist_club = None
-            state.stylist_period_from = None
-            state.stylist_period_to = None
-            state.stylist_expenses = None
-            state.stylist_errors = None
-            state.club = saved_club  # Восстанавливаем клуб
+            state.clear_transient()
             
             await update.message.reply_text(
                 f"❌ Операция отменена\n\n"
                 f"🏢 Клуб: {state.club}\n"
                 f"Используйте кнопки меню:",
-                reply_markup=get_main_keyboard()
-            )
-            return
-    
-    # Проверка ограниченного доступа (пароль 0001)
-    # Список команд, доступных ТОЛЬКО при полном доступе
-    restricted_commands = [
-        'нал', 'безнал', 'готово', 'загрузить файл', 'загрузить зп',
-        'отчет', 'список', 'экспорт', 
-        'исправить', 'удалить', 'обнулить',
-        'сотрудники', 'объединить', 'самозанятые', 'стилисты',
-        'помощь', 'старт москвич', 'старт анора'
-    ]
-    
-    # Проверяем режимы ввода данных
-    restricted_modes = [
-        'нал', 'безнал', 'awaiting_preview_date', 'awaiting_preview_action',
-        'awaiting_edit_line_number', 'awaiting_edit_line_data',
-        'awaiting_report_club', 'awaiting_report_period',
-        'awaiting_list_club', 'awaiting_list_date',
-        'awaiting_export_club', 'awaiting_export_period',
-        'awaiting_edit_params', 'awaiting_edit_data',
-        'awaiting_delete_choice', 'awaiting_delete_mass_club',
-        'awaiting_upload_club', 'awaiting_upload_date', 'awaiting_upload_file',
-        'awaiting_payments_upload_club', 'awaiting_payments_upload_date', 'awaiting_payments_upload_file',
-        'awaiting_stylist_period', 'awaiting_stylist_data',
-        'awaiting_merge_confirm', 'awaiting_duplicate_confirm', 'awaiting_sb_merge_confirm',
-        'awaiting_salary_input', 'awaiting_employee_edit_select', 'awaiting_emp_code', 'awaiting_add_employee',
-        'awaiting_emp_name', 'awaiting_emp_phone', 'awaiting_emp_tg', 'awaiting_emp_birth',
-        'employee_awaiting_date', 'employee_awaiting_period'
-    ]
-    
-    if state.limited_access:
-        # Проверяем команды
-        if text_lower in restricted_commands:
-            await update.message.reply_text(
-                "❌ Доступ запрещён\n\n"
-                "У вас ограниченный доступ.\n"
-                "Доступна только функция 'Выплаты'."
-            )
-            return
-        
-        # Проверяем режимы (если пользователь пытается что-то ввести в неразрешённом режиме)
-        if state.mode in restricted_modes:
-            await update.message.reply_text(
-                "❌ Доступ запрещён\n\n"
-                "У вас ограниченный доступ.\n"
-                "Доступна только функция 'Выплаты'."
-            )
-            state.mode = None  # Сбрасываем режим
-            return
-    
-    if state.mode == 'awaiting_delete_mass_club':
-        await handle_delete_mass_club_input(update, state, text, text_lower)
-        return
-    
-    if state.mode == 'awaiting_delete_mass_period':
-        await handle_delete_mass_period_input(update, state, text, text_lower)
-        return
-    
-    if state.mode == 'awaiting_delete_mass_confirm':
-        await handle_delete_mass_confirm_text(update, state, text_lower)
-        return
-
-    if state.mode == 'awaiting_delete_employee_input':
-        await handle_delete_employee_input(update, context, state, text)
-        return
-    
-    # Обработка ввода даты для загрузки файла
-    if state.mode == 'awaiting_upload_date':
-        success, parsed_date, error = parse_short_date(text)
-        if success:
-            state.upload_file_date = parsed_date
-            await update.message.reply_text(
-                f"📎 ЗАГРУЗКА ФАЙЛА\n"
-                f"🏢 Клуб: {state.upload_file_club}\n"
-                f"📅 Дата: {parsed_date}\n\n"
-                f"📄 Теперь отправьте Excel файл"
-            )
-            state.mode = 'awaiting_upload_file'
-        else:
-            await update.message.reply_text(
-                f"❌ {error}\n\n"
-                f"Введите дату (формат: 30,10 или 28,12,25) или напишите: отмена"
-            )
-        return
-    
-    # Обработка выбора клуба для загрузки ЗП
-    if state.mode == 'awaiting_payments_upload_club':
-        club_choice = text_lower
-        if club_choice in ['москвич', 'анора']:
-            state.payments_upload_club = 'Москвич' if club_choice == 'москвич' else 'Анора'
-            await update.message.reply_text(
-                f"💰 ЗАГРУЗКА ЗП\n"
-                f"🏢 Клуб: {state.payments_upload_club}\n\n"
-                f"📅 Введите дату (формат: 30,10 или 28,12,25):"
-            )
-            state.mode = 'awaiting_payments_upload_date'
-        else:
-            await update.message.reply_text("❌ Выберите: москвич или анора")
-        return
-    
-    # Обработка ввода даты для загрузки ЗП
-    if state.mode == 'awaiting_payments_upload_date':
-        success, parsed_date, error = parse_short_date(text)
-        if success:
-            state.payments_upload_date = parsed_date
-            await update.message.reply_text(
-                f"💰 ЗАГРУЗКА ЗП\n"
-                f"🏢 Клуб: {state.payments_upload_club}\n"
-                f"📅 Дата: {parsed_date}\n\n"
-                f"📄 Теперь отправьте Excel файл"
-            )
-            state.mode = 'awaiting_payments_upload_file'
-        else:
-            await update.message.reply_text(
-                f"❌ {error}\n\n"
-                f"Введите дату (формат: 30,10 или 28,12,25) или напишите: отмена"
-            )
-        return
-    
-    # НОВАЯ ЛОГИКА: обработка предпросмотра и ввода даты
-    if state.mode == 'awaiting_preview_date':
-        # Пытаемся распарсить дату
-        success, parsed_date, error = parse_short_date(text)
-        if success:
-            # Сохраняем дату и показываем финальный предпросмотр
-            state.preview_date = parsed_date
-            await show_data_preview(update, state, show_duplicates=True)
-            
-            # Переходим в режим ожидания действия (ЗАПИСАТЬ/ИЗМЕНИТЬ/ОТМЕНА)
-            state.mode = 'awaiting_preview_action'
-            return
-        else:
-            await update.message.reply_text(
-                f"❌ {error}\n\n"
-                f"Введите дату (формат: 30,10 или 28,12,25) или напишите: отмена"
+                reply_markup=MAIN_KEYBOARD
             )
             return
     
-    # Обработка действий в режиме предпросмотра
-    if state.mode == 'awaiting_preview_action':
-        await handle_preview_action(update, state, text, text_lower)
-        return
-    
-    # Обработка ввода номера строки для редактирования
-    if state.mode == 'awaiting_edit_line_number':
-        await handle_edit_line_number(update, state, text)
-        return
-    
-    # Обработка ввода новых данных для строки
-    if state.mode == 'awaiting_edit_line_data':
-        await handle_edit_line_data(update, state, text)
+    # Режимы ввода, которые обрабатываются раньше любых команд
+    handler = INPUT_MODE_HANDLERS.get(state.mode)
+    if handler:
+        await handler(update, context, state, text, text_lower)
         return
     
     # Команда "обнулить"
@@ -1485,19 +1662,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text_lower == 'завершить' or text_lower == '🚪 завершить':
         # Удаляем сообщения бота (последние сохранённые)
         chat_id = update.effective_chat.id
-        deleted_count = 0
         
-        for msg_id in state.bot_messages[-50:]:  # Последние 50 сообщений
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                deleted_count += 1
-            except:
-                pass  # Игнорируем ошибки (сообщение уже удалено или старое)
+        # Последние 50 сообщений удаляем параллельно, небольшими порциями запросов
+        deleted_count = await delete_messages_limited(context.bot, chat_id, list(state.bot_messages)[-50:])
         
         # Очищаем состояние
         state.reset_input()
         state.club = None
-        state.bot_messages = []
+        state.bot_messages.clear()
         state.employee_mode = False
         state.limited_access = False
         
@@ -1579,19 +1751,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             # Получаем ЗП за эту дату (поиск по всем клубам, так как сотрудник может быть в обоих)
-            conn = db.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT date, club, stavka, lm_3, percent_5, promo, crz, cons, tips, 
-                       fines, total_shift, debt, debt_nal, to_pay
-                FROM payments
-                WHERE code = ? AND date = ?
-                ORDER BY club
-            """, (state.employee_code, date_formatted))
-            
-            rows = cursor.fetchall()
-            conn.close()
+            rows = await asyncio.to_thread(db.get_employee_payments_by_date, state.employee_code, date_formatted)
             
             if not rows:
                 await update.message.reply_text(
@@ -1606,34 +1766,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Обрабатываем все записи (может быть несколько клубов)
             for row in rows:
-                date, club, stavka, lm_3, percent_5, promo, crz, cons, tips, fines, total_shift, debt, debt_nal, to_pay = row
-                
-                vychet_10 = round(debt * 0.1) if debt else 0
-                k_vyplate = round((debt_nal or 0) + (debt or 0) - vychet_10)
-                
-                msg = (
+                date, club = row[0], row[1]
+                msg = format_salary_message(
                     f"💰 ЗП ЗА {date_str_input}\n\n"
                     f"🏢 Клуб: {club}\n"
                     f"📅 Дата: {date}\n"
                     f"💼 Код: {state.employee_code}\n"
-                    f"👤 {state.employee_name}\n\n"
-                    f"━━━━━━━━━━━━━━━━━━━\n"
-                    f"💵 Ставка: {int(stavka)}\n"
-                    f"📊 3% ЛМ: {int(lm_3)}\n"
-                    f"📊 5%: {int(percent_5)}\n"
-                    f"🎉 Промо: {int(promo)}\n"
-                    f"🍽 CRZ: {int(crz)}\n"
-                    f"🥂 Cons: {int(cons)}\n"
-                    f"💸 Чаевые: {int(tips)}\n"
-                )
-                
-                if fines:
-                    msg += f"⚠️ Штрафы: {int(fines)}\n"
-                
-                msg += (
-                    f"━━━━━━━━━━━━━━━━━━━\n"
-                    f"💰 ИТОГО: {int(total_shift)}\n"
-                    f"💎 К ВЫПЛАТЕ: {k_vyplate} ₽\n"
+                    f"👤 {state.employee_name}\n\n",
+                    *row[2:], brief_totals=True
                 )
                 
                 await update.message.reply_text(msg)
@@ -1663,35 +1803,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             state.mode = None
             return
     
-    # Сопоставление кнопок с командами
-    button_commands = {
-        '🏢 старт москвич': 'старт москвич',
-        '🏢 старт анора': 'старт анора',
-        '📥 нал': 'нал',
-        '📥 безнал': 'безнал',
-        '📎 загрузить файл': 'загрузить файл',
-        '💰 загрузить зп': 'загрузить зп',
-        '✅ готово': 'готово',
-        '❌ отмена': 'отмена',
-        '📊 отчёт': 'отчет',
-        '📊 отчет': 'отчет',
-        '💰 выплаты': 'выплаты',
-        '💵 зп': 'зп',
-        '📋 список': 'список',
-        '📤 экспорт': 'экспорт',
-        '✏️ исправить': 'исправить',
-        '🗑️ удалить': 'удалить',
-        '📜 журнал': 'журнал',
-        '👔 самозанятые': 'самозанятые',
-        '👥 сотрудники': 'сотрудники',
-        '💄 стилисты': 'стилисты',
-        '❓ помощь': 'помощь',
-        '🚪 завершить': 'завершить'
-    }
-    
     # Если нажата кнопка - преобразуем в команду
-    if text_lower in button_commands:
-        text_lower = button_commands[text_lower]
+    if text_lower in BUTTON_COMMANDS:
+        text_lower = BUTTON_COMMANDS[text_lower]
     
     # Команда "старт москвич" или "старт анора" - обрабатываем ПЕРВОЙ (после преобразования кнопок!)
     if text_lower.startswith('старт'):
@@ -1708,89 +1822,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Команда "кнопки" - показать клавиатуру
     if text_lower == 'кнопки':
-        # Блокируем для ограниченного доступа
-        if state.limited_access:
-            await update.message.reply_text(
-                "❌ Доступ запрещён\n\n"
-                "У вас ограниченный доступ.\n"
-                "Доступна только функция 'Выплаты'."
-            )
-            return
-        
         if state.club:
             await update.message.reply_text(
                 "Клавиатура:",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
         else:
             await update.message.reply_text(
                 "Сначала выберите клуб:",
-                reply_markup=get_club_keyboard()
+                reply_markup=CLUB_KEYBOARD
             )
         return
     
     # Команда "помощь"
     if text_lower in ['помощь', 'help']:
-        await update.message.reply_text(
-            "📋 ПОЛНАЯ СПРАВКА ПО КОМАНДАМ\n\n"
-            "🏢 НАЧАЛО РАБОТЫ:\n"
-            "• Выберите клуб: СТАРТ МОСКВИЧ / СТАРТ АНОРА\n"
-            "• После выбора используйте кнопки меню\n\n"
-            "💰 ВВОД ДАННЫХ:\n"
-            "1️⃣ Нажмите НАЛ или БЕЗНАЛ\n"
-            "2️⃣ Вставьте список данных\n"
-            "3️⃣ Нажмите ГОТОВО → предпросмотр\n"
-            "4️⃣ Укажите дату (например: 3,10)\n"
-            "5️⃣ Проверьте данные в предпросмотре\n"
-            "6️⃣ ЗАПИСАТЬ - сохранить в базу\n\n"
-            "🔍 ПРЕДПРОСМОТР:\n"
-            "После ГОТОВО вы увидите все данные с номерами строк\n"
-            "• ЗАПИСАТЬ → сохранить данные\n"
-            "• ИЗМЕНИТЬ → редактировать строку (укажите номер)\n"
-            "• ОТМЕНА → отменить ввод\n"
-            "• Если есть дубликаты → команды для объединения\n\n"
-            "🔄 ОБЪЕДИНЕНИЕ ДУБЛИКАТОВ:\n"
-            "Если найдены записи с одним кодом (с именем и без):\n"
-            "• ОК → объединить все\n"
-            "• ОК 1 → объединить только пункт 1\n"
-            "• ОК 1 2 → объединить пункты 1 и 2\n"
-            "• НЕ 1 → НЕ объединять пункт 1 (остальные да)\n"
-            "• НЕ 1 2 → НЕ объединять пункты 1 и 2\n\n"
-            "📊 ОТЧЁТЫ:\n"
-            "• ОТЧЁТ → выбрать клуб → указать период\n"
-            "• ВЫПЛАТЫ → код + период (Д7 3,10-5,11)\n"
-            "• Получите Excel файл с отчётом\n\n"
-            "📝 ПРОСМОТР И РЕДАКТИРОВАНИЕ:\n"
-            "• СПИСОК → клуб → дата (посмотреть все записи)\n"
-            "• ИСПРАВИТЬ → код + дата (Д7 3,10)\n"
-            "• УДАЛИТЬ → код + дата (Д7 3,10)\n"
-            "• УДАЛИТЬ ВСЕ → клуб → дата/период (массовое удаление)\n\n"
-            "📤 ЭКСПОРТ:\n"
-            "• ЭКСПОРТ → клуб → период → Excel файл\n\n"
-            "📜 ЖУРНАЛ ИЗМЕНЕНИЙ:\n"
-            "• ЖУРНАЛ → последние 20 изменений\n"
-            "• ЖУРНАЛ 50 → последние 50 изменений\n"
-            "• ЖУРНАЛ Д7 → все изменения по коду Д7\n"
-            "• ЖУРНАЛ 3,10 → все изменения за дату\n"
-            "Показывает: объединения, исправления, удаления\n\n"
-            "🔧 ДОПОЛНИТЕЛЬНО:\n"
-            "• ОБНУЛИТЬ → удалить все данные (нужен пин)\n"
-            "• ЗАВЕРШИТЬ → выход (очистка истории)\n\n"
-            "📖 ФОРМАТЫ ДАТ:\n"
-            "• 3,10 = 03.10.2025\n"
-            "• 30,10 = 30.10.2025\n"
-            "• 3,10-5,11 = период с 3.10 по 5.11\n\n"
-            "📝 ФОРМАТЫ ДАННЫХ:\n"
-            "• Д7 Надя 6800 или Д7 Надя-6800\n"
-            "• Юля Д17 1000\n"
-            "• СБ Дмитрий 4000\n"
-            "• Уборщица-2000\n"
-            "• Суммы: 40,000 или 40.000 → 40000 ✅\n\n"
-            "✨ АВТОМАТИЧЕСКАЯ ОЧИСТКА:\n"
-            "• Дубли из Excel очищаются автоматически\n"
-            "• Разделители тысяч (точки/запятые) удаляются\n"
-            "• В предпросмотре видно что было изменено"
-        )
+        await update.message.reply_text(HELP_TEXT)
         return
     
     # Обработка подтверждения объединения дубликатов
@@ -1812,59 +1858,41 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(
                 "❌ Загрузка файла отменена\n\n"
                 "Используйте кнопки меню:",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
             return
         elif text_lower.startswith('записать'):
             # Парсим команду
             # Варианты: "записать", "записать 1 2", "записать без 3"
             selected_merges = None  # None = все, [] = без объединений, [1,2] = только указанные
+            match = _SAVE_MERGES_RE.match(text_lower)
+            numbers = [int(part) for part in match.group(2).split() if part.isdecimal()]
             
             if text_lower == 'записать':
                 # Применить все объединения
                 selected_merges = None
-            elif 'без' in text_lower:
+            elif match.group(1):
                 # ЗАПИСАТЬ БЕЗ 1 2 3 - исключить указанные
-                parts = text_lower.replace('записать', '').replace('без', '').strip().split()
-                excluded = []
-                for part in parts:
-                    try:
-                        excluded.append(int(part))
-                    except ValueError:
-                        pass
-                
+                excluded = set(numbers)
                 if excluded:
                     # Получаем все ID объединений
                     data = state.upload_file_data
                     beznal_analysis = data.get('beznal_analysis', {})
                     nal_analysis = data.get('nal_analysis', {})
                     
-                    all_merge_ids = []
-                    for merge in beznal_analysis.get('merges', []):
-                        if 'merge_id' in merge:
-                            all_merge_ids.append(merge['merge_id'])
-                    for merge in nal_analysis.get('merges', []):
-                        if 'merge_id' in merge:
-                            all_merge_ids.append(merge['merge_id'])
+                    all_merge_ids = [
+                        merge['merge_id']
+                        for merge in chain(beznal_analysis.get('merges', ()), nal_analysis.get('merges', ()))
+                        if 'merge_id' in merge
+                    ]
                     
                     # Все кроме исключенных
                     selected_merges = [mid for mid in all_merge_ids if mid not in excluded]
                 else:
                     selected_merges = None  # Нет исключений - все
             else:
-                # ЗАПИСАТЬ 1 2 3 - только указанные
-                parts = text_lower.replace('записать', '').strip().split()
-                selected = []
-                for part in parts:
-                    try:
-                        selected.append(int(part))
-                    except ValueError:
-                        pass
-                
-                if selected:
-                    selected_merges = selected
-                else:
-                    selected_merges = None  # Не смогли распарсить - применяем все
+                # ЗАПИСАТЬ 1 2 3 - только указанные (не смогли распарсить - применяем все)
+                selected_merges = numbers or None
             
             # Сохраняем выбор и сохраняем данные
             state.upload_file_data['selected_merges'] = selected_merges
@@ -1882,163 +1910,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Обработка подтверждения сохранения ЗП
     
-    # Команда "нал"
-    if text_lower == 'нал':
-        if not state.club:
-            await update.message.reply_text(
-                "❌ Клуб не выбран.\n"
-                "Используйте: старт москвич или старт анора"
-            )
-        else:
-            state.mode = 'нал'
-            await update.message.reply_text(
-                f"📥 РЕЖИМ ВВОДА: НАЛ\n\n"
-                f"🏢 Клуб: {state.club}\n\n"
-                f"📝 Вставьте список данных:\n"
-                f"Примеры форматов:\n"
-                f"  • Д7 Юля 1000\n"
-                f"  • Д7 Юля-1000\n"
-                f"  • Юля Д7 1000\n\n"
-                f"⏭️ После ввода всех данных (НАЛ и БЕЗНАЛ)\n"
-                f"   нажмите: ГОТОВО"
-            )
-        return
-    
-    # Команда "безнал"
-    if text_lower == 'безнал':
-        if not state.club:
-            await update.message.reply_text(
-                "❌ Клуб не выбран.\n"
-                "Используйте: старт москвич или старт анора"
-            )
-        else:
-            state.mode = 'безнал'
-            await update.message.reply_text(
-                f"📥 РЕЖИМ ВВОДА: БЕЗНАЛ\n\n"
-                f"🏢 Клуб: {state.club}\n\n"
-                f"📝 Вставьте список данных:\n"
-                f"Примеры форматов:\n"
-                f"  • Д7 Юля 1000\n"
-                f"  • Д7 Юля-1000\n"
-                f"  • Юля Д7 1000\n\n"
-                f"⏭️ После ввода всех данных (НАЛ и БЕЗНАЛ)\n"
-                f"   нажмите: ГОТОВО"
-            )
-        return
-    
-    # Команда "загрузить файл"
-    if text_lower == 'загрузить файл':
-        if state.has_data():
-            await update.message.reply_text(
-                "⚠️ У вас есть несохранённые данные!\n"
-                "Завершите ввод командой: готово\n"
-                "Или отмените: отмена"
-            )
-            return
-        
-        await update.message.reply_text(
-            "📎 ЗАГРУЗКА EXCEL ФАЙЛА\n\n"
-            "Выберите клуб:",
-            reply_markup=get_club_keyboard()
-        )
-        state.mode = 'awaiting_upload_club'
-        return
-    
-    # Команда "загрузить зп"
-    if text_lower == 'загрузить зп' or text_lower == '💰 загрузить зп':
-        if state.has_data():
-            await update.message.reply_text(
-                "⚠️ У вас есть несохранённые данные!\n"
-                "Завершите ввод командой: готово\n"
-                "Или отмените: отмена"
-            )
-            return
-        
-        await update.message.reply_text(
-            "💰 ЗАГРУЗКА ЛИСТА ВЫПЛАТ\n\n"
-            "Выберите клуб:",
-            reply_markup=get_club_keyboard()
-        )
-        state.mode = 'awaiting_payments_upload_club'
-        return
-    
-    # Обработка ввода периода для расходов на стилистов
-    if state.mode == 'awaiting_stylist_period':
-        # Парсим период
-        if '-' in text:
-            success, date_from, date_to, error = parse_date_range(text)
-            if not success:
-                await update.message.reply_text(f"❌ {error}\n\n❌ Для отмены напишите: ОТМЕНА")
-                return
-        else:
-            success, single_date, error = parse_short_date(text)
-            if not success:
-                await update.message.reply_text(f"❌ {error}\n\n❌ Для отмены напишите: ОТМЕНА")
-                return
-            date_from = single_date
-            date_to = single_date
-        
-        # Сохраняем период
-        state.stylist_period_from = date_from
-        state.stylist_period_to = date_to
-        state.stylist_expenses = []  # Инициализируем пустой список
-        state.stylist_errors = []
-        state.mode = 'awaiting_stylist_data'
-        
-        # Создаем inline кнопку ГОТОВО
-        keyboard = [[InlineKeyboardButton("✅ ГОТОВО", callback_data='stylist_done')]]
-        
-        await update.message.reply_text(
-            f"✅ ПЕРИОД: {date_from} - {date_to}\n\n"
-            f"💄 Отправьте данные о расходах.\n\n"
-            f"Формат:\n"
-            f"Д14Бритни 2000\n"
-            f"А13Варя 1500\n"
-            f"Н3Влада 2500\n\n"
-            f"📝 Можете отправлять НЕСКОЛЬКО сообщений.\n"
-            f"После завершения нажмите: ГОТОВО",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-    
-    # Обработка ввода данных стилистов (накопление из нескольких сообщений)
-    if state.mode == 'awaiting_stylist_data':
-        await handle_stylist_data_input(update, state, text, text_lower)
-        return
-    
-    # Обработка подтверждения сохранения расходов на стилистов
-    if state.mode == 'awaiting_stylist_confirm':
-        await handle_stylist_confirm(update, state, text_lower)
-        return
-    
-    # Обработка ввода номера для редактирования расхода на стилиста
-    if state.mode == 'awaiting_stylist_edit_number':
-        await handle_stylist_edit_number(update, state, text)
-        return
-    
-    # Обработка ввода новых данных для расхода на стилиста
-    if state.mode == 'awaiting_stylist_edit_data':
-        await handle_stylist_edit_data(update, state, text)
+    # Команды, перебивающие режимы ввода ниже (нал/безнал/загрузить...)
+    handler = COMMAND_HANDLERS.get(text_lower)
+    if handler:
+        await handler(update, context, state, text, text_lower)
         return
     
-    # Обработка уточнений для расходов на стилистов (выбор имени)
-    if state.mode == 'awaiting_stylist_clarification':
-        await handle_stylist_clarification(update, state, text)
-        return
-    
-    # Обработка удаления записей стилистов при просмотре
-    if state.mode == 'awaiting_stylist_view_delete':
-        await handle_stylist_view_delete(update, state, text)
-        return
-    
-    # Обработка редактирования записей стилистов при просмотре
-    if state.mode == 'awaiting_stylist_view_edit':
-        await handle_stylist_view_edit_number(update, state, text)
-        return
-    
-    # Обработка ввода новых данных при редактировании
-    if state.mode == 'awaiting_stylist_view_edit_data':
-        await handle_stylist_view_edit_data(update, state, text)
+    # Режимы ввода стилистов - после общих команд (нал/безнал/загрузить...)
+    handler = STYLIST_MODE_HANDLERS.get(state.mode)
+    if handler:
+        await handler(update, context, state, text, text_lower)
         return
     
     # Команда "готово"
@@ -2061,10 +1942,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state.mode in ['нал', 'безнал']:
         # Проверяем - это команда или кнопка?
         # Если текст начинается с emoji кнопок или это известная команда - НЕ парсим как данные
-        emoji_buttons = ['📥', '✅', '❌', '📊', '💰', '📋', '📤', '✏️', '🗑️', '❓', '🚪']
-        is_button = any(text.startswith(emoji) for emoji in emoji_buttons)
+        is_button = text.startswith(EMOJI_BUTTON_PREFIXES)
         
-        if is_button or text_lower in ['отмена', 'готово', 'отчет', 'список', 'экспорт', 'помощь']:
+        if is_button or text_lower in DATA_INPUT_COMMANDS:
             # Это команда/кнопка - НЕ парсим как данные, пропускаем дальше
             pass
         else:
@@ -2090,7 +1970,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text_lower == 'отчет':
         await update.message.reply_text(
             "Выберите клуб:",
-            reply_markup=get_club_report_keyboard()
+            reply_markup=CLUB_REPORT_KEYBOARD
         )
         state.mode = 'awaiting_report_club'
         return
@@ -2146,6 +2026,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Инициализируем отслеживание обработанных клубов
             state.processed_clubs_for_report = set()
             
+            # Операции обоих клубов - одним запросом, отчёты ниже берут их из кэша
+            operations_by_club = await asyncio.to_thread(
+                db.get_operations_by_period_for_clubs, ['Москвич', 'Анора'], date_from, date_to
+            )
+            state.report_operations_cache = {
+                (club, date_from, date_to): operations
+                for club, operations in operations_by_club.items()
+            }
+            
             # Сохраняем период для дальнейшего использования
             state.pending_report_period = (date_from, date_to)
             
@@ -2165,6 +2054,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 state.mode = None
                 state.report_club = None
                 state.pending_report_period = None
+                state.report_operations_cache = {}
         else:
             club = 'Москвич' if state.report_club == 'москвич' else 'Анора'
             await generate_and_send_report(update, club, date_from, date_to, state)
@@ -2227,9 +2117,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Обработка ввода для выплат (после кнопки)
     if state.mode == 'awaiting_payments_input':
         await handle_payments_command(update, context, state, text)
-        # Для ограниченного доступа НЕ сбрасываем режим - оставляем в цикле
-        if not state.limited_access:
-            state.mode = None
+        state.mode = None
         return
     
     # Команда "список"
@@ -2237,7 +2125,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if text_lower == 'список':
             await update.message.reply_text(
                 "📋 Выберите клуб для просмотра записей:",
-                reply_markup=get_club_report_keyboard()
+                reply_markup=CLUB_REPORT_KEYBOARD
             )
             state.mode = 'awaiting_list_club'
         else:
@@ -2317,7 +2205,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "• удалить Д1 30,10\n\n"
                 "Массовое удаление:\n"
                 "• удалить все"
-            , reply_markup=get_delete_mode_keyboard())
+            , reply_markup=DELETE_MODE_KEYBOARD)
         else:
             await handle_delete_command_new(update, context, state, text)
         return
@@ -2332,93 +2220,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_journal_command(update, context, state, text)
         return
     
-    # Команда "самозанятые"
-    if text_lower in ['самозанятые', '👔 самозанятые']:
-        await handle_self_employed_command(update, context, state)
-        return
-    
-    # Команда "сотрудники"
-    if text_lower in ['сотрудники', '👥 сотрудники']:
-        await update.message.reply_text(
-            "👥 УПРАВЛЕНИЕ СОТРУДНИКАМИ\n\n"
-            "Выберите действие:",
-            reply_markup=get_employees_menu_keyboard()
-        )
-        return
-    
-    # Команда "стилисты"
-    if text_lower in ['стилисты', '💄 стилисты']:
-        print(f"DEBUG: Обработка команды СТИЛИСТЫ")
-        keyboard = [
-            [InlineKeyboardButton("💄 Загрузить расходы", callback_data='stylist_load')],
-            [InlineKeyboardButton("📋 Показать расходы", callback_data='stylist_view')]
-        ]
-        await update.message.reply_text(
-            "💄 УПРАВЛЕНИЕ РАСХОДАМИ НА СТИЛИСТОВ\n\n"
-            "Выберите действие:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-    
-    # Команда "ВЛАДЕЛЬЦЫ" (только для админов)
-    if text_lower in ['владельцы', '👔 владельцы']:
-        if not db.is_admin(user_id):
-            await update.message.reply_text("🔒 Доступ запрещён. Только для админов.")
-            return
-        
-        owners = db.get_all_owners()
-        
-        if not owners:
-            # Нет владельцев - показываем только кнопку добавления
-            keyboard = [[InlineKeyboardButton("➕ Добавить владельца", callback_data="owner_add")]]
-            await update.message.reply_text(
-                "👔 УПРАВЛЕНИЕ ВЛАДЕЛЬЦАМИ\n\n"
-                "❌ Владельцы не найдены.\n\n"
-                "Нажмите кнопку ниже для добавления:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            return
-        
-        # Показать список владельцев с кнопками управления
-        keyboard = []
-        owners_text_lines = []
-        
-        for owner in owners:
-            status = "✅" if owner['is_active'] else "❌"
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{status} {owner['telegram_user_id']}", 
-                    callback_data=f"owner_view_{owner['telegram_user_id']}"
-                )
-            ])
-            owners_text_lines.append(
-                f"{status} {owner['telegram_user_id']} (добавлен: {owner['created_at'][:10]})"
-            )
-        
-        keyboard.append([InlineKeyboardButton("➕ Добавить владельца", callback_data="owner_add")])
-        
-        await update.message.reply_text(
-            f"👔 УПРАВЛЕНИЕ ВЛАДЕЛЬЦАМИ\n\n" + "\n".join(owners_text_lines),
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
-    
-    # Команда "ИТОГОВЫЕ ОТЧЁТЫ" (для админов и владельцев)
-    if text_lower in ['итоговые отчёты', '📈 итоговые отчёты', 'итоговые отчеты', '📈 итоговые отчеты']:
-        if not db.is_admin(user_id) and not state.owner_mode:
-            await update.message.reply_text("❌ Доступно только для администраторов и владельцев")
-            return
-        
-        # Показываем выбор клуба
-        keyboard = [
-            [InlineKeyboardButton("🏢 Москвич", callback_data="final_club_select_Москвич")],
-            [InlineKeyboardButton("🏢 Анора", callback_data="final_club_select_Анора")]
-        ]
-        await update.message.reply_text(
-            "📈 ИТОГОВЫЕ ОТЧЁТЫ\n\n"
-            "Выберите клуб:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    # Команды меню (самозанятые, сотрудники, стилисты, владельцы, итоговые отчёты)
+    handler = MENU_COMMAND_HANDLERS.get(text_lower)
+    if handler:
+        await handler(update, context, state, text, text_lower)
         return
     
     # Обработка режима добавления самозанятого
@@ -2882,7 +2687,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime
         cursor.execute("""
             UPDATE employees
             SET full_name = ?, updated_at = ?
@@ -2891,6 +2695,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         await update.message.reply_text(
             f"✅ ИМЯ ИЗМЕНЕНО\n\n"
@@ -2917,7 +2722,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime
         cursor.execute("""
             UPDATE employees
             SET phone = ?, updated_at = ?
@@ -2926,6 +2730,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         await update.message.reply_text(
             f"✅ ТЕЛЕФОН {action.upper()}\n\n"
@@ -2971,7 +2776,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cursor = conn.cursor()
             print("DEBUG: Подключение к БД установлено")
             
-            from datetime import datetime
             update_data = (new_tg, datetime.now().isoformat(), emp['code'], state.edit_employees_club)
             print(f"DEBUG: Параметры UPDATE: {update_data}")
             
@@ -2989,6 +2793,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             print("DEBUG: Закрываем соединение")
             conn.close()
+            db.invalidate_identity_cache()
             print("DEBUG: Соединение закрыто")
             
             print("DEBUG: Отправляем ответ пользователю")
@@ -3028,7 +2833,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             # Парсим дату
             try:
-                from datetime import datetime
                 birth_date = datetime.strptime(text.strip(), '%d.%m.%Y')
                 new_birth = birth_date.strftime('%Y-%m-%d')
                 action = "изменена"
@@ -3044,7 +2848,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime
         cursor.execute("""
             UPDATE employees
             SET birth_date = ?, updated_at = ?
@@ -3053,6 +2856,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         display_birth = datetime.strptime(new_birth, '%Y-%m-%d').strftime('%d.%m.%Y') if new_birth else 'удалена'
         
@@ -3093,7 +2897,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         old_code = emp['code']
         
-        from datetime import datetime
         now = datetime.now().isoformat()
         
         # Обновляем в employees
@@ -3132,6 +2935,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         await update.message.reply_text(
             f"✅ КОД ИЗМЕНЁН\n\n"
@@ -3161,7 +2965,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Парсим дату найма
         if len(parts) > 2:
             try:
-                from datetime import datetime
                 hired = datetime.strptime(parts[2], '%d.%m.%Y').strftime('%Y-%m-%d')
             except:
                 await update.message.reply_text(
@@ -3170,7 +2973,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
         else:
-            from datetime import datetime
             hired = datetime.now().strftime('%Y-%m-%d')
         
         # Проверяем существование
@@ -3190,7 +2992,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Добавляем
-        from datetime import datetime
         now = datetime.now().isoformat()
         
         cursor.execute("""
@@ -3201,6 +3002,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         await update.message.reply_text(
             f"✅ СОТРУДНИК ДОБАВЛЕН\n\n"
@@ -3304,7 +3106,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text_lower == 'экспорт':
         await update.message.reply_text(
             "Выберите клуб для экспорта:",
-            reply_markup=get_club_report_keyboard()  # Используем ту же клавиатуру
+            reply_markup=CLUB_REPORT_KEYBOARD  # Используем ту же клавиатуру
         )
         state.mode = 'awaiting_export_club'
         return
@@ -3359,6 +3161,264 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 
+async def handle_cash_mode_command(update: Update, state: UserState, mode: str):
+    """Команды НАЛ / БЕЗНАЛ - включение режима ввода данных"""
+    if not state.club:
+        await update.message.reply_text(
+            "❌ Клуб не выбран.\n"
+            "Используйте: старт москвич или старт анора"
+        )
+        return
+    
+    state.mode = mode
+    await update.message.reply_text(CASH_MODE_PROMPT.format(mode=mode.upper(), club=state.club))
+
+
+async def handle_upload_start_command(update: Update, state: UserState, mode: str, title: str):
+    """Команды ЗАГРУЗИТЬ ФАЙЛ / ЗАГРУЗИТЬ ЗП - выбор клуба для загрузки"""
+    if state.has_data():
+        await update.message.reply_text(
+            "⚠️ У вас есть несохранённые данные!\n"
+            "Завершите ввод командой: готово\n"
+            "Или отмените: отмена"
+        )
+        return
+    
+    await update.message.reply_text(
+        f"{title}\n\n"
+        "Выберите клуб:",
+        reply_markup=CLUB_KEYBOARD
+    )
+    state.mode = mode
+
+
+async def handle_employees_menu_command(update: Update):
+    """Команда СОТРУДНИКИ"""
+    await update.message.reply_text(
+        "👥 УПРАВЛЕНИЕ СОТРУДНИКАМИ\n\n"
+        "Выберите действие:",
+        reply_markup=EMPLOYEES_MENU_KEYBOARD
+    )
+
+
+async def handle_stylists_menu_command(update: Update):
+    """Команда СТИЛИСТЫ"""
+    print(f"DEBUG: Обработка команды СТИЛИСТЫ")
+    keyboard = [
+        [InlineKeyboardButton("💄 Загрузить расходы", callback_data='stylist_load')],
+        [InlineKeyboardButton("📋 Показать расходы", callback_data='stylist_view')]
+    ]
+    await update.message.reply_text(
+        "💄 УПРАВЛЕНИЕ РАСХОДАМИ НА СТИЛИСТОВ\n\n"
+        "Выберите действие:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def handle_owners_command(update: Update):
+    """Команда ВЛАДЕЛЬЦЫ (только для админов)"""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("🔒 Доступ запрещён. Только для админов.")
+        return
+    
+    owners = db.get_all_owners()
+    
+    if not owners:
+        # Нет владельцев - показываем только кнопку добавления
+        keyboard = [[InlineKeyboardButton("➕ Добавить владельца", callback_data="owner_add")]]
+        await update.message.reply_text(
+            "👔 УПРАВЛЕНИЕ ВЛАДЕЛЬЦАМИ\n\n"
+            "❌ Владельцы не найдены.\n\n"
+            "Нажмите кнопку ниже для добавления:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    
+    # Показать список владельцев с кнопками управления
+    keyboard = []
+    owners_text_lines = []
+    
+    for owner in owners:
+        status = "✅" if owner['is_active'] else "❌"
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{status} {owner['telegram_user_id']}", 
+                callback_data=f"owner_view_{owner['telegram_user_id']}"
+            )
+        ])
+        owners_text_lines.append(
+            f"{status} {owner['telegram_user_id']} (добавлен: {owner['created_at'][:10]})"
+        )
+    
+    keyboard.append([InlineKeyboardButton("➕ Добавить владельца", callback_data="owner_add")])
+    
+    await update.message.reply_text(
+        f"👔 УПРАВЛЕНИЕ ВЛАДЕЛЬЦАМИ\n\n" + "\n".join(owners_text_lines),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def handle_final_reports_command(update: Update, state: UserState):
+    """Команда ИТОГОВЫЕ ОТЧЁТЫ (для админов и владельцев)"""
+    if not db.is_admin(update.effective_user.id) and not state.owner_mode:
+        await update.message.reply_text("❌ Доступно только для администраторов и владельцев")
+        return
+    
+    # Показываем выбор клуба
+    keyboard = [
+        [InlineKeyboardButton("🏢 Москвич", callback_data="final_club_select_Москвич")],
+        [InlineKeyboardButton("🏢 Анора", callback_data="final_club_select_Анора")]
+    ]
+    await update.message.reply_text(
+        "📈 ИТОГОВЫЕ ОТЧЁТЫ\n\n"
+        "Выберите клуб:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def handle_upload_date_input(update: Update, state: UserState, text: str, text_lower: str):
+    """Ввод даты для загрузки файла"""
+    success, parsed_date, error = parse_short_date(text)
+    if success:
+        state.upload_file_date = parsed_date
+        await update.message.reply_text(
+            f"📎 ЗАГРУЗКА ФАЙЛА\n"
+            f"🏢 Клуб: {state.upload_file_club}\n"
+            f"📅 Дата: {parsed_date}\n\n"
+            f"📄 Теперь отправьте Excel файл"
+        )
+        state.mode = 'awaiting_upload_file'
+    else:
+        await update.message.reply_text(
+            f"❌ {error}\n\n"
+            f"Введите дату (формат: 30,10 или 28,12,25) или напишите: отмена"
+        )
+
+
+async def handle_payments_upload_club_input(update: Update, state: UserState, text: str, text_lower: str):
+    """Выбор клуба для загрузки ЗП"""
+    club_choice = text_lower
+    if club_choice in ['москвич', 'анора']:
+        state.payments_upload_club = 'Москвич' if club_choice == 'москвич' else 'Анора'
+        await update.message.reply_text(
+            f"💰 ЗАГРУЗКА ЗП\n"
+            f"🏢 Клуб: {state.payments_upload_club}\n\n"
+            f"📅 Введите дату (формат: 30,10 или 28,12,25):"
+        )
+        state.mode = 'awaiting_payments_upload_date'
+    else:
+        await update.message.reply_text("❌ Выберите: москвич или анора")
+
+
+async def handle_payments_upload_date_input(update: Update, state: UserState, text: str, text_lower: str):
+    """Ввод даты для загрузки ЗП"""
+    success, parsed_date, error = parse_short_date(text)
+    if success:
+        state.payments_upload_date = parsed_date
+        await update.message.reply_text(
+            f"💰 ЗАГРУЗКА ЗП\n"
+            f"🏢 Клуб: {state.payments_upload_club}\n"
+            f"📅 Дата: {parsed_date}\n\n"
+            f"📄 Теперь отправьте Excel файл"
+        )
+        state.mode = 'awaiting_payments_upload_file'
+    else:
+        await update.message.reply_text(
+            f"❌ {error}\n\n"
+            f"Введите дату (формат: 30,10 или 28,12,25) или напишите: отмена"
+        )
+
+
+async def handle_preview_date_input(update: Update, state: UserState, text: str, text_lower: str):
+    """Ввод даты для предпросмотра"""
+    # Пытаемся распарсить дату
+    success, parsed_date, error = parse_short_date(text)
+    if success:
+        # Сохраняем дату и показываем финальный предпросмотр
+        state.preview_date = parsed_date
+        await show_data_preview(update, state, show_duplicates=True)
+
+        # Переходим в режим ожидания действия (ЗАПИСАТЬ/ИЗМЕНИТЬ/ОТМЕНА)
+        state.mode = 'awaiting_preview_action'
+        return
+    else:
+        await update.message.reply_text(
+            f"❌ {error}\n\n"
+            f"Введите дату (формат: 30,10 или 28,12,25) или напишите: отмена"
+        )
+
+
+async def handle_stylist_period_input(update: Update, state: UserState, text: str, text_lower: str):
+    """Ввод периода для расходов на стилистов"""
+    # Парсим период
+    if '-' in text:
+        success, date_from, date_to, error = parse_date_range(text)
+        if not success:
+            await update.message.reply_text(f"❌ {error}\n\n❌ Для отмены напишите: ОТМЕНА")
+            return
+    else:
+        success, single_date, error = parse_short_date(text)
+        if not success:
+            await update.message.reply_text(f"❌ {error}\n\n❌ Для отмены напишите: ОТМЕНА")
+            return
+        date_from = single_date
+        date_to = single_date
+
+    # Сохраняем период
+    state.stylist_period_from = date_from
+    state.stylist_period_to = date_to
+    state.stylist_expenses = []  # Инициализируем пустой список
+    state.stylist_errors = []
+    state.mode = 'awaiting_stylist_data'
+
+    # Создаем inline кнопку ГОТОВО
+    keyboard = [[InlineKeyboardButton("✅ ГОТОВО", callback_data='stylist_done')]]
+
+    await update.message.reply_text(
+        f"✅ ПЕРИОД: {date_from} - {date_to}\n\n"
+        f"💄 Отправьте данные о расходах.\n\n"
+        f"Формат:\n"
+        f"Д14Бритни 2000\n"
+        f"А13Варя 1500\n"
+        f"Н3Влада 2500\n\n"
+        f"📝 Можете отправлять НЕСКОЛЬКО сообщений.\n"
+        f"После завершения нажмите: ГОТОВО",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def handle_limited_payments_input(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                        state: UserState, text: str, text_lower: str):
+    """Ввод кода и периода при быстром доступе (режим не сбрасываем - оставляем в цикле)"""
+    await handle_payments_command(update, context, state, text)
+
+
+async def handle_limited_access_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                        state: UserState, text: str, text_lower: str):
+    """
+    Сообщение при ограниченном доступе (код 0001): доступны только выплаты.
+    ОТМЕНА завершает сессию, всё остальное вне LIMITED_ACCESS_HANDLERS запрещено
+    """
+    if text_lower in ('отмена', '❌ отмена'):
+        state.__init__()
+        await update.message.reply_text(
+            "❌ Сессия завершена\n\n"
+            "Для начала работы введите /start"
+        )
+        return
+    
+    handler = LIMITED_ACCESS_HANDLERS.get(state.mode)
+    if handler and text_lower not in RESTRICTED_COMMANDS:
+        await handler(update, context, state, text, text_lower)
+        return
+    
+    await update.message.reply_text(
+        "❌ Доступ запрещён\n\n"
+        "У вас ограниченный доступ.\n"
+        "Доступна только функция 'Выплаты'."
+    )
+
+
 async def handle_save_command(update: Update, context: ContextTypes.DEFAULT_TYPE, state: UserState):
     """Обработка команды дата/записать"""
     if not state.club:
@@ -3391,33 +3451,13 @@ async def handle_save_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     # Записываем в БД
-    saved_count = 0
-    
-    for item in ready_nal:
-        db.add_or_update_operation(
-            club=state.club,
-            date=target_date,
-            code=item['code'],
-            name=item['name'],
-            channel='нал',
-            amount=item['amount'],
-            original_line=item['original_line'],
-            aggregate=True
-        )
-        saved_count += 1
-    
-    for item in ready_beznal:
-        db.add_or_update_operation(
-            club=state.club,
-            date=target_date,
-            code=item['code'],
-            name=item['name'],
-            channel='безнал',
-            amount=item['amount'],
-            original_line=item['original_line'],
-            aggregate=True
-        )
-        saved_count += 1
+    rows = [
+        (state.club, target_date, item['code'], item['name'], channel,
+         item['amount'], item['original_line'])
+        for channel, items in (('нал', ready_nal), ('безнал', ready_beznal))
+        for item in items
+    ]
+    saved_count = await asyncio.to_thread(db.add_or_update_operations_bulk, rows, aggregate=True)
     
     # Очищаем временные данные
     context.user_data['ready_нал'] = []
@@ -3666,7 +3706,7 @@ async def handle_delete_command_new(update: Update, context: ContextTypes.DEFAUL
     if text_lower in ['удалить все', 'удалить всё']:
         await update.message.reply_text(
             "🏢 Выберите клуб для удаления данных:",
-            reply_markup=get_club_report_keyboard()
+            reply_markup=CLUB_REPORT_KEYBOARD
         )
         state.mode = 'awaiting_delete_mass_club'
         return
@@ -3710,7 +3750,7 @@ async def handle_delete_command_new(update: Update, context: ContextTypes.DEFAUL
     
     response.append("\nЧто удалить?")
     
-    await update.message.reply_text('\n'.join(response), reply_markup=get_delete_keyboard())
+    await update.message.reply_text('\n'.join(response), reply_markup=DELETE_KEYBOARD)
     
     # Сохраняем состояние
     state.delete_code = code
@@ -3772,10 +3812,54 @@ async def handle_delete_employee_input(update: Update, context: ContextTypes.DEF
     await handle_delete_command_new(update, context, state, f"удалить {cleaned}")
 
 
+def _channel_totals(operations: list) -> Tuple[float, float]:
+    """Суммы (НАЛ, БЕЗНАЛ) по списку операций за один проход"""
+    total_nal = 0
+    total_beznal = 0
+    for op in operations:
+        channel = op['channel']
+        if channel == 'нал':
+            total_nal += op['amount']
+        elif channel == 'безнал':
+            total_beznal += op['amount']
+    return total_nal, total_beznal
+
+
+def _duplicate_prompt_lines(duplicates: list) -> Iterable[str]:
+    """Строки запроса на объединение записей с одинаковым кодом (с именем и без)"""
+    yield "⚠️ Найдены записи с одинаковым кодом:"
+    yield ""
+    
+    for i, dup in enumerate(duplicates, 1):
+        yield f"{i}. Код: {dup['code']}"
+        
+        # С именем (группируем операции по имени за один проход)
+        ops_by_name = {}
+        for op in dup['with_name']:
+            ops_by_name.setdefault(op['name'], []).append(op)
+        for name, ops in ops_by_name.items():
+            total_nal, total_bez = _channel_totals(ops)
+            yield f"   • {name}: НАЛ {total_nal:.0f}, БЕЗНАЛ {total_bez:.0f}"
+        
+        # Без имени
+        total_nal_no, total_bez_no = _channel_totals(dup['without_name'])
+        yield f"   • (без имени): НАЛ {total_nal_no:.0f}, БЕЗНАЛ {total_bez_no:.0f}"
+        yield ""
+    
+    yield "─" * 35
+    yield ""
+    yield "🔄 ОБЪЕДИНЕНИЕ ДУБЛИКАТОВ:"
+    yield ""
+    yield "• ОК → объединить все"
+    yield "• ОК 1 → объединить только пункт 1"
+    yield "• ОК 1 2 → объединить пункты 1 и 2"
+    yield "• НЕ 1 → НЕ объединять пункт 1 (остальные да)"
+    yield "• НЕ 1 2 → НЕ объединять пункты 1 и 2"
+
+
 def _summarize_operations_for_delete(operations: list) -> Dict:
     """Возвращает агрегаты по списку операций"""
-    total_nal = sum(op['amount'] for op in operations if op['channel'] == 'нал')
-    total_beznal = sum(op['amount'] for op in operations if op['channel'] == 'безнал')
+    total_nal, total_beznal = _channel_totals(operations)
     return {
         'count': len(operations),
         'total_nal': total_nal,
@@ -3791,8 +3875,8 @@ def _format_delete_preview_lines(club_label: str, date_from: str, date_to: str,
     lines.append(f"🏢 {club_label}")
     lines.append(f"📅 Период: {date_from} .. {date_to}")
     lines.append(f"🧾 Записей: {summary['count']}")
-    lines.append(f"💵 НАЛ: {summary['total_nal']:,.0f}".replace(',', ' '))
-    lines.append(f"💳 БЕЗНАЛ: {summary['total_beznal']:,.0f}".replace(',', ' '))
+    lines.append(f"💵 НАЛ: {format_amount(summary['total_nal'])}")
+    lines.append(f"💳 БЕЗНАЛ: {format_amount(summary['total_beznal'])}")
     
     if operations:
         lines.append("Первые записи:")
@@ -3800,7 +3884,7 @@ def _format_delete_preview_lines(club_label: str, date_from: str, date_to: str,
             code = op['code']
             name = op['name'] or "(без имени)"
             channel = op['channel'].upper()
-            amount = f"{op['amount']:,.0f}".replace(',', ' ')
+            amount = format_amount(op['amount'])
             lines.append(f" • {op['date']} | {code} {name} | {channel} {amount}")
         if len(operations) > 5:
             lines.append(f" • ... и ещё {len(operations) - 5} записей")
@@ -3945,7 +4029,7 @@ async def handle_delete_mass_period_input(update: Update, state: UserState,
     
     # Отправляем Excel с деталями
     filename = f"delete_preview_{uuid.uuid4().hex}.xlsx"
-    create_delete_preview_excel(preview_data, filename)
+    await asyncio.to_thread(create_delete_preview_excel, preview_data, filename)
     with open(filename, 'rb') as f:
         await update.message.reply_document(
             document=f,
@@ -3956,7 +4040,7 @@ async def handle_delete_mass_period_input(update: Update, state: UserState,
     
     await update.message.reply_text(
         "❗ Подтвердите удаление всех записей за этот период.",
-        reply_markup=get_delete_mass_confirm_keyboard()
+        reply_markup=DELETE_MASS_CONFIRM_KEYBOARD
     )
     state.mode = 'awaiting_delete_mass_confirm'
 
@@ -4006,8 +4090,8 @@ async def handle_delete_mass_confirm_message(message, state: UserState, confirme
                 lines.append(f"🏢 {item['club']}")
                 lines.append(f"Удалено записей: {item['deleted']}")
                 if summary:
-                    lines.append(f"НАЛ: {summary['total_nal']:,.0f}".replace(',', ' '))
-                    lines.append(f"БЕЗНАЛ: {summary['total_beznal']:,.0f}".replace(',', ' '))
+                    lines.append(f"НАЛ: {format_amount(summary['total_nal'])}")
+                    lines.append(f"БЕЗНАЛ: {format_amount(summary['total_beznal'])}")
                 lines.append("")
             lines.append("📜 История доступна в ЖУРНАЛ.")
         
@@ -4079,13 +4163,16 @@ async def export_report(update: Update, club: str, date_from: str, date_to: str)
     # Создаем XLSX
     club_translit = 'moskvich' if club == 'Москвич' else 'anora'
     filename = f"otchet_{club_translit}_{date_from}_{date_to}.xlsx"
+    # На диске - уникальное имя: одинаковые выгрузки разных пользователей не пересекаются
+    filepath = f"{uuid.uuid4().hex}_{filename}"
     
-    ReportGenerator.generate_xlsx(
-        report_rows, totals, club, f"{date_from} .. {date_to}", filename, db
+    await asyncio.to_thread(
+        ReportGenerator.generate_xlsx,
+        report_rows, totals, club, f"{date_from} .. {date_to}", filepath, db
     )
     
     # Отправляем файл
-    with open(filename, 'rb') as f:
+    with open(filepath, 'rb') as f:
         await update.message.reply_document(
             document=f,
             filename=filename,
@@ -4093,14 +4180,14 @@ async def export_report(update: Update, club: str, date_from: str, date_to: str)
         )
     
     # Удаляем временный файл
-    os.remove(filename)
+    os.remove(filepath)
 
 
 async def prepare_merged_report(update: Update, state: UserState, date_from: str, date_to: str):
     """Подготовка сводного отчета с проверкой совпадений"""
     # Получаем данные по обоим клубам
-    ops_moskvich = db.get_operations_by_period('Москвич', date_from, date_to)
-    ops_anora = db.get_operations_by_period('Анора', date_from, date_to)
+    ops_moskvich = get_report_operations(state, 'Москвич', date_from, date_to)
+    ops_anora = get_report_operations(state, 'Анора', date_from, date_to)
     
     # Группируем по сотрудникам (код)
     from collections import defaultdict
@@ -4199,7 +4286,7 @@ async def prepare_merged_report(update: Update, state: UserState, date_from: str
                 has_matching_surname = False
                 for s_m in surnames_m:
                     for s_a in surnames_a:
-                        surname_similarity = SequenceMatcher(None, s_m, s_a).ratio()
+                        surname_similarity = fuzz.ratio(s_m, s_a) / 100
                         if surname_similarity >= 0.90:
                             has_matching_surname = True
                             break
@@ -4252,15 +4339,17 @@ async def prepare_merged_report(update: Update, state: UserState, date_from: str
             
             # Экспорт
             filename = f"otchet_svodny_{date_from}_{date_to}.xlsx"
-            ReportGenerator.generate_xlsx(
-                report_rows, totals, "СВОДНЫЙ (Москвич + Анора)", f"{date_from} .. {date_to}", filename, db
+            filepath = f"{uuid.uuid4().hex}_{filename}"
+            await asyncio.to_thread(
+                ReportGenerator.generate_xlsx,
+                report_rows, totals, "СВОДНЫЙ (Москвич + Анора)", f"{date_from} .. {date_to}", filepath, db
             )
-            with open(filename, 'rb') as f:
-                await msg.reply_document(
-                    document=f, filename=filename,
-                    caption=f"📊 СВОДНЫЙ ОТЧЁТ (Оба клуба)\nПериод: {date_from} .. {date_to}"
-                )
-            os.remove(filename)
+            await reply_document_from_disk(
+                msg, filepath,
+                filename=filename,
+                caption=f"📊 СВОДНЫЙ ОТЧЁТ (Оба клуба)\nПериод: {date_from} .. {date_to}"
+            )
+            os.remove(filepath)
         
         state.mode = None
         state.report_club = None
@@ -4324,13 +4413,12 @@ async def prepare_merged_report(update: Update, state: UserState, date_from: str
     # Определяем куда отправлять (может быть callback query или обычное сообщение)
     msg = update.message if update.message else (update.callback_query.message if update.callback_query else None)
     
-    with open(temp_file.name, 'rb') as f:
-        await msg.reply_document(
-            document=f,
-            filename=f"sovpadeniya_{date_from}_{date_to}.txt",
-            caption=short_message,
-            reply_markup=get_merge_confirmation_keyboard()
-        )
+    await reply_document_from_disk(
+        msg, temp_file.name,
+        filename=f"sovpadeniya_{date_from}_{date_to}.txt",
+        caption=short_message,
+        reply_markup=MERGE_CONFIRM_KEYBOARD
+    )
     
     # Удаляем временный файл
     os.remove(temp_file.name)
@@ -4433,8 +4521,8 @@ async def generate_merged_report(update: Update, state: UserState, excluded_regu
         date_from, date_to = state.merge_period
         
         # Получаем ВСЕ данные обоих клубов
-        ops_m = db.get_operations_by_period('Москвич', date_from, date_to)
-        ops_a = db.get_operations_by_period('Анора', date_from, date_to)
+        ops_m = get_report_operations(state, 'Москвич', date_from, date_to)
+        ops_a = get_report_operations(state, 'Анора', date_from, date_to)
     except Exception as e:
         await msg.reply_text(f"❌ Ошибка получения данных: {str(e)}")
         return
@@ -4706,20 +4794,22 @@ async def generate_merged_report(update: Update, state: UserState, excluded_regu
         # Экспорт сводного с тремя листами
         try:
             filename = f"otchet_svodny_{date_from}_{date_to}.xlsx"
-            ReportGenerator.generate_merged_xlsx(
+            filepath = f"{uuid.uuid4().hex}_{filename}"
+            await asyncio.to_thread(
+                ReportGenerator.generate_merged_xlsx,
                 report_moskvich=(report_rows_m, totals_m),
                 report_anora=(report_rows_a, totals_a),
                 report_merged=(report_rows_merged, totals_merged),
                 period=f"{date_from} .. {date_to}",
-                filename=filename,
+                filename=filepath,
                 db=db
             )
-            with open(filename, 'rb') as f:
-                await msg.reply_document(
-                    document=f, filename=filename,
-                    caption=f"📊 СВОДНЫЙ ОТЧЁТ (Оба клуба)\nПериод: {date_from} .. {date_to}\n\n📄 Файл содержит 3 листа:\n• Москвич\n• Анора\n• Сводный"
-                )
-            os.remove(filename)
+            await reply_document_from_disk(
+                msg, filepath,
+                filename=filename,
+                caption=f"📊 СВОДНЫЙ ОТЧЁТ (Оба клуба)\nПериод: {date_from} .. {date_to}\n\n📄 Файл содержит 3 листа:\n• Москвич\n• Анора\n• Сводный"
+            )
+            os.remove(filepath)
         except Exception as e:
             await msg.reply_text(f"⚠️ Ошибка создания Excel: {str(e)}")
     else:
@@ -4741,7 +4831,11 @@ def find_code_duplicates(operations: list) -> list:
         else:
             by_code[code]['without_name'].append(op)
     
-    # Ищем коды где есть И с именем И без имени
+    return collect_code_duplicates(by_code)
+
+
+def collect_code_duplicates(by_code: dict) -> list:
+    """Выбор кодов, у которых есть записи И с именем И без имени"""
     duplicates = []
     for code, data in by_code.items():
         if data['with_name'] and data['without_name']:
@@ -4774,7 +4868,7 @@ def name_similarity(name1: str, name2: str) -> float:
     
     # Если одно из имен содержит только одно слово - обычное сравнение
     if len(parts1) == 1 or len(parts2) == 1:
-        return SequenceMatcher(None, name1_clean, name2_clean).ratio()
+        return fuzz.ratio(name1_clean, name2_clean) / 100
     
     # Извлекаем фамилию (последнее слово) и имя (остальное)
     surname1 = parts1[-1]
@@ -4818,10 +4912,10 @@ def name_similarity(name1: str, name2: str) -> float:
     firstname2_normalized = name_abbreviations.get(firstname2.lower(), firstname2.lower())
     
     # Сравниваем фамилии
-    surname_similarity = SequenceMatcher(None, surname1, surname2).ratio()
+    surname_similarity = fuzz.ratio(surname1, surname2) / 100
     
     # Сравниваем имена (с учетом нормализации)
-    firstname_similarity = SequenceMatcher(None, firstname1_normalized, firstname2_normalized).ratio()
+    firstname_similarity = fuzz.ratio(firstname1_normalized, firstname2_normalized) / 100
     
     # Взвешенная сумма: фамилия 70%, имя 30%
     weighted_similarity = surname_similarity * 0.7 + firstname_similarity * 0.3
@@ -4930,6 +5024,32 @@ def extract_surname_candidates(name: str) -> set:
     return surnames
 
 
+def _aggregate_by_name(operations: list) -> Dict[str, Dict[str, float]]:
+    """Суммы НАЛ/БЕЗНАЛ по каждому имени в группе операций"""
+    by_name = {}
+    for op in operations:
+        totals = by_name.setdefault(op['name'], {'nal': 0, 'beznal': 0})
+        if op['channel'] == 'нал':
+            totals['nal'] += op['amount']
+        else:
+            totals['beznal'] += op['amount']
+    return by_name
+
+
+def find_similar_surname_pairs(surnames: List[str], min_score: float = 90) -> List[Tuple[int, int]]:
+    """
+    Поиск пар похожих фамилий (fuzz.ratio >= min_score), возвращает пары индексов (i < j)
+    Вся матрица считается в rapidfuzz; пары ниже порога отсекаются внутри по score_cutoff
+    """
+    if len(surnames) < 2:
+        return []
+    
+    scores = rapidfuzz_process.cdist(
+        surnames, surnames,
+        scorer=fuzz.ratio, score_cutoff=min_score, workers=-1
+    )
+    return [(i, j) for i, j in zip(*scores.nonzero()) if i < j]
+
 def find_sb_name_duplicates(operations: list, similarity_threshold: float = 0.75) -> list:
     """
     Поиск СБ сотрудников с похожими именами для объединения
@@ -4951,6 +5071,16 @@ def find_sb_name_duplicates(operations: list, similarity_threshold: float = 0.75
         if name:
             by_name[name].append(op)
     
+    return cluster_sb_names(by_name)
+
+
+def cluster_sb_names(by_name: Dict[str, list]) -> list:
+    """
+    Кластеризация СБ по фамилии
+    by_name: операции СБ, сгруппированные по имени {имя: [операции]}
+    """
+    from collections import defaultdict
+    
     names_list = list(by_name.keys())
     
     # ШАГ 1: Строгая кластеризация по фамилии
@@ -4968,27 +5098,23 @@ def find_sb_name_duplicates(operations: list, similarity_threshold: float = 0.75
             parent[px] = py
     
     # Объединяем имена с общей фамилией
-    for i, name1 in enumerate(names_list):
-        surnames1 = extract_surname_candidates(name1)
-        
-        for j, name2 in enumerate(names_list[i+1:], i+1):
-            surnames2 = extract_surname_candidates(name2)
-            
-            # Проверяем: есть ли общая фамилия с похожестью >= 90%
-            has_matching_surname = False
-            
-            for s1 in surnames1:
-                for s2 in surnames2:
-                    # СТРОГОЕ сравнение фамилий
-                    surname_similarity = SequenceMatcher(None, s1, s2).ratio()
-                    if surname_similarity >= 0.90:
-                        has_matching_surname = True
-                        break
-                if has_matching_surname:
-                    break
-            
-            if has_matching_surname:
-                union(name1, name2)
+    # Собираем уникальные варианты фамилий и для каждой - имена, где она встречается
+    names_by_surname = defaultdict(list)
+    for name in names_list:
+        for surname in extract_surname_candidates(name):
+            names_by_surname[surname].append(name)
+    
+    # Имена с одинаковой фамилией объединяем сразу
+    for surname_names in names_by_surname.values():
+        for name in surname_names[1:]:
+            union(surname_names[0], name)
+    
+    # СТРОГОЕ сравнение разных фамилий (похожесть >= 90%)
+    surnames_list = list(names_by_surname.keys())
+    for i, j in find_similar_surname_pairs(surnames_list, min_score=90):
+        group_names = names_by_surname[surnames_list[i]] + names_by_surname[surnames_list[j]]
+        for name in group_names[1:]:
+            union(group_names[0], name)
     
     # Собираем кластеры
     clusters = defaultdict(list)
@@ -5007,8 +5133,7 @@ def find_sb_name_duplicates(operations: list, similarity_threshold: float = 0.75
                 group_operations.extend(by_name[name])
             
             # Вычисляем суммы
-            total_nal = sum(op['amount'] for op in group_operations if op['channel'] == 'нал')
-            total_beznal = sum(op['amount'] for op in group_operations if op['channel'] == 'безнал')
+            total_nal, total_beznal = _channel_totals(group_operations)
             
             # Определяем основное имя (самое полное/длинное)
             main_name = max(cluster_names, key=lambda n: (len(n.split()), len(n)))
@@ -5030,12 +5155,47 @@ def find_sb_name_duplicates(operations: list, similarity_threshold: float = 0.75
                 'operations': group_operations,
                 'total_nal': total_nal,
                 'total_beznal': total_beznal,
-                'similarity': max_similarity if max_similarity > 0 else 1.0
+                'similarity': max_similarity if max_similarity > 0 else 1.0,
+                # Суммы по каждому имени - для списка кандидатов (файл и кнопка "Показать список")
+                'by_name': _aggregate_by_name(group_operations)
             })
     
     return name_groups
 
 
+def find_all_duplicates(operations: list) -> Tuple[list, list]:
+    """
+    Поиск дубликатов кода и СБ с похожими именами за один проход по операциям
+    Возвращает (дубликаты_кода, группы_СБ). Группы СБ ищем только если нет
+    дубликатов кода - их проверяем уже после объединения кодов
+    """
+    from collections import defaultdict
+    
+    by_code = defaultdict(lambda: {'with_name': [], 'without_name': []})
+    sb_by_name = defaultdict(list)
+    
+    for op in operations:
+        code = op['code']
+        name = op['name']
+        if name:
+            by_code[code]['with_name'].append(op)
+            if code == 'СБ':
+                name = name.strip()
+                if name:
+                    sb_by_name[name].append(op)
+        else:
+            by_code[code]['without_name'].append(op)
+    
+    code_duplicates = collect_code_duplicates(by_code)
+    if code_duplicates:
+        return code_duplicates, []
+    
+    if len(sb_by_name) < 2:
+        return [], []
+    
+    return [], cluster_sb_names(sb_by_name)
+
+
 async def handle_duplicate_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE, 
                                        state: UserState, text: str, text_lower: str):
     """Обработка подтверждения объединения дубликатов"""
@@ -5117,7 +5277,9 @@ async def handle_duplicate_confirmation(update: Update, context: ContextTypes.DE
                         updated_count += 1
     
     # Получаем ОБНОВЛЁННЫЕ данные из БД
-    updated_operations = db.get_operations_by_period(data['club'], data['date_from'], data['date_to'])
+    updated_operations = get_report_operations(
+        state, data['club'], data['date_from'], data['date_to'], refresh=True
+    )
     
     # Проверяем СБ с похожими именами после обработки дубликатов кода
     sb_duplicates = find_sb_name_duplicates(updated_operations)
@@ -5149,18 +5311,20 @@ async def handle_duplicate_confirmation(update: Update, context: ContextTypes.DE
     # Создаем XLSX
     club_translit = 'moskvich' if data['club'] == 'Москвич' else 'anora'
     filename = f"otchet_{club_translit}_{data['date_from']}_{data['date_to']}.xlsx"
+    filepath = f"{uuid.uuid4().hex}_{filename}"
     
-    ReportGenerator.generate_xlsx(report_rows, totals, data['club'], 
-                                  f"{data['date_from']} .. {data['date_to']}", filename, db)
+    await asyncio.to_thread(
+        ReportGenerator.generate_xlsx,
+        report_rows, totals, data['club'], f"{data['date_from']} .. {data['date_to']}", filepath, db
+    )
     
-    with open(filename, 'rb') as f:
-        await update.message.reply_document(
-            document=f,
-            filename=filename,
-            caption=f"📊 Отчет {data['club']} ({data['date_from']} .. {data['date_to']})"
-        )
+    await reply_document_from_disk(
+        update.message, filepath,
+        filename=filename,
+        caption=f"📊 Отчет {data['club']} ({data['date_from']} .. {data['date_to']})"
+    )
     
-    os.remove(filename)
+    os.remove(filepath)
     
     # Проверяем, был ли выбран "оба" клуба - если да, продолжаем обработку
     if state.report_club == 'оба':
@@ -5193,6 +5357,7 @@ async def handle_duplicate_confirmation(update: Update, context: ContextTypes.DE
                 state.report_club = None
                 state.processed_clubs_for_report = set()
                 state.pending_report_period = None
+                state.report_operations_cache = {}
     else:
         # Очищаем состояние
         state.mode = None
@@ -5258,29 +5423,25 @@ async def handle_sb_merge_confirmation(update: Update, context: ContextTypes.DEF
         return
     
     # Создаем словарь объединений (ТОЛЬКО для отчета, БД не изменяем!)
-    sb_name_merges = {}
-    merged_sb_count = 0  # Счетчик объединенных СБ
+    # Для всех похожих имен указываем основное имя
+    merged_groups = [sb_duplicates[i] for i in sorted(indices_to_merge) if 0 <= i < len(sb_duplicates)]
+    merged_pairs = [
+        (name, group['main_name'])
+        for group in merged_groups
+        for name in group['names']
+        if name != group['main_name']
+    ]
+    merged_sb_count = len(merged_pairs)  # Счетчик объединенных СБ
     
-    for i, group in enumerate(sb_duplicates):
-        if i in indices_to_merge:
-            main_name = group['main_name']
-            
-            # Для всех похожих имен указываем основное имя
-            for name in group['names']:
-                if name != main_name:
-                    # Нормализуем имена (Ё→Е) для корректного сопоставления
-                    normalized_name = name.replace('ё', 'е').replace('Ё', 'Е')
-                    normalized_main = main_name.replace('ё', 'е').replace('Ё', 'Е')
-                    
-                    # Добавляем оба варианта (с Ё и без) для надёжности
-                    sb_name_merges[name] = main_name
-                    if normalized_name != name:
-                        sb_name_merges[normalized_name] = main_name
-                    
-                    merged_sb_count += 1  # Считаем объединенные имена
+    # Добавляем оба варианта (с Ё и без) для надёжности сопоставления
+    sb_name_merges = {
+        variant: main_name
+        for name, main_name in merged_pairs
+        for variant in (name, name.replace('ё', 'е').replace('Ё', 'Е'))
+    }
     
     # Получаем данные из БД (БЕЗ изменений!)
-    operations = db.get_operations_by_period(data['club'], data['date_from'], data['date_to'])
+    operations = get_report_operations(state, data['club'], data['date_from'], data['date_to'])
     
     # Загружаем расходы на стилистов для этого периода
     stylist_expenses = db.get_stylist_expenses_for_period(data['club'], data['date_from'], data['date_to'])
@@ -5302,13 +5463,15 @@ async def handle_sb_merge_confirmation(update: Update, context: ContextTypes.DEF
     if merged_sb_count > 0:
         summary_lines.append(f"🔄 Объединено СБ имён: {merged_sb_count} (только в отчете)")
     
-    summary_lines.append("\n💰 ИТОГО:")
-    summary_lines.append(f"   НАЛ:      {totals['nal']:,.0f}".replace(',', ' '))
-    summary_lines.append(f"   БЕЗНАЛ:   {totals['beznal']:,.0f}".replace(',', ' '))
-    summary_lines.append(f"   10%:      {totals['minus10']:,.0f}".replace(',', ' '))
-    summary_lines.append(f"   {'─' * 25}")
-    summary_lines.append(f"   ИТОГО:    {totals['itog']:,.0f}".replace(',', ' '))
-    summary_lines.append("\n📄 Детальный отчёт в Excel файле ⬇️")
+    summary_lines += (
+        "\n💰 ИТОГО:",
+        f"   НАЛ:      {format_amount(totals['nal'])}",
+        f"   БЕЗНАЛ:   {format_amount(totals['beznal'])}",
+        f"   10%:      {format_amount(totals['minus10'])}",
+        f"   {'─' * 25}",
+        f"   ИТОГО:    {format_amount(totals['itog'])}",
+        "\n📄 Детальный отчёт в Excel файле ⬇️",
+    )
     
     summary = '\n'.join(summary_lines)
     
@@ -5317,18 +5480,20 @@ async def handle_sb_merge_confirmation(update: Update, context: ContextTypes.DEF
     # Создаем XLSX
     club_translit = 'moskvich' if data['club'] == 'Москвич' else 'anora'
     filename = f"otchet_{club_translit}_{data['date_from']}_{data['date_to']}.xlsx"
+    filepath = f"{uuid.uuid4().hex}_{filename}"
     
-    ReportGenerator.generate_xlsx(report_rows, totals, data['club'], 
-                                  f"{data['date_from']} .. {data['date_to']}", filename, db)
+    await asyncio.to_thread(
+        ReportGenerator.generate_xlsx,
+        report_rows, totals, data['club'], f"{data['date_from']} .. {data['date_to']}", filepath, db
+    )
     
-    with open(filename, 'rb') as f:
-        await msg.reply_document(
-            document=f,
-            filename=filename,
-            caption=f"📊 Отчет {data['club']} ({data['date_from']} .. {data['date_to']})"
-        )
+    await reply_document_from_disk(
+        msg, filepath,
+        filename=filename,
+        caption=f"📊 Отчет {data['club']} ({data['date_from']} .. {data['date_to']})"
+    )
     
-    os.remove(filename)
+    os.remove(filepath)
     
     # СОХРАНЯЕМ словарь объединений СБ в state для сводного отчёта
     if sb_name_merges:
@@ -5373,6 +5538,7 @@ async def handle_sb_merge_confirmation(update: Update, context: ContextTypes.DEF
                 state.report_club = None
                 state.processed_clubs_for_report = set()
                 state.pending_report_period = None
+                state.report_operations_cache = {}
     else:
         # Очищаем состояние
         state.mode = None
@@ -5407,16 +5573,8 @@ async def prepare_sb_merge_internal(msg, state: UserState, club: str, date_from:
         file_content.append(f"{i}. Группа: {group['main_name']}\n")
         file_content.append(f"   Похожесть: {similarity_pct}%\n")
         
-        # Группируем операции по именам для отображения
-        by_name = {}
-        for op in group['operations']:
-            name = op['name']
-            if name not in by_name:
-                by_name[name] = {'nal': 0, 'beznal': 0}
-            if op['channel'] == 'нал':
-                by_name[name]['nal'] += op['amount']
-            else:
-                by_name[name]['beznal'] += op['amount']
+        # Суммы по именам посчитаны при поиске группы
+        by_name = group['by_name']
         
         for name in group['names']:
             if name in by_name:
@@ -5453,13 +5611,12 @@ async def prepare_sb_merge_internal(msg, state: UserState, club: str, date_from:
     )
     
     # Отправляем файл и сообщение с кнопками
-    with open(temp_file.name, 'rb') as f:
-        await msg.reply_document(
-            document=f,
-            filename=f"sb_merge_{club}_{date_from}_{date_to}.txt",
-            caption=short_message,
-            reply_markup=get_merge_confirmation_keyboard()
-        )
+    await reply_document_from_disk(
+        msg, temp_file.name,
+        filename=f"sb_merge_{club}_{date_from}_{date_to}.txt",
+        caption=short_message,
+        reply_markup=MERGE_CONFIRM_KEYBOARD
+    )
     
     # Удаляем временный файл
     os.remove(temp_file.name)
@@ -5475,13 +5632,30 @@ async def prepare_sb_merge_internal(msg, state: UserState, club: str, date_from:
     state.mode = 'awaiting_sb_merge_confirm'
 
 
+def get_report_operations(state: Optional[UserState], club: str, date_from: str, date_to: str,
+                          refresh: bool = False) -> list:
+    """
+    Операции клуба за период для отчёта
+    При отчёте по обоим клубам результат запоминается в state, чтобы отчёт
+    второго клуба и сводный отчёт не читали те же данные из БД повторно
+    refresh: перечитать данные из БД (после изменения записей)
+    """
+    if not state or state.report_club != 'оба':
+        return db.get_operations_by_period(club, date_from, date_to)
+    
+    key = (club, date_from, date_to)
+    if refresh or key not in state.report_operations_cache:
+        state.report_operations_cache[key] = db.get_operations_by_period(club, date_from, date_to)
+    return state.report_operations_cache[key]
+
+
 async def generate_and_send_report(update: Update, club: str, date_from: str, date_to: str, 
                                   state: UserState = None, check_duplicates: bool = True, message=None, sb_name_merges: dict = None):
     """Генерация и отправка отчета"""
     # Определяем куда отправлять сообщения
     msg = message if message else update.message
     
-    operations = db.get_operations_by_period(club, date_from, date_to)
+    operations = await asyncio.to_thread(get_report_operations, state, club, date_from, date_to)
     
     if not operations:
         await msg.reply_text(
@@ -5492,39 +5666,14 @@ async def generate_and_send_report(update: Update, club: str, date_from: str, da
         return
     
     # Проверка на дубликаты (одинаковый код, но с именем и без)
+    # и на СБ с похожими именами - одним проходом по операциям
     if check_duplicates and state:
-        duplicates = find_code_duplicates(operations)
+        duplicates, sb_duplicates = find_all_duplicates(operations)
         
         if duplicates:
-            # Показываем запрос на объединение
-            response = [f"⚠️ Найдены записи с одинаковым кодом:\n"]
-            
-            for i, dup in enumerate(duplicates, 1):
-                response.append(f"{i}. Код: {dup['code']}")
-                
-                # С именем
-                names_with = set(op['name'] for op in dup['with_name'])
-                for name in names_with:
-                    ops = [op for op in dup['with_name'] if op['name'] == name]
-                    total_nal = sum(op['amount'] for op in ops if op['channel'] == 'нал')
-                    total_bez = sum(op['amount'] for op in ops if op['channel'] == 'безнал')
-                    response.append(f"   • {name}: НАЛ {total_nal:.0f}, БЕЗНАЛ {total_bez:.0f}")
-                
-                # Без имени
-                total_nal_no = sum(op['amount'] for op in dup['without_name'] if op['channel'] == 'нал')
-                total_bez_no = sum(op['amount'] for op in dup['without_name'] if op['channel'] == 'безнал')
-                response.append(f"   • (без имени): НАЛ {total_nal_no:.0f}, БЕЗНАЛ {total_bez_no:.0f}")
-                response.append("")
-            
-            response.append("─" * 35)
-            response.append("\n🔄 ОБЪЕДИНЕНИЕ ДУБЛИКАТОВ:\n")
-            response.append("• ОК → объединить все")
-            response.append("• ОК 1 → объединить только пункт 1")
-            response.append("• ОК 1 2 → объединить пункты 1 и 2")
-            response.append("• НЕ 1 → НЕ объединять пункт 1 (остальные да)")
-            response.append("• НЕ 1 2 → НЕ объединять пункты 1 и 2")
-            
-            await msg.reply_text('\n'.join(response))
+            # Показываем запрос на объединение; длинный - частями по строкам
+            # (одна группа с множеством имён сама может превысить лимит Telegram)
+            await reply_lines_chunked(msg, _duplicate_prompt_lines(duplicates))
             
             # Сохраняем данные для обработки
             state.duplicate_check_data = {
@@ -5537,10 +5686,7 @@ async def generate_and_send_report(update: Update, club: str, date_from: str, da
             state.mode = 'awaiting_duplicate_confirm'
             return
     
-    # Проверка на СБ с похожими именами (после проверки дубликатов кода)
-    if check_duplicates and state:
-        sb_duplicates = find_sb_name_duplicates(operations)
-        
+        # Проверка на СБ с похожими именами (после проверки дубликатов кода)
         if sb_duplicates:
             # Показываем запрос на объединение СБ с инлайн-кнопками и файлом
             await prepare_sb_merge_with_message(msg, state, club, date_from, date_to, operations, sb_duplicates)
@@ -5548,9 +5694,10 @@ async def generate_and_send_report(update: Update, club: str, date_from: str, da
     
     # Генерируем отчет (без дубликатов или после подтверждения)
     # Загружаем расходы на стилистов для этого периода
-    stylist_expenses = db.get_stylist_expenses_for_period(club, date_from, date_to)
+    stylist_expenses = await asyncio.to_thread(db.get_stylist_expenses_for_period, club, date_from, date_to)
     
-    report_rows, totals, totals_recalc, check_ok = ReportGenerator.calculate_report(
+    report_rows, totals, totals_recalc, check_ok = await asyncio.to_thread(
+        ReportGenerator.calculate_report,
         operations,
         sb_name_merges=sb_name_merges if sb_name_merges else None,
         stylist_expenses=stylist_expenses
@@ -5568,21 +5715,22 @@ async def generate_and_send_report(update: Update, club: str, date_from: str, da
     # Создаем XLSX
     club_translit = 'moskvich' if club == 'Москвич' else 'anora'
     filename = f"otchet_{club_translit}_{date_from}_{date_to}.xlsx"
+    filepath = f"{uuid.uuid4().hex}_{filename}"
     
-    ReportGenerator.generate_xlsx(
-        report_rows, totals, club, f"{date_from} .. {date_to}", filename, db
+    await asyncio.to_thread(
+        ReportGenerator.generate_xlsx,
+        report_rows, totals, club, f"{date_from} .. {date_to}", filepath, db
     )
     
     # Отправляем файл
-    with open(filename, 'rb') as f:
-        await msg.reply_document(
-            document=f,
-            filename=filename,
-            caption=f"📊 Отчет по клубу {club}\nПериод: {date_from} .. {date_to}"
-        )
+    await reply_document_from_disk(
+        msg, filepath,
+        filename=filename,
+        caption=f"📊 Отчет по клубу {club}\nПериод: {date_from} .. {date_to}"
+    )
     
     # Удаляем временный файл
-    os.remove(filename)
+    os.remove(filepath)
     
     # Если это часть обработки "оба" клуба - отмечаем клуб как обработанный
     if state and state.report_club == 'оба':
@@ -5633,7 +5781,7 @@ async def handle_payments_command(update: Update, context: ContextTypes.DEFAULT_
         date_to = single_date
     
     # Получаем выплаты ПО ВСЕМ КЛУБАМ
-    payments = db.get_employee_payments(code, date_from, date_to, None)
+    payments = await asyncio.to_thread(db.get_employee_payments, code, date_from, date_to, None)
     
     if not payments:
         await update.message.reply_text(
@@ -5660,182 +5808,188 @@ async def handle_payments_command(update: Update, context: ContextTypes.DEFAULT_
             by_club[club]['by_date'][date]['beznal'] += amount
             by_club[club]['beznal'] += amount
     
-    # Создаем Excel файл
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Выплаты"
-    
-    # Стили
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=11)
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Заголовок
-    ws['A1'] = f"Выплаты сотруднику {code}"
-    ws['A1'].font = Font(bold=True, size=14)
-    ws['A2'] = f"Период: {date_from} .. {date_to}"
-    ws['A2'].font = Font(size=11)
-    
-    row_num = 4
-    
-    # Общие итоги
-    total_nal = 0
-    total_beznal = 0
+    # Книгу собираем в отдельном потоке, чтобы не блокировать обработку других апдейтов
+    filename = f"vyplaty_{code}_{date_from}_{date_to}.xlsx"
+    filepath = f"{uuid.uuid4().hex}_{filename}"
     
-    # Выводим по каждому клубу
-    for club in sorted(by_club.keys()):
-        data = by_club[club]
+    def build_workbook():
+        # Создаем Excel файл
+        from openpyxl import Workbook
+        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
         
-        # Заголовок клуба
-        ws.cell(row=row_num, column=1, value=f"Клуб: {club}")
-        ws.cell(row=row_num, column=1).font = Font(bold=True, size=12)
-        row_num += 1
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Выплаты"
         
-        # Шапка таблицы
-        headers = ['Дата', 'НАЛ', 'БЕЗНАЛ', '10%', 'ИТОГО']
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=row_num, column=col, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.border = border
-        row_num += 1
+        # Стили
+        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+        header_font = Font(bold=True, color="FFFFFF", size=11)
+        border = Border(
+            left=Side(style='thin'),
+            right=Side(style='thin'),
+            top=Side(style='thin'),
+            bottom=Side(style='thin')
+        )
+        
+        # Заголовок
+        ws['A1'] = f"Выплаты сотруднику {code}"
+        ws['A1'].font = Font(bold=True, size=14)
+        ws['A2'] = f"Период: {date_from} .. {date_to}"
+        ws['A2'].font = Font(size=11)
+        
+        row_num = 4
+        
+        # Общие итоги
+        total_nal = 0
+        total_beznal = 0
         
-        # Данные по датам
-        for date in sorted(data['by_date'].keys()):
-            date_data = data['by_date'][date]
-            nal_sum = date_data['nal']
-            beznal_sum = date_data['beznal']
-            minus10 = beznal_sum * 0.1
-            itog = nal_sum + (beznal_sum - minus10)
+        # Выводим по каждому клубу
+        for club in sorted(by_club.keys()):
+            data = by_club[club]
             
-            # Преобразуем дату из 2024-10-30 в 30.10.24
-            try:
-                year, month, day = date.split('-')
-                date_short = f"{day}.{month}.{year[2:]}"
-            except:
-                date_short = date
+            # Заголовок клуба
+            ws.cell(row=row_num, column=1, value=f"Клуб: {club}")
+            ws.cell(row=row_num, column=1).font = Font(bold=True, size=12)
+            row_num += 1
             
-            # Дата
-            cell = ws.cell(row=row_num, column=1, value=date_short)
-            cell.alignment = Alignment(horizontal='center', vertical='center')
+            # Шапка таблицы
+            headers = ['Дата', 'НАЛ', 'БЕЗНАЛ', '10%', 'ИТОГО']
+            for col, header in enumerate(headers, 1):
+                cell = ws.cell(row=row_num, column=col, value=header)
+                cell.font = header_font
+                cell.fill = header_fill
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+                cell.border = border
+            row_num += 1
+            
+            # Данные по датам
+            for date in sorted(data['by_date'].keys()):
+                date_data = data['by_date'][date]
+                nal_sum = date_data['nal']
+                beznal_sum = date_data['beznal']
+                minus10 = beznal_sum * 0.1
+                itog = nal_sum + (beznal_sum - minus10)
+                
+                # Преобразуем дату из 2024-10-30 в 30.10.24
+                try:
+                    year, month, day = date.split('-')
+                    date_short = f"{day}.{month}.{year[2:]}"
+                except:
+                    date_short = date
+                
+                # Дата
+                cell = ws.cell(row=row_num, column=1, value=date_short)
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+                cell.border = border
+                
+                # НАЛ
+                cell = ws.cell(row=row_num, column=2, value=nal_sum)
+                cell.alignment = Alignment(horizontal='right', vertical='center')
+                cell.border = border
+                
+                # БЕЗНАЛ
+                cell = ws.cell(row=row_num, column=3, value=beznal_sum)
+                cell.alignment = Alignment(horizontal='right', vertical='center')
+                cell.border = border
+                
+                # 10%
+                cell = ws.cell(row=row_num, column=4, value=minus10)
+                cell.alignment = Alignment(horizontal='right', vertical='center')
+                cell.border = border
+                
+                # ИТОГО
+                cell = ws.cell(row=row_num, column=5, value=itog)
+                cell.alignment = Alignment(horizontal='right', vertical='center')
+                cell.border = border
+                
+                row_num += 1
+            
+            # Итог по клубу
+            club_nal = data['nal']
+            club_beznal = data['beznal']
+            club_minus10 = club_beznal * 0.1
+            club_total = club_nal + (club_beznal - club_minus10)
+            
+            cell = ws.cell(row=row_num, column=1, value='ИТОГО ПО КЛУБУ')
+            cell.font = Font(bold=True)
+            cell.alignment = Alignment(horizontal='left', vertical='center')
             cell.border = border
             
-            # НАЛ
-            cell = ws.cell(row=row_num, column=2, value=nal_sum)
+            cell = ws.cell(row=row_num, column=2, value=club_nal)
+            cell.font = Font(bold=True)
             cell.alignment = Alignment(horizontal='right', vertical='center')
             cell.border = border
             
-            # БЕЗНАЛ
-            cell = ws.cell(row=row_num, column=3, value=beznal_sum)
+            cell = ws.cell(row=row_num, column=3, value=club_beznal)
+            cell.font = Font(bold=True)
             cell.alignment = Alignment(horizontal='right', vertical='center')
             cell.border = border
             
-            # 10%
-            cell = ws.cell(row=row_num, column=4, value=minus10)
+            cell = ws.cell(row=row_num, column=4, value=club_minus10)
+            cell.font = Font(bold=True)
             cell.alignment = Alignment(horizontal='right', vertical='center')
             cell.border = border
             
-            # ИТОГО
-            cell = ws.cell(row=row_num, column=5, value=itog)
+            cell = ws.cell(row=row_num, column=5, value=club_total)
+            cell.font = Font(bold=True)
             cell.alignment = Alignment(horizontal='right', vertical='center')
             cell.border = border
             
-            row_num += 1
+            row_num += 2  # Пропускаем строку
+            
+            total_nal += club_nal
+            total_beznal += club_beznal
         
-        # Итог по клубу
-        club_nal = data['nal']
-        club_beznal = data['beznal']
-        club_minus10 = club_beznal * 0.1
-        club_total = club_nal + (club_beznal - club_minus10)
+        # Общий итог
+        total_minus10 = total_beznal * 0.1
+        total_itog = total_nal + (total_beznal - total_minus10)
         
-        cell = ws.cell(row=row_num, column=1, value='ИТОГО ПО КЛУБУ')
-        cell.font = Font(bold=True)
+        cell = ws.cell(row=row_num, column=1, value='ИТОГО ПО ВСЕМ КЛУБАМ')
+        cell.font = Font(bold=True, size=12)
         cell.alignment = Alignment(horizontal='left', vertical='center')
         cell.border = border
         
-        cell = ws.cell(row=row_num, column=2, value=club_nal)
+        cell = ws.cell(row=row_num, column=2, value=total_nal)
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='right', vertical='center')
         cell.border = border
         
-        cell = ws.cell(row=row_num, column=3, value=club_beznal)
+        cell = ws.cell(row=row_num, column=3, value=total_beznal)
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='right', vertical='center')
         cell.border = border
         
-        cell = ws.cell(row=row_num, column=4, value=club_minus10)
+        cell = ws.cell(row=row_num, column=4, value=total_minus10)
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='right', vertical='center')
         cell.border = border
         
-        cell = ws.cell(row=row_num, column=5, value=club_total)
+        cell = ws.cell(row=row_num, column=5, value=total_itog)
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='right', vertical='center')
         cell.border = border
         
-        row_num += 2  # Пропускаем строку
+        # Автоподгонка ширины столбцов
+        for column in ws.columns:
+            max_length = 0
+            column_letter = column[0].column_letter
+            for cell in column:
+                try:
+                    if cell.value:
+                        cell_length = len(str(cell.value))
+                        if cell_length > max_length:
+                            max_length = cell_length
+                except:
+                    pass
+            adjusted_width = max_length + 2
+            ws.column_dimensions[column_letter].width = adjusted_width
         
-        total_nal += club_nal
-        total_beznal += club_beznal
-    
-    # Общий итог
-    total_minus10 = total_beznal * 0.1
-    total_itog = total_nal + (total_beznal - total_minus10)
-    
-    cell = ws.cell(row=row_num, column=1, value='ИТОГО ПО ВСЕМ КЛУБАМ')
-    cell.font = Font(bold=True, size=12)
-    cell.alignment = Alignment(horizontal='left', vertical='center')
-    cell.border = border
-    
-    cell = ws.cell(row=row_num, column=2, value=total_nal)
-    cell.font = Font(bold=True)
-    cell.alignment = Alignment(horizontal='right', vertical='center')
-    cell.border = border
-    
-    cell = ws.cell(row=row_num, column=3, value=total_beznal)
-    cell.font = Font(bold=True)
-    cell.alignment = Alignment(horizontal='right', vertical='center')
-    cell.border = border
-    
-    cell = ws.cell(row=row_num, column=4, value=total_minus10)
-    cell.font = Font(bold=True)
-    cell.alignment = Alignment(horizontal='right', vertical='center')
-    cell.border = border
-    
-    cell = ws.cell(row=row_num, column=5, value=total_itog)
-    cell.font = Font(bold=True)
-    cell.alignment = Alignment(horizontal='right', vertical='center')
-    cell.border = border
-    
-    # Автоподгонка ширины столбцов
-    for column in ws.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if cell.value:
-                    cell_length = len(str(cell.value))
-                    if cell_length > max_length:
-                        max_length = cell_length
-            except:
-                pass
-        adjusted_width = max_length + 2
-        ws.column_dimensions[column_letter].width = adjusted_width
+        # Сохраняем и отправляем
+        wb.save(filepath)
     
-    # Сохраняем и отправляем
-    filename = f"vyplaty_{code}_{date_from}_{date_to}.xlsx"
-    wb.save(filename)
+    await asyncio.to_thread(build_workbook)
     
-    with open(filename, 'rb') as f:
+    with open(filepath, 'rb') as f:
         await update.message.reply_document(
             document=f,
             filename=filename,
@@ -5843,7 +5997,7 @@ async def handle_payments_command(update: Update, context: ContextTypes.DEFAULT_
         )
     
     import os
-    os.remove(filename)
+    os.remove(filepath)
     
     # Если ограниченный доступ - предлагаем повторить
     if state.limited_access:
@@ -5930,35 +6084,31 @@ async def generate_salary_excel_by_employee(update: Update, code: str, date_from
     from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
     from collections import defaultdict
     
-    # Получаем данные из БД по всем клубам
+    # Получаем строки сотрудника из БД по всем клубам (фильтр по коду и сортировка - в SQL)
     all_payments = []
-    for club in ['Москвич', 'Анора']:
-        club_payments = db.get_payments(club, date_from, date_to)
-        for row in club_payments:
-            # row это tuple из БД, преобразуем в dict
-            payment_dict = {
-                'id': row[0],
-                'club': row[1],
-                'date': row[2],
-                'code': row[3],
-                'name': row[4],
-                'stavka': row[5],
-                'lm_3': row[6],
-                'percent_5': row[7],
-                'promo': row[8],
-                'crz': row[9],
-                'cons': row[10],
-                'tips': row[11],
-                'fines': row[12],
-                'total_shift': row[13],
-                'debt': row[14],
-                'debt_nal': row[15],
-                'to_pay': row[16],
-                'created_at': row[17]
-            }
-            # Фильтруем по коду
-            if payment_dict['code'] == code:
-                all_payments.append(payment_dict)
+    employee_payments = await asyncio.to_thread(db.get_employee_payments_by_period, code, date_from, date_to)
+    for row in employee_payments:
+        # row это tuple из БД, преобразуем в dict
+        all_payments.append({
+            'id': row[0],
+            'club': row[1],
+            'date': row[2],
+            'code': row[3],
+            'name': row[4],
+            'stavka': row[5],
+            'lm_3': row[6],
+            'percent_5': row[7],
+            'promo': row[8],
+            'crz': row[9],
+            'cons': row[10],
+            'tips': row[11],
+            'fines': row[12],
+            'total_shift': row[13],
+            'debt': row[14],
+            'debt_nal': row[15],
+            'to_pay': row[16],
+            'created_at': row[17]
+        })
     
     if not all_payments:
         await update.message.reply_text(
@@ -5969,218 +6119,221 @@ async def generate_salary_excel_by_employee(update: Update, code: str, date_from
         )
         return
     
-    # Сортируем по дате и клубу
-    all_payments.sort(key=lambda x: (x['date'], x['club']))
-    
-    # Создаём Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "ЗП"
-    
-    # Стили
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=10)
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Заголовок
-    ws['A1'] = f"Отчёт ЗП: {code} - {all_payments[0]['name']}"
-    ws['A1'].font = Font(bold=True, size=14)
-    ws['A2'] = f"Период: {date_from} .. {date_to}"
-    ws['A2'].font = Font(size=11)
-    
-    row_num = 4
-    
-    # Шапка таблицы
-    headers = [
-        'Дата', 'Клуб', 'Код', 'Имя', 
-        'Ставка', '3% ЛМ', '5%', 'Промо',
-        'CRZ', 'Cons', 'Чаевые', 'ИТОГО выплат', 'Получила на смене',
-        'Долг БН', '10% (вычет)', 'Долг НАЛ', 'К выплате',
-        'Самозанятость', 'К выплате (самозанятый)'
-    ]
-    
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=row_num, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-        cell.border = border
-    row_num += 1
-    
-    # Итоговые суммы
-    totals = {
-        'stavka': 0, 'lm_3': 0, 'percent_5': 0, 'promo': 0,
-        'crz': 0, 'cons': 0, 'tips': 0, 'total_shift': 0,
-        'to_pay': 0, 'debt': 0, 'debt_nal': 0, 'final_pay': 0
-    }
+    # Книгу собираем в отдельном потоке, чтобы не блокировать обработку других апдейтов
+    filename = f"zp_{code}_{date_from}_{date_to}.xlsx"
+    filepath = f"{uuid.uuid4().hex}_{filename}"
     
-    # Данные
-    for payment in all_payments:
-        # Преобразуем дату
-        try:
-            year, month, day = payment['date'].split('-')
-            date_short = f"{day}.{month}.{year[2:]}"
-        except:
-            date_short = payment['date']
-        
-        # Рассчитываем 10% и к выплате
-        vychet_10 = round(payment['debt'] * 0.1)  # Округление до целого
-        k_vyplate = round(payment['debt_nal'] + payment['debt'] - vychet_10)  # Без стилистов
-        
-        # Обработка кода для отображения
-        display_code = payment['code']
-        if display_code.startswith('СБ-'):
-            display_code = 'СБ'  # Убираем имя из кода для отображения
-        elif display_code.startswith('Уборщица'):
-            display_code = 'Уборщица'  # Убираем "Москвич/Анора" из кода для отображения
-        
-        # Проверяем самозанятость
-        normalized_code = payment['code'].upper().strip()
-        is_self_employed = db.is_self_employed(normalized_code)
-        
-        # Рассчитываем "К выплате (самозанятый)" если самозанятый
-        # Формула: itog / 0.94 (где itog = total_shift)
-        if is_self_employed:
-            self_employed_payout = round(payment['total_shift'] / 0.94, 2)
-            self_employed_icon = '✓'
-        else:
-            self_employed_payout = ''
-            self_employed_icon = ''
-        
-        # Записываем строку (одинаково для всех)
-        row_data = [
-            date_short,
-            payment['club'],
-            display_code,  # Используем обработанный код
-            payment['name'],
-            payment['stavka'],
-            payment['lm_3'],
-            payment['percent_5'],
-            payment['promo'],
-            payment['crz'],
-            payment['cons'],
-            payment['tips'],
-            payment['total_shift'],
-            payment['to_pay'],
-            payment['debt'],
-            vychet_10,
-            payment['debt_nal'],
-            k_vyplate,  # БЕЗ stylist_amount
-            self_employed_icon,  # Самозанятость
-            self_employed_payout  # К выплате (самозанятый)
+    def build_workbook():
+        # Создаём Excel
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "ЗП"
+        
+        # Стили
+        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+        header_font = Font(bold=True, color="FFFFFF", size=10)
+        border = Border(
+            left=Side(style='thin'),
+            right=Side(style='thin'),
+            top=Side(style='thin'),
+            bottom=Side(style='thin')
+        )
+        
+        # Заголовок
+        ws['A1'] = f"Отчёт ЗП: {code} - {all_payments[0]['name']}"
+        ws['A1'].font = Font(bold=True, size=14)
+        ws['A2'] = f"Период: {date_from} .. {date_to}"
+        ws['A2'].font = Font(size=11)
+        
+        row_num = 4
+        
+        # Шапка таблицы
+        headers = [
+            'Дата', 'Клуб', 'Код', 'Имя', 
+            'Ставка', '3% ЛМ', '5%', 'Промо',
+            'CRZ', 'Cons', 'Чаевые', 'ИТОГО выплат', 'Получила на смене',
+            'Долг БН', '10% (вычет)', 'Долг НАЛ', 'К выплате',
+            'Самозанятость', 'К выплате (самозанятый)'
         ]
         
-        for col, value in enumerate(row_data, 1):
-            cell = ws.cell(row=row_num, column=col, value=value)
+        for col, header in enumerate(headers, 1):
+            cell = ws.cell(row=row_num, column=col, value=header)
+            cell.font = header_font
+            cell.fill = header_fill
+            cell.alignment = Alignment(horizontal='center', vertical='center')
             cell.border = border
-            if is_employee_request:
-                # Для сотрудников: числовые столбцы после Имя (col > 4)
-                if col > 4:
-                    # Определяем индекс колонки "Самозанятость" (предпоследняя)
-                    self_employed_col = len(headers) - 1
-                    if col == self_employed_col:  # Колонка "Самозанятость" - по центру
-                        cell.alignment = Alignment(horizontal='center', vertical='center')
-                    else:
-                        cell.alignment = Alignment(horizontal='right', vertical='center')
-                else:
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-            else:
-                # Для админов: числовые столбцы после Статус (col > 7)
-                if col > 7:
-                    # Определяем индекс колонки "Самозанятость" (предпоследняя)
-                    self_employed_col = len(headers) - 1
-                    if col == self_employed_col:  # Колонка "Самозанятость" - по центру
-                        cell.alignment = Alignment(horizontal='center', vertical='center')
-                    else:
-                        cell.alignment = Alignment(horizontal='right', vertical='center')
-                else:
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
+        row_num += 1
         
-        # Обновляем итоги
-        totals['stavka'] += payment['stavka']
-        totals['lm_3'] += payment['lm_3']
-        totals['percent_5'] += payment['percent_5']
-        totals['promo'] += payment['promo']
-        totals['crz'] += payment['crz']
-        totals['cons'] += payment['cons']
-        totals['tips'] += payment['tips']
-        totals['total_shift'] += payment['total_shift']
-        totals['to_pay'] += payment['to_pay']
-        totals['debt'] += payment['debt']
-        totals['debt_nal'] += payment['debt_nal']
-        totals['final_pay'] += k_vyplate
+        # Итоговые суммы
+        totals = {
+            'stavka': 0, 'lm_3': 0, 'percent_5': 0, 'promo': 0,
+            'crz': 0, 'cons': 0, 'tips': 0, 'total_shift': 0,
+            'to_pay': 0, 'debt': 0, 'debt_nal': 0, 'final_pay': 0
+        }
         
-        row_num += 1
-    
-    # Строка ИТОГО
-    vychet_10_total = round(totals['debt'] * 0.1)  # Округление до целого
-    
-    # ИТОГО
-    vychet_10_total = round(totals['debt'] * 0.1)
-    itogo_data = [
-        'ИТОГО', '', '', '',  # Дата, Клуб, Код, Имя
-        totals['stavka'],
-        totals['lm_3'],
-        totals['percent_5'],
-        totals['promo'],
-        totals['crz'],
-        totals['cons'],
-        totals['tips'],
-        totals['total_shift'],
-        totals['to_pay'],
-        totals['debt'],
-        vychet_10_total,
-        totals['debt_nal'],
-        round(totals['final_pay']),  # Округление до целого
-        '',  # Самозанятость (пусто для итогов)
-        ''   # К выплате (самозанятый) (пусто для итогов)
-    ]
-    
-    for col, value in enumerate(itogo_data, 1):
-        cell = ws.cell(row=row_num, column=col, value=value)
-        cell.font = Font(bold=True)
-        cell.border = border
-        # Числовые столбцы после Имя (col > 4)
-        if col > 4:
-            # Определяем индекс колонки "Самозанятость" (предпоследняя)
-            self_employed_col = len(headers) - 1
-            if col == self_employed_col:  # Колонка "Самозанятость" - по центру
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            else:
-                cell.alignment = Alignment(horizontal='right', vertical='center')
-        else:
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-    
-    # Автоподгонка ширины
-    for column in ws.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
+        # Данные
+        for payment in all_payments:
+            # Преобразуем дату
             try:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
+                year, month, day = payment['date'].split('-')
+                date_short = f"{day}.{month}.{year[2:]}"
             except:
-                pass
-        ws.column_dimensions[column_letter].width = min(max_length + 2, 20)
-    
-    # Сохраняем и отправляем
-    filename = f"zp_{code}_{date_from}_{date_to}.xlsx"
-    wb.save(filename)
-    
-    with open(filename, 'rb') as f:
-        await update.message.reply_document(
-            document=f,
-            filename=filename,
-            caption=f"💵 Отчёт ЗП: {code}\nПериод: {date_from} .. {date_to}"
-        )
-    
-    import os
-    os.remove(filename)
+                date_short = payment['date']
+            
+            # Рассчитываем 10% и к выплате
+            vychet_10 = round(payment['debt'] * 0.1)  # Округление до целого
+            k_vyplate = round(payment['debt_nal'] + payment['debt'] - vychet_10)  # Без стилистов
+            
+            # Обработка кода для отображения
+            display_code = payment['code']
+            if display_code.startswith('СБ-'):
+                display_code = 'СБ'  # Убираем имя из кода для отображения
+            elif display_code.startswith('Уборщица'):
+                display_code = 'Уборщица'  # Убираем "Москвич/Анора" из кода для отображения
+            
+            # Проверяем самозанятость
+            normalized_code = payment['code'].upper().strip()
+            is_self_employed = db.is_self_employed(normalized_code)
+            
+            # Рассчитываем "К выплате (самозанятый)" если самозанятый
+            # Формула: itog / 0.94 (где itog = total_shift)
+            if is_self_employed:
+                self_employed_payout = round(payment['total_shift'] / 0.94, 2)
+                self_employed_icon = '✓'
+            else:
+                self_employed_payout = ''
+                self_employed_icon = ''
+            
+            # Записываем строку (одинаково для всех)
+            row_data = [
+                date_short,
+                payment['club'],
+                display_code,  # Используем обработанный код
+                payment['name'],
+                payment['stavka'],
+                payment['lm_3'],
+                payment['percent_5'],
+                payment['promo'],
+                payment['crz'],
+                payment['cons'],
+                payment['tips'],
+                payment['total_shift'],
+                payment['to_pay'],
+                payment['debt'],
+                vychet_10,
+                payment['debt_nal'],
+                k_vyplate,  # БЕЗ stylist_amount
+                self_employed_icon,  # Самозанятость
+                self_employed_payout  # К выплате (самозанятый)
+            ]
+            
+            for col, value in enumerate(row_data, 1):
+                cell = ws.cell(row=row_num, column=col, value=value)
+                cell.border = border
+                if is_employee_request:
+                    # Для сотрудников: числовые столбцы после Имя (col > 4)
+                    if col > 4:
+                        # Определяем индекс колонки "Самозанятость" (предпоследняя)
+                        self_employed_col = len(headers) - 1
+                        if col == self_employed_col:  # Колонка "Самозанятость" - по центру
+                            cell.alignment = Alignment(horizontal='center', vertical='center')
+                        else:
+                            cell.alignment = Alignment(horizontal='right', vertical='center')
+                    else:
+                        cell.alignment = Alignment(horizontal='center', vertical='center')
+                else:
+                    # Для админов: числовые столбцы после Статус (col > 7)
+                    if col > 7:
+                        # Определяем индекс колонки "Самозанятость" (предпоследняя)
+                        self_employed_col = len(headers) - 1
+                        if col == self_employed_col:  # Колонка "Самозанятость" - по центру
+                            cell.alignment = Alignment(horizontal='center', vertical='center')
+                        else:
+                            cell.alignment = Alignment(horizontal='right', vertical='center')
+                    else:
+                        cell.alignment = Alignment(horizontal='center', vertical='center')
+            
+            # Обновляем итоги
+            totals['stavka'] += payment['stavka']
+            totals['lm_3'] += payment['lm_3']
+            totals['percent_5'] += payment['percent_5']
+            totals['promo'] += payment['promo']
+            totals['crz'] += payment['crz']
+            totals['cons'] += payment['cons']
+            totals['tips'] += payment['tips']
+            totals['total_shift'] += payment['total_shift']
+            totals['to_pay'] += payment['to_pay']
+            totals['debt'] += payment['debt']
+            totals['debt_nal'] += payment['debt_nal']
+            totals['final_pay'] += k_vyplate
+            
+            row_num += 1
+        
+        # Строка ИТОГО
+        vychet_10_total = round(totals['debt'] * 0.1)  # Округление до целого
+        
+        # ИТОГО
+        vychet_10_total = round(totals['debt'] * 0.1)
+        itogo_data = [
+            'ИТОГО', '', '', '',  # Дата, Клуб, Код, Имя
+            totals['stavka'],
+            totals['lm_3'],
+            totals['percent_5'],
+            totals['promo'],
+            totals['crz'],
+            totals['cons'],
+            totals['tips'],
+            totals['total_shift'],
+            totals['to_pay'],
+            totals['debt'],
+            vychet_10_total,
+            totals['debt_nal'],
+            round(totals['final_pay']),  # Округление до целого
+            '',  # Самозанятость (пусто для итогов)
+            ''   # К выплате (самозанятый) (пусто для итогов)
+        ]
+        
+        for col, value in enumerate(itogo_data, 1):
+            cell = ws.cell(row=row_num, column=col, value=value)
+            cell.font = Font(bold=True)
+            cell.border = border
+            # Числовые столбцы после Имя (col > 4)
+            if col > 4:
+                # Определяем индекс колонки "Самозанятость" (предпоследняя)
+                self_employed_col = len(headers) - 1
+                if col == self_employed_col:  # Колонка "Самозанятость" - по центру
+                    cell.alignment = Alignment(horizontal='center', vertical='center')
+                else:
+                    cell.alignment = Alignment(horizontal='right', vertical='center')
+            else:
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+        
+        # Автоподгонка ширины
+        for column in ws.columns:
+            max_length = 0
+            column_letter = column[0].column_letter
+            for cell in column:
+                try:
+                    if cell.value:
+                        max_length = max(max_length, len(str(cell.value)))
+                except:
+                    pass
+            ws.column_dimensions[column_letter].width = min(max_length + 2, 20)
+        
+        # Сохраняем и отправляем
+        wb.save(filepath)
+    
+    await asyncio.to_thread(build_workbook)
+    
+    with open(filepath, 'rb') as f:
+        await update.message.reply_document(
+            document=f,
+            filename=filename,
+            caption=f"💵 Отчёт ЗП: {code}\nПериод: {date_from} .. {date_to}"
+        )
+    
+    import os
+    os.remove(filepath)
     
     # === ВТОРОЙ ФАЙЛ: СТИЛИСТЫ (только для одного сотрудника) ===
     
@@ -6213,103 +6366,106 @@ async def generate_salary_excel_by_employee(update: Update, code: str, date_from
     
     # Если есть данные по стилистам - создаём второй файл
     if stylist_records:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-        
-        wb2 = Workbook()
-        ws2 = wb2.active
-        ws2.title = "Стилисты"
-        
-        # Стили
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=10)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        
-        # Заголовок
-        ws2['A1'] = f"Расходы на стилистов: {code}"
-        ws2['A1'].font = Font(bold=True, size=14)
-        ws2['A2'] = f"Период: {date_from} .. {date_to}"
-        ws2['A2'].font = Font(size=11)
-        
-        row_num = 4
-        
-        # Шапка таблицы
-        headers = ['Клуб', 'Период с', 'Период по', 'Сумма']
-        for col, header in enumerate(headers, 1):
-            cell = ws2.cell(row=row_num, column=col, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.border = border
-        row_num += 1
-        
-        # Данные
-        total_stylist = 0
-        for record in stylist_records:
-            # Преобразуем даты
-            try:
-                year, month, day = record['period_from'].split('-')
-                date_from_short = f"{day}.{month}.{year[2:]}"
-            except:
-                date_from_short = record['period_from']
+        # Книгу собираем в отдельном потоке, чтобы не блокировать обработку других апдейтов
+        filename2 = f"stilisty_{code}_{date_from}_{date_to}.xlsx"
+        filepath2 = f"{uuid.uuid4().hex}_{filename2}"
+        
+        def build_workbook():
+            wb2 = Workbook()
+            ws2 = wb2.active
+            ws2.title = "Стилисты"
+            
+            # Стили
+            header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+            header_font = Font(bold=True, color="FFFFFF", size=10)
+            border = Border(
+                left=Side(style='thin'),
+                right=Side(style='thin'),
+                top=Side(style='thin'),
+                bottom=Side(style='thin')
+            )
             
-            try:
-                year, month, day = record['period_to'].split('-')
-                date_to_short = f"{day}.{month}.{year[2:]}"
-            except:
-                date_to_short = record['period_to']
+            # Заголовок
+            ws2['A1'] = f"Расходы на стилистов: {code}"
+            ws2['A1'].font = Font(bold=True, size=14)
+            ws2['A2'] = f"Период: {date_from} .. {date_to}"
+            ws2['A2'].font = Font(size=11)
             
-            row_data = [
-                record['club'],
-                date_from_short,
-                date_to_short,
-                record['amount']
-            ]
+            row_num = 4
             
-            for col, value in enumerate(row_data, 1):
+            # Шапка таблицы
+            headers = ['Клуб', 'Период с', 'Период по', 'Сумма']
+            for col, header in enumerate(headers, 1):
+                cell = ws2.cell(row=row_num, column=col, value=header)
+                cell.font = header_font
+                cell.fill = header_fill
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+                cell.border = border
+            row_num += 1
+            
+            # Данные
+            total_stylist = 0
+            for record in stylist_records:
+                # Преобразуем даты
+                try:
+                    year, month, day = record['period_from'].split('-')
+                    date_from_short = f"{day}.{month}.{year[2:]}"
+                except:
+                    date_from_short = record['period_from']
+                
+                try:
+                    year, month, day = record['period_to'].split('-')
+                    date_to_short = f"{day}.{month}.{year[2:]}"
+                except:
+                    date_to_short = record['period_to']
+                
+                row_data = [
+                    record['club'],
+                    date_from_short,
+                    date_to_short,
+                    record['amount']
+                ]
+                
+                for col, value in enumerate(row_data, 1):
+                    cell = ws2.cell(row=row_num, column=col, value=value)
+                    cell.border = border
+                    if col == 4:  # Сумма
+                        cell.alignment = Alignment(horizontal='right', vertical='center')
+                    else:
+                        cell.alignment = Alignment(horizontal='center', vertical='center')
+                
+                total_stylist += record['amount']
+                row_num += 1
+            
+            # Строка ИТОГО
+            itogo_data = ['ИТОГО', '', '', total_stylist]
+            for col, value in enumerate(itogo_data, 1):
                 cell = ws2.cell(row=row_num, column=col, value=value)
+                cell.font = Font(bold=True)
                 cell.border = border
-                if col == 4:  # Сумма
+                if col == 4:
                     cell.alignment = Alignment(horizontal='right', vertical='center')
                 else:
                     cell.alignment = Alignment(horizontal='center', vertical='center')
             
-            total_stylist += record['amount']
-            row_num += 1
-        
-        # Строка ИТОГО
-        itogo_data = ['ИТОГО', '', '', total_stylist]
-        for col, value in enumerate(itogo_data, 1):
-            cell = ws2.cell(row=row_num, column=col, value=value)
-            cell.font = Font(bold=True)
-            cell.border = border
-            if col == 4:
-                cell.alignment = Alignment(horizontal='right', vertical='center')
-            else:
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Автоподгонка ширины
-        for column in ws2.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if cell.value:
-                        max_length = max(max_length, len(str(cell.value)))
-                except:
-                    pass
-            ws2.column_dimensions[column_letter].width = min(max_length + 2, 20)
+            # Автоподгонка ширины
+            for column in ws2.columns:
+                max_length = 0
+                column_letter = column[0].column_letter
+                for cell in column:
+                    try:
+                        if cell.value:
+                            max_length = max(max_length, len(str(cell.value)))
+                    except:
+                        pass
+                ws2.column_dimensions[column_letter].width = min(max_length + 2, 20)
+            
+            # Сохраняем и отправляем
+            wb2.save(filepath2)
         
-        # Сохраняем и отправляем
-        filename2 = f"stilisty_{code}_{date_from}_{date_to}.xlsx"
-        wb2.save(filename2)
+        await asyncio.to_thread(build_workbook)
         
-        with open(filename2, 'rb') as f:
+        with open(filepath2, 'rb') as f:
             await update.message.reply_document(
                 document=f,
                 filename=filename2,
@@ -6317,7 +6473,7 @@ async def generate_salary_excel_by_employee(update: Update, code: str, date_from
             )
         
         import os
-        os.remove(filename2)
+        os.remove(filepath2)
 
 
 async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_from: str, date_to: str):
@@ -6328,7 +6484,6 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
     """
     from openpyxl import Workbook
     from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-    from datetime import datetime, timedelta
     from parser import DataParser
     
     # Получаем все данные из БД
@@ -6426,91 +6581,337 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
         payments_by_date[date].append(payment)
     
     # Создаём Excel
-    wb = Workbook()
-    # НЕ удаляем активный лист - используем его для ИТОГО
-    
+    # Книгу собираем в отдельном потоке, чтобы не блокировать обработку других апдейтов
     club_names = ', '.join(clubs)  # Определяем для использования в create_sheet
+    club_str = '_'.join([c.lower() for c in clubs])
+    filename = f"zp_{club_str}_{date_from}_{date_to}.xlsx"
+    filepath = f"{uuid.uuid4().hex}_{filename}"
     
-    # Стили
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=10)
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Шапка таблицы
-    headers = [
-        'Дата', 'Клуб', 'Код', 'Имя',
-        'Ставка', '3% ЛМ', '5%', 'Промо',
-        'CRZ', 'Cons', 'Чаевые', 'ИТОГО выплат', 'Получила на смене',
-        'Долг БН', '10% (вычет)', 'Долг НАЛ', 'К выплате',
-        'Самозанятость', 'К выплате (самозанятый)'
-    ]
-    
-    # Получаем соединение для запросов к БД
-    conn_temp = db.get_connection()
-    
-    # Функция для создания листа с данными
-    def create_sheet(ws, title, payments_list, show_date_col=True):
-        ws.title = title
-        ws['A1'] = f"Отчёт ЗП: {club_names}"
-        ws['A1'].font = Font(bold=True, size=14)
-        ws['A2'] = f"Период: {date_from} .. {date_to}"
-        ws['A2'].font = Font(size=11)
+    def build_workbook():
+        wb = Workbook()
+        # НЕ удаляем активный лист - используем его для ИТОГО
+        
+        
+        # Стили
+        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+        header_font = Font(bold=True, color="FFFFFF", size=10)
+        border = Border(
+            left=Side(style='thin'),
+            right=Side(style='thin'),
+            top=Side(style='thin'),
+            bottom=Side(style='thin')
+        )
+        
+        # Шапка таблицы
+        headers = [
+            'Дата', 'Клуб', 'Код', 'Имя',
+            'Ставка', '3% ЛМ', '5%', 'Промо',
+            'CRZ', 'Cons', 'Чаевые', 'ИТОГО выплат', 'Получила на смене',
+            'Долг БН', '10% (вычет)', 'Долг НАЛ', 'К выплате',
+            'Самозанятость', 'К выплате (самозанятый)'
+        ]
+        
+        # Получаем соединение для запросов к БД
+        conn_temp = db.get_connection()
+        
+        # Функция для создания листа с данными
+        def create_sheet(ws, title, payments_list, show_date_col=True):
+            ws.title = title
+            ws['A1'] = f"Отчёт ЗП: {club_names}"
+            ws['A1'].font = Font(bold=True, size=14)
+            ws['A2'] = f"Период: {date_from} .. {date_to}"
+            ws['A2'].font = Font(size=11)
+            
+            row_num = 4
+            
+            # Шапка таблицы
+            for col, header in enumerate(headers, 1):
+                cell = ws.cell(row=row_num, column=col, value=header)
+                cell.font = header_font
+                cell.fill = header_fill
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+                cell.border = border
+            row_num += 1
+            
+            # Итоговые суммы
+            totals = {
+                'stavka': 0, 'lm_3': 0, 'percent_5': 0, 'promo': 0,
+                'crz': 0, 'cons': 0, 'tips': 0, 'total_shift': 0,
+                'to_pay': 0, 'debt': 0, 'debt_nal': 0, 'final_pay': 0
+            }
+            
+            # Данные
+            for payment in payments_list:
+                # НОРМАЛИЗАЦИЯ КОДА
+                normalized_code = DataParser.normalize_code(payment['code'])
+                
+                # Преобразуем дату
+                try:
+                    year, month, day = payment['date'].split('-')
+                    date_short = f"{day}.{month}.{year[2:]}"
+                except:
+                    date_short = payment['date']
+                
+                # Рассчитываем 10% и к выплате
+                vychet_10 = round(payment['debt'] * 0.1)  # Округление до целого
+                k_vyplate = round(payment['debt_nal'] + payment['debt'] - vychet_10)  # Без стилистов
+                
+                # Обработка кода для отображения
+                display_code = normalized_code
+                if display_code.startswith('СБ-'):
+                    display_code = 'СБ'  # Убираем имя из кода для отображения
+                elif display_code.startswith('Уборщица'):
+                    display_code = 'Уборщица'  # Убираем "Москвич/Анора" из кода для отображения
+                
+                # Получаем даты найма/увольнения
+                cursor_temp = conn_temp.cursor()
+                
+                # Сначала проверяем employees (используем нормализованный код)
+                cursor_temp.execute("""
+                    SELECT hired_date, fired_date, is_active
+                    FROM employees
+                    WHERE code = ? AND club = ?
+                """, (normalized_code, payment['club']))
+                
+                emp_row = cursor_temp.fetchone()
+                
+                if emp_row:
+                    hired_date = emp_row[0]
+                    fired_date = emp_row[1]
+                    is_active = emp_row[2]
+                else:
+                    # Проверяем employee_history (используем нормализованный код)
+                    cursor_temp.execute("""
+                        SELECT hired_date, fired_date
+                        FROM employee_history
+                        WHERE code = ? AND club = ?
+                          AND ? BETWEEN hired_date AND COALESCE(fired_date, '9999-12-31')
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                    """, (normalized_code, payment['club'], payment['date']))
+                    
+                    hist_row = cursor_temp.fetchone()
+                    if hist_row:
+                        hired_date = hist_row[0]
+                        fired_date = hist_row[1]
+                        is_active = 0
+                    else:
+                        hired_date = None
+                        fired_date = None
+                        is_active = 1
+                
+                # Форматируем даты
+                if hired_date:
+                    try:
+                        year, month, day = hired_date.split('-')
+                        hired_str = f"{day}.{month}.{year[2:]}"
+                    except:
+                        hired_str = hired_date
+                else:
+                    hired_str = '-'
+                
+                if fired_date:
+                    try:
+                        year, month, day = fired_date.split('-')
+                        fired_str = f"{day}.{month}.{year[2:]}"
+                    except:
+                        fired_str = fired_date
+                else:
+                    fired_str = '-'
+                
+                status_icon = '✅' if is_active else '🗂️'
+                
+                # Проверка самозанятости
+                normalized_code_for_check = payment['code'].upper().strip()
+                is_self_employed = db.is_self_employed(normalized_code_for_check)
+                
+                if is_self_employed:
+                    self_employed_mark = '✓'
+                    self_employed_payout = round(k_vyplate / 0.94, 2)
+                else:
+                    self_employed_mark = ''
+                    self_employed_payout = ''
+                
+                # Записываем строку
+                row_data = [
+                    date_short if show_date_col else '',
+                    payment['club'],
+                    display_code,  # Используем обработанный код
+                    payment['name'],
+                    payment['stavka'],
+                    payment['lm_3'],
+                    payment['percent_5'],
+                    payment['promo'],
+                    payment['crz'],
+                    payment['cons'],
+                    payment['tips'],
+                    payment['total_shift'],
+                    payment['to_pay'],
+                    payment['debt'],
+                    vychet_10,
+                    payment['debt_nal'],
+                    k_vyplate,  # БЕЗ stylist_amount
+                    self_employed_mark,  # Самозанятость
+                    self_employed_payout  # К выплате (самозанятый)
+                ]
+                
+                for col, value in enumerate(row_data, 1):
+                    cell = ws.cell(row=row_num, column=col, value=value)
+                    cell.border = border
+                    if col > 4:  # Числовые столбцы (после Дата, Клуб, Код, Имя)
+                        # Определяем индекс колонки "Самозанятость" (предпоследняя)
+                        self_employed_col = len(headers) - 1
+                        if col == self_employed_col:  # Колонка "Самозанятость" - по центру
+                            cell.alignment = Alignment(horizontal='center', vertical='center')
+                        else:
+                            cell.alignment = Alignment(horizontal='right', vertical='center')
+                    else:
+                        cell.alignment = Alignment(horizontal='center', vertical='center')
+                
+                # Обновляем итоги
+                totals['stavka'] += payment['stavka']
+                totals['lm_3'] += payment['lm_3']
+                totals['percent_5'] += payment['percent_5']
+                totals['promo'] += payment['promo']
+                totals['crz'] += payment['crz']
+                totals['cons'] += payment['cons']
+                totals['tips'] += payment['tips']
+                totals['total_shift'] += payment['total_shift']
+                totals['to_pay'] += payment['to_pay']
+                totals['debt'] += payment['debt']
+                totals['debt_nal'] += payment['debt_nal']
+                totals['final_pay'] += k_vyplate
+                
+                row_num += 1
+            
+            # Строка ИТОГО
+            vychet_10_total = round(totals['debt'] * 0.1)  # Округление до целого
+            
+            itogo_data = [
+                'ИТОГО', '', '', '',  # Дата, Клуб, Код, Имя
+                totals['stavka'],
+                totals['lm_3'],
+                totals['percent_5'],
+                totals['promo'],
+                totals['crz'],
+                totals['cons'],
+                totals['tips'],
+                totals['total_shift'],
+                totals['to_pay'],
+                totals['debt'],
+                vychet_10_total,
+                totals['debt_nal'],
+                round(totals['final_pay']),  # Округление до целого
+                '',  # Самозанятость (пусто в ИТОГО)
+                ''   # К выплате (самозанятый) (пусто в ИТОГО)
+            ]
+            
+            for col, value in enumerate(itogo_data, 1):
+                cell = ws.cell(row=row_num, column=col, value=value)
+                cell.font = Font(bold=True)
+                cell.border = border
+                if col > 4:  # Числовые столбцы (после Дата, Клуб, Код, Имя)
+                    # Определяем индекс колонки "Самозанятость" (предпоследняя)
+                    self_employed_col = len(headers) - 1
+                    if col == self_employed_col:  # Колонка "Самозанятость" - по центру
+                        cell.alignment = Alignment(horizontal='center', vertical='center')
+                    else:
+                        cell.alignment = Alignment(horizontal='right', vertical='center')
+                else:
+                    cell.alignment = Alignment(horizontal='center', vertical='center')
+            
+            # Автоподгонка ширины
+            for column in ws.columns:
+                max_length = 0
+                column_letter = column[0].column_letter
+                for cell in column:
+                    try:
+                        if cell.value:
+                            max_length = max(max_length, len(str(cell.value)))
+                    except:
+                        pass
+                ws.column_dimensions[column_letter].width = min(max_length + 2, 20)
+            
+            return totals
+        
+        # === СНАЧАЛА СОЗДАЁМ ЛИСТ ИТОГО (будет первым) ===
+        # Создаём лист ИТОГО с группировкой по (код, имя)
+        employee_totals = {}
+        for payment in all_payments:
+            # НОРМАЛИЗАЦИЯ КОДА ПЕРЕД ГРУППИРОВКОЙ
+            normalized_code = DataParser.normalize_code(payment['code'])
+            
+            # Обработка кода для отображения
+            display_code = normalized_code
+            if display_code.startswith('СБ-'):
+                display_code = 'СБ'
+            elif display_code.startswith('Уборщица'):
+                display_code = 'Уборщица'
+            
+            key = (display_code, payment['name'])
+            if key not in employee_totals:
+                employee_totals[key] = {
+                    'code': display_code,
+                    'real_code': normalized_code,  # Нормализованный код для поиска в БД
+                    'name': payment['name'],
+                    'club': payment['club'],  # Сохраняем клуб
+                    'stavka': 0, 'lm_3': 0, 'percent_5': 0, 'promo': 0,
+                    'crz': 0, 'cons': 0, 'tips': 0, 'total_shift': 0,
+                    'to_pay': 0, 'debt': 0, 'debt_nal': 0
+                }
+            
+            employee_totals[key]['stavka'] += payment['stavka']
+            employee_totals[key]['lm_3'] += payment['lm_3']
+            employee_totals[key]['percent_5'] += payment['percent_5']
+            employee_totals[key]['promo'] += payment['promo']
+            employee_totals[key]['crz'] += payment['crz']
+            employee_totals[key]['cons'] += payment['cons']
+            employee_totals[key]['tips'] += payment['tips']
+            employee_totals[key]['total_shift'] += payment['total_shift']
+            employee_totals[key]['to_pay'] += payment['to_pay']
+            employee_totals[key]['debt'] += payment['debt']
+            employee_totals[key]['debt_nal'] += payment['debt_nal']
+        
+        # Используем активный лист для ИТОГО (будет первым)
+        ws_itogo = wb.active
+        ws_itogo.title = "ИТОГО"
+        ws_itogo['A1'] = f"Отчёт ЗП: {club_names}"
+        ws_itogo['A1'].font = Font(bold=True, size=14)
+        ws_itogo['A2'] = f"Период: {date_from} .. {date_to}"
+        ws_itogo['A2'].font = Font(size=11)
         
         row_num = 4
         
         # Шапка таблицы
         for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=row_num, column=col, value=header)
+            cell = ws_itogo.cell(row=row_num, column=col, value=header)
             cell.font = header_font
             cell.fill = header_fill
             cell.alignment = Alignment(horizontal='center', vertical='center')
             cell.border = border
         row_num += 1
         
-        # Итоговые суммы
-        totals = {
+        # Итоговые суммы для листа ИТОГО
+        grand_totals = {
             'stavka': 0, 'lm_3': 0, 'percent_5': 0, 'promo': 0,
             'crz': 0, 'cons': 0, 'tips': 0, 'total_shift': 0,
             'to_pay': 0, 'debt': 0, 'debt_nal': 0, 'final_pay': 0
         }
         
-        # Данные
-        for payment in payments_list:
-            # НОРМАЛИЗАЦИЯ КОДА
-            normalized_code = DataParser.normalize_code(payment['code'])
-            
-            # Преобразуем дату
-            try:
-                year, month, day = payment['date'].split('-')
-                date_short = f"{day}.{month}.{year[2:]}"
-            except:
-                date_short = payment['date']
-            
-            # Рассчитываем 10% и к выплате
-            vychet_10 = round(payment['debt'] * 0.1)  # Округление до целого
-            k_vyplate = round(payment['debt_nal'] + payment['debt'] - vychet_10)  # Без стилистов
-            
-            # Обработка кода для отображения
-            display_code = normalized_code
-            if display_code.startswith('СБ-'):
-                display_code = 'СБ'  # Убираем имя из кода для отображения
-            elif display_code.startswith('Уборщица'):
-                display_code = 'Уборщица'  # Убираем "Москвич/Анора" из кода для отображения
+        # Данные по сотрудникам
+        for key in sorted(employee_totals.keys()):
+            emp = employee_totals[key]
             
             # Получаем даты найма/увольнения
             cursor_temp = conn_temp.cursor()
             
-            # Сначала проверяем employees (используем нормализованный код)
+            # Используем реальный код и клуб из employee_totals
+            # Сначала проверяем employees
             cursor_temp.execute("""
                 SELECT hired_date, fired_date, is_active
                 FROM employees
                 WHERE code = ? AND club = ?
-            """, (normalized_code, payment['club']))
+            """, (emp['real_code'], emp['club']))
             
             emp_row = cursor_temp.fetchone()
             
@@ -6519,15 +6920,14 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
                 fired_date = emp_row[1]
                 is_active = emp_row[2]
             else:
-                # Проверяем employee_history (используем нормализованный код)
+                # Проверяем employee_history (берём последнюю запись)
                 cursor_temp.execute("""
                     SELECT hired_date, fired_date
                     FROM employee_history
                     WHERE code = ? AND club = ?
-                      AND ? BETWEEN hired_date AND COALESCE(fired_date, '9999-12-31')
                     ORDER BY created_at DESC
                     LIMIT 1
-                """, (normalized_code, payment['club'], payment['date']))
+                """, (emp['real_code'], emp['club']))
                 
                 hist_row = cursor_temp.fetchone()
                 if hist_row:
@@ -6560,8 +6960,12 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
             
             status_icon = '✅' if is_active else '🗂️'
             
+            # Рассчитываем 10% и к выплате
+            vychet_10 = round(emp['debt'] * 0.1)  # Округление до целого
+            k_vyplate = round(emp['debt_nal'] + emp['debt'] - vychet_10)
+            
             # Проверка самозанятости
-            normalized_code_for_check = payment['code'].upper().strip()
+            normalized_code_for_check = emp['code'].upper().strip()
             is_self_employed = db.is_self_employed(normalized_code_for_check)
             
             if is_self_employed:
@@ -6571,31 +6975,30 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
                 self_employed_mark = ''
                 self_employed_payout = ''
             
-            # Записываем строку
             row_data = [
-                date_short if show_date_col else '',
-                payment['club'],
-                display_code,  # Используем обработанный код
-                payment['name'],
-                payment['stavka'],
-                payment['lm_3'],
-                payment['percent_5'],
-                payment['promo'],
-                payment['crz'],
-                payment['cons'],
-                payment['tips'],
-                payment['total_shift'],
-                payment['to_pay'],
-                payment['debt'],
+                '',  # Дата пустая в ИТОГО
+                '',  # Клуб пустой в ИТОГО
+                emp['code'],
+                emp['name'],
+                emp['stavka'],
+                emp['lm_3'],
+                emp['percent_5'],
+                emp['promo'],
+                emp['crz'],
+                emp['cons'],
+                emp['tips'],
+                emp['total_shift'],
+                emp['to_pay'],
+                emp['debt'],
                 vychet_10,
-                payment['debt_nal'],
-                k_vyplate,  # БЕЗ stylist_amount
+                emp['debt_nal'],
+                k_vyplate,
                 self_employed_mark,  # Самозанятость
                 self_employed_payout  # К выплате (самозанятый)
             ]
             
             for col, value in enumerate(row_data, 1):
-                cell = ws.cell(row=row_num, column=col, value=value)
+                cell = ws_itogo.cell(row=row_num, column=col, value=value)
                 cell.border = border
                 if col > 4:  # Числовые столбцы (после Дата, Клуб, Код, Имя)
                     # Определяем индекс колонки "Самозанятость" (предпоследняя)
@@ -6608,45 +7011,45 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
                     cell.alignment = Alignment(horizontal='center', vertical='center')
             
             # Обновляем итоги
-            totals['stavka'] += payment['stavka']
-            totals['lm_3'] += payment['lm_3']
-            totals['percent_5'] += payment['percent_5']
-            totals['promo'] += payment['promo']
-            totals['crz'] += payment['crz']
-            totals['cons'] += payment['cons']
-            totals['tips'] += payment['tips']
-            totals['total_shift'] += payment['total_shift']
-            totals['to_pay'] += payment['to_pay']
-            totals['debt'] += payment['debt']
-            totals['debt_nal'] += payment['debt_nal']
-            totals['final_pay'] += k_vyplate
+            grand_totals['stavka'] += emp['stavka']
+            grand_totals['lm_3'] += emp['lm_3']
+            grand_totals['percent_5'] += emp['percent_5']
+            grand_totals['promo'] += emp['promo']
+            grand_totals['crz'] += emp['crz']
+            grand_totals['cons'] += emp['cons']
+            grand_totals['tips'] += emp['tips']
+            grand_totals['total_shift'] += emp['total_shift']
+            grand_totals['to_pay'] += emp['to_pay']
+            grand_totals['debt'] += emp['debt']
+            grand_totals['debt_nal'] += emp['debt_nal']
+            grand_totals['final_pay'] += k_vyplate
             
             row_num += 1
         
-        # Строка ИТОГО
-        vychet_10_total = round(totals['debt'] * 0.1)  # Округление до целого
+        # Строка ИТОГО в листе ИТОГО
+        vychet_10_grand = round(grand_totals['debt'] * 0.1)  # Округление до целого
         
         itogo_data = [
             'ИТОГО', '', '', '',  # Дата, Клуб, Код, Имя
-            totals['stavka'],
-            totals['lm_3'],
-            totals['percent_5'],
-            totals['promo'],
-            totals['crz'],
-            totals['cons'],
-            totals['tips'],
-            totals['total_shift'],
-            totals['to_pay'],
-            totals['debt'],
-            vychet_10_total,
-            totals['debt_nal'],
-            round(totals['final_pay']),  # Округление до целого
+            grand_totals['stavka'],
+            grand_totals['lm_3'],
+            grand_totals['percent_5'],
+            grand_totals['promo'],
+            grand_totals['crz'],
+            grand_totals['cons'],
+            grand_totals['tips'],
+            grand_totals['total_shift'],
+            grand_totals['to_pay'],
+            grand_totals['debt'],
+            vychet_10_grand,
+            grand_totals['debt_nal'],
+            round(grand_totals['final_pay']),  # Округление до целого
             '',  # Самозанятость (пусто в ИТОГО)
             ''   # К выплате (самозанятый) (пусто в ИТОГО)
         ]
         
         for col, value in enumerate(itogo_data, 1):
-            cell = ws.cell(row=row_num, column=col, value=value)
+            cell = ws_itogo.cell(row=row_num, column=col, value=value)
             cell.font = Font(bold=True)
             cell.border = border
             if col > 4:  # Числовые столбцы (после Дата, Клуб, Код, Имя)
@@ -6659,8 +7062,8 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
             else:
                 cell.alignment = Alignment(horizontal='center', vertical='center')
         
-        # Автоподгонка ширины
-        for column in ws.columns:
+        # Автоподгонка ширины для листа ИТОГО
+        for column in ws_itogo.columns:
             max_length = 0
             column_letter = column[0].column_letter
             for cell in column:
@@ -6669,395 +7072,191 @@ async def generate_salary_excel_by_club(update: Update, clubs: List[str], date_f
                         max_length = max(max_length, len(str(cell.value)))
                 except:
                     pass
-            ws.column_dimensions[column_letter].width = min(max_length + 2, 20)
-        
-        return totals
-    
-    # === СНАЧАЛА СОЗДАЁМ ЛИСТ ИТОГО (будет первым) ===
-    # Создаём лист ИТОГО с группировкой по (код, имя)
-    employee_totals = {}
-    for payment in all_payments:
-        # НОРМАЛИЗАЦИЯ КОДА ПЕРЕД ГРУППИРОВКОЙ
-        normalized_code = DataParser.normalize_code(payment['code'])
-        
-        # Обработка кода для отображения
-        display_code = normalized_code
-        if display_code.startswith('СБ-'):
-            display_code = 'СБ'
-        elif display_code.startswith('Уборщица'):
-            display_code = 'Уборщица'
-        
-        key = (display_code, payment['name'])
-        if key not in employee_totals:
-            employee_totals[key] = {
-                'code': display_code,
-                'real_code': normalized_code,  # Нормализованный код для поиска в БД
-                'name': payment['name'],
-                'club': payment['club'],  # Сохраняем клуб
-                'stavka': 0, 'lm_3': 0, 'percent_5': 0, 'promo': 0,
-                'crz': 0, 'cons': 0, 'tips': 0, 'total_shift': 0,
-                'to_pay': 0, 'debt': 0, 'debt_nal': 0
-            }
-        
-        employee_totals[key]['stavka'] += payment['stavka']
-        employee_totals[key]['lm_3'] += payment['lm_3']
-        employee_totals[key]['percent_5'] += payment['percent_5']
-        employee_totals[key]['promo'] += payment['promo']
-        employee_totals[key]['crz'] += payment['crz']
-        employee_totals[key]['cons'] += payment['cons']
-        employee_totals[key]['tips'] += payment['tips']
-        employee_totals[key]['total_shift'] += payment['total_shift']
-        employee_totals[key]['to_pay'] += payment['to_pay']
-        employee_totals[key]['debt'] += payment['debt']
-        employee_totals[key]['debt_nal'] += payment['debt_nal']
-    
-    # Используем активный лист для ИТОГО (будет первым)
-    ws_itogo = wb.active
-    ws_itogo.title = "ИТОГО"
-    club_names = ', '.join(clubs)
-    ws_itogo['A1'] = f"Отчёт ЗП: {club_names}"
-    ws_itogo['A1'].font = Font(bold=True, size=14)
-    ws_itogo['A2'] = f"Период: {date_from} .. {date_to}"
-    ws_itogo['A2'].font = Font(size=11)
-    
-    row_num = 4
-    
-    # Шапка таблицы
-    for col, header in enumerate(headers, 1):
-        cell = ws_itogo.cell(row=row_num, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-        cell.border = border
-    row_num += 1
-    
-    # Итоговые суммы для листа ИТОГО
-    grand_totals = {
-        'stavka': 0, 'lm_3': 0, 'percent_5': 0, 'promo': 0,
-        'crz': 0, 'cons': 0, 'tips': 0, 'total_shift': 0,
-        'to_pay': 0, 'debt': 0, 'debt_nal': 0, 'final_pay': 0
-    }
-    
-    # Данные по сотрудникам
-    for key in sorted(employee_totals.keys()):
-        emp = employee_totals[key]
-        
-        # Получаем даты найма/увольнения
-        cursor_temp = conn_temp.cursor()
-        
-        # Используем реальный код и клуб из employee_totals
-        # Сначала проверяем employees
-        cursor_temp.execute("""
-            SELECT hired_date, fired_date, is_active
-            FROM employees
-            WHERE code = ? AND club = ?
-        """, (emp['real_code'], emp['club']))
-        
-        emp_row = cursor_temp.fetchone()
-        
-        if emp_row:
-            hired_date = emp_row[0]
-            fired_date = emp_row[1]
-            is_active = emp_row[2]
-        else:
-            # Проверяем employee_history (берём последнюю запись)
-            cursor_temp.execute("""
-                SELECT hired_date, fired_date
-                FROM employee_history
-                WHERE code = ? AND club = ?
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (emp['real_code'], emp['club']))
+            ws_itogo.column_dimensions[column_letter].width = min(max_length + 2, 20)
+        
+        # === ЛИСТ КАТЕГОРИИ (будет вторым) ===
+        ws_categories = wb.create_sheet(title="КАТЕГОРИИ", index=1)
+        
+        # Собираем данные из employee_totals (уже есть в коде)
+        # Фильтруем: исключаем СБ, УБОРЩИЦА, ДЖ*, К*
+        filtered_employees = []
+        for key, emp_data in employee_totals.items():
+            emp_code = emp_data['code']  # display_code
+            # Исключаем коды
+            if (emp_code.startswith('СБ') or emp_code == 'СБ') and emp_code != 'СБН':
+                continue  # Исключаем всех СБ КРОМЕ СБН
+            if 'УБОРЩИЦА' in emp_code.upper() or 'Уборщица' in emp_code:
+                continue
+            if emp_code.startswith('ДЖ'):
+                continue
+            if emp_code.startswith('К') and len(emp_code) > 1 and emp_code[1].isdigit():
+                continue
             
-            hist_row = cursor_temp.fetchone()
-            if hist_row:
-                hired_date = hist_row[0]
-                fired_date = hist_row[1]
-                is_active = 0
-            else:
-                hired_date = None
-                fired_date = None
-                is_active = 1
-        
-        # Форматируем даты
-        if hired_date:
-            try:
-                year, month, day = hired_date.split('-')
-                hired_str = f"{day}.{month}.{year[2:]}"
-            except:
-                hired_str = hired_date
-        else:
-            hired_str = '-'
-        
-        if fired_date:
-            try:
-                year, month, day = fired_date.split('-')
-                fired_str = f"{day}.{month}.{year[2:]}"
-            except:
-                fired_str = fired_date
-        else:
-            fired_str = '-'
-        
-        status_icon = '✅' if is_active else '🗂️'
-        
-        # Рассчитываем 10% и к выплате
-        vychet_10 = round(emp['debt'] * 0.1)  # Округление до целого
-        k_vyplate = round(emp['debt_nal'] + emp['debt'] - vychet_10)
-        
-        # Проверка самозанятости
-        normalized_code_for_check = emp['code'].upper().strip()
-        is_self_employed = db.is_self_employed(normalized_code_for_check)
-        
-        if is_self_employed:
-            self_employed_mark = '✓'
-            self_employed_payout = round(k_vyplate / 0.94, 2)
-        else:
-            self_employed_mark = ''
-            self_employed_payout = ''
-        
-        row_data = [
-            '',  # Дата пустая в ИТОГО
-            '',  # Клуб пустой в ИТОГО
-            emp['code'],
-            emp['name'],
-            emp['stavka'],
-            emp['lm_3'],
-            emp['percent_5'],
-            emp['promo'],
-            emp['crz'],
-            emp['cons'],
-            emp['tips'],
-            emp['total_shift'],
-            emp['to_pay'],
-            emp['debt'],
-            vychet_10,
-            emp['debt_nal'],
-            k_vyplate,
-            self_employed_mark,  # Самозанятость
-            self_employed_payout  # К выплате (самозанятый)
-        ]
-        
-        for col, value in enumerate(row_data, 1):
-            cell = ws_itogo.cell(row=row_num, column=col, value=value)
-            cell.border = border
-            if col > 4:  # Числовые столбцы (после Дата, Клуб, Код, Имя)
-                # Определяем индекс колонки "Самозанятость" (предпоследняя)
-                self_employed_col = len(headers) - 1
-                if col == self_employed_col:  # Колонка "Самозанятость" - по центру
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                else:
-                    cell.alignment = Alignment(horizontal='right', vertical='center')
-            else:
-                cell.alignment = Alignment(horizontal='center', vertical='center')
+            filtered_employees.append({
+                'code': emp_code,
+                'name': emp_data['name'],
+                'total': emp_data['total_shift']  # ИТОГО выплат
+            })
         
-        # Обновляем итоги
-        grand_totals['stavka'] += emp['stavka']
-        grand_totals['lm_3'] += emp['lm_3']
-        grand_totals['percent_5'] += emp['percent_5']
-        grand_totals['promo'] += emp['promo']
-        grand_totals['crz'] += emp['crz']
-        grand_totals['cons'] += emp['cons']
-        grand_totals['tips'] += emp['tips']
-        grand_totals['total_shift'] += emp['total_shift']
-        grand_totals['to_pay'] += emp['to_pay']
-        grand_totals['debt'] += emp['debt']
-        grand_totals['debt_nal'] += emp['debt_nal']
-        grand_totals['final_pay'] += k_vyplate
+        # Сортируем по сумме (по убыванию)
+        filtered_employees.sort(key=lambda x: x['total'], reverse=True)
         
-        row_num += 1
-    
-    # Строка ИТОГО в листе ИТОГО
-    vychet_10_grand = round(grand_totals['debt'] * 0.1)  # Округление до целого
-    
-    itogo_data = [
-        'ИТОГО', '', '', '',  # Дата, Клуб, Код, Имя
-        grand_totals['stavka'],
-        grand_totals['lm_3'],
-        grand_totals['percent_5'],
-        grand_totals['promo'],
-        grand_totals['crz'],
-        grand_totals['cons'],
-        grand_totals['tips'],
-        grand_totals['total_shift'],
-        grand_totals['to_pay'],
-        grand_totals['debt'],
-        vychet_10_grand,
-        grand_totals['debt_nal'],
-        round(grand_totals['final_pay']),  # Округление до целого
-        '',  # Самозанятость (пусто в ИТОГО)
-        ''   # К выплате (самозанятый) (пусто в ИТОГО)
-    ]
-    
-    for col, value in enumerate(itogo_data, 1):
-        cell = ws_itogo.cell(row=row_num, column=col, value=value)
-        cell.font = Font(bold=True)
-        cell.border = border
-        if col > 4:  # Числовые столбцы (после Дата, Клуб, Код, Имя)
-            # Определяем индекс колонки "Самозанятость" (предпоследняя)
-            self_employed_col = len(headers) - 1
-            if col == self_employed_col:  # Колонка "Самозанятость" - по центру
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-            else:
-                cell.alignment = Alignment(horizontal='right', vertical='center')
-        else:
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-    
-    # Автоподгонка ширины для листа ИТОГО
-    for column in ws_itogo.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            except:
-                pass
-        ws_itogo.column_dimensions[column_letter].width = min(max_length + 2, 20)
-    
-    # === ЛИСТ КАТЕГОРИИ (будет вторым) ===
-    ws_categories = wb.create_sheet(title="КАТЕГОРИИ", index=1)
-    
-    # Собираем данные из employee_totals (уже есть в коде)
-    # Фильтруем: исключаем СБ, УБОРЩИЦА, ДЖ*, К*
-    filtered_employees = []
-    for key, emp_data in employee_totals.items():
-        emp_code = emp_data['code']  # display_code
-        # Исключаем коды
-        if (emp_code.startswith('СБ') or emp_code == 'СБ') and emp_code != 'СБН':
-            continue  # Исключаем всех СБ КРОМЕ СБН
-        if 'УБОРЩИЦА' in emp_code.upper() or 'Уборщица' in emp_code:
-            continue
-        if emp_code.startswith('ДЖ'):
-            continue
-        if emp_code.startswith('К') and len(emp_code) > 1 and emp_code[1].isdigit():
-            continue
+        # Разбиваем на категории
+        cat_1 = [e for e in filtered_employees if e['total'] < 200000]  # < 200k
+        cat_2 = [e for e in filtered_employees if 200000 <= e['total'] < 350000]  # 200-350k
+        cat_3 = [e for e in filtered_employees if 350000 <= e['total'] < 450000]  # 350-450k
+        cat_4 = [e for e in filtered_employees if e['total'] >= 450000]  # > 450k
         
-        filtered_employees.append({
-            'code': emp_code,
-            'name': emp_data['name'],
-            'total': emp_data['total_shift']  # ИТОГО выплат
-        })
-    
-    # Сортируем по сумме (по убыванию)
-    filtered_employees.sort(key=lambda x: x['total'], reverse=True)
-    
-    # Разбиваем на категории
-    cat_1 = [e for e in filtered_employees if e['total'] < 200000]  # < 200k
-    cat_2 = [e for e in filtered_employees if 200000 <= e['total'] < 350000]  # 200-350k
-    cat_3 = [e for e in filtered_employees if 350000 <= e['total'] < 450000]  # 350-450k
-    cat_4 = [e for e in filtered_employees if e['total'] >= 450000]  # > 450k
-    
-    # Стили
-    category_header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    category_header_font = Font(bold=True, color="FFFFFF", size=11)
-    category_fill_1 = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")  # Красный
-    category_fill_2 = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")  # Жёлтый
-    category_fill_3 = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")  # Зелёный
-    category_fill_4 = PatternFill(start_color="9BC2E6", end_color="9BC2E6", fill_type="solid")  # Синий
-    category_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Заголовок
-    ws_categories['A1'] = "КАТЕГОРИИ СОТРУДНИКОВ"
-    ws_categories['A1'].font = Font(bold=True, size=14)
-    ws_categories['A2'] = f"Период: {date_from} .. {date_to}"
-    ws_categories['A2'].font = Font(size=11)
-    
-    row_num = 4
-    
-    # Функция для добавления категории
-    def add_category(ws, start_row, title, employees, fill_color):
-        # Заголовок категории
-        ws.cell(row=start_row, column=1, value=title).font = Font(bold=True, size=12)
-        start_row += 1
+        # Стили
+        category_header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+        category_header_font = Font(bold=True, color="FFFFFF", size=11)
+        category_fill_1 = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")  # Красный
+        category_fill_2 = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")  # Жёлтый
+        category_fill_3 = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")  # Зелёный
+        category_fill_4 = PatternFill(start_color="9BC2E6", end_color="9BC2E6", fill_type="solid")  # Синий
+        category_border = Border(
+            left=Side(style='thin'),
+            right=Side(style='thin'),
+            top=Side(style='thin'),
+            bottom=Side(style='thin')
+        )
         
-        # Шапка таблицы
-        headers = ['КОД', 'ИМЯ', 'ИТОГО']
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=start_row, column=col, value=header)
-            cell.font = category_header_font
-            cell.fill = category_header_fill
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.border = category_border
-        start_row += 1
+        # Заголовок
+        ws_categories['A1'] = "КАТЕГОРИИ СОТРУДНИКОВ"
+        ws_categories['A1'].font = Font(bold=True, size=14)
+        ws_categories['A2'] = f"Период: {date_from} .. {date_to}"
+        ws_categories['A2'].font = Font(size=11)
         
-        # Данные
-        total_sum = 0
-        for emp in employees:
-            row_data = [emp['code'], emp['name'], emp['total']]
-            for col, value in enumerate(row_data, 1):
-                cell = ws.cell(row=start_row, column=col, value=value)
-                cell.fill = fill_color
-                cell.border = category_border
-                if col == 3:  # Сумма
-                    cell.alignment = Alignment(horizontal='right', vertical='center')
-                    cell.number_format = '#,##0'
-                else:
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
+        row_num = 4
+        
+        # Функция для добавления категории
+        def add_category(ws, start_row, title, employees, fill_color):
+            # Заголовок категории
+            ws.cell(row=start_row, column=1, value=title).font = Font(bold=True, size=12)
+            start_row += 1
             
-            total_sum += emp['total']
+            # Шапка таблицы
+            headers = ['КОД', 'ИМЯ', 'ИТОГО']
+            for col, header in enumerate(headers, 1):
+                cell = ws.cell(row=start_row, column=col, value=header)
+                cell.font = category_header_font
+                cell.fill = category_header_fill
+                cell.alignment = Alignment(horizontal='center', vertical='center')
+                cell.border = category_border
             start_row += 1
+            
+            # Данные
+            total_sum = 0
+            for emp in employees:
+                row_data = [emp['code'], emp['name'], emp['total']]
+                for col, value in enumerate(row_data, 1):
+                    cell = ws.cell(row=start_row, column=col, value=value)
+                    cell.fill = fill_color
+                    cell.border = category_border
+                    if col == 3:  # Сумма
+                        cell.alignment = Alignment(horizontal='right', vertical='center')
+                        cell.number_format = '#,##0'
+                    else:
+                        cell.alignment = Alignment(horizontal='center', vertical='center')
+                
+                total_sum += emp['total']
+                start_row += 1
+            
+            # Итого по категории
+            ws.cell(row=start_row, column=1, value=f"Всего: {len(employees)} чел.").font = Font(bold=True)
+            total_cell = ws.cell(row=start_row, column=3, value=total_sum)
+            total_cell.font = Font(bold=True)
+            total_cell.number_format = '#,##0'
+            total_cell.alignment = Alignment(horizontal='right')
+            start_row += 2
+            
+            return start_row
         
-        # Итого по категории
-        ws.cell(row=start_row, column=1, value=f"Всего: {len(employees)} чел.").font = Font(bold=True)
-        total_cell = ws.cell(row=start_row, column=3, value=total_sum)
-        total_cell.font = Font(bold=True)
-        total_cell.number_format = '#,##0'
-        total_cell.alignment = Alignment(horizontal='right')
-        start_row += 2
+        # Добавляем категории
+        row_num = add_category(ws_categories, row_num, "🔴 МЕНЬШЕ 200,000₽", cat_1, category_fill_1)
+        row_num = add_category(ws_categories, row_num, "🟡 ОТ 200,000₽ ДО 350,000₽", cat_2, category_fill_2)
+        row_num = add_category(ws_categories, row_num, "🟢 ОТ 350,000₽ ДО 450,000₽", cat_3, category_fill_3)
+        row_num = add_category(ws_categories, row_num, "💎 БОЛЬШЕ 450,000₽", cat_4, category_fill_4)
         
-        return start_row
-    
-    # Добавляем категории
-    row_num = add_category(ws_categories, row_num, "🔴 МЕНЬШЕ 200,000₽", cat_1, category_fill_1)
-    row_num = add_category(ws_categories, row_num, "🟡 ОТ 200,000₽ ДО 350,000₽", cat_2, category_fill_2)
-    row_num = add_category(ws_categories, row_num, "🟢 ОТ 350,000₽ ДО 450,000₽", cat_3, category_fill_3)
-    row_num = add_category(ws_categories, row_num, "💎 БОЛЬШЕ 450,000₽", cat_4, category_fill_4)
-    
-    # Автоподгонка ширины
-    for column in ws_categories.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
+        # Автоподгонка ширины
+        for column in ws_categories.columns:
+            max_length = 0
+            column_letter = column[0].column_letter
+            for cell in column:
+                try:
+                    if cell.value:
+                        max_length = max(max_length, len(str(cell.value)))
+                except:
+                    pass
+            ws_categories.column_dimensions[column_letter].width = min(max_length + 2, 30)
+        
+        # === СОЗДАЁМ ЛИСТЫ ПО ДАТАМ (будут после ИТОГО и КАТЕГОРИЙ) ===
+        for date in sorted(payments_by_date.keys()):
             try:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
+                year, month, day = date.split('-')
+                sheet_name = f"{day}.{month}.{year[2:]}"
             except:
-                pass
-        ws_categories.column_dimensions[column_letter].width = min(max_length + 2, 30)
-    
-    # === СОЗДАЁМ ЛИСТЫ ПО ДАТАМ (будут после ИТОГО и КАТЕГОРИЙ) ===
-    for date in sorted(payments_by_date.keys()):
-        try:
-            year, month, day = date.split('-')
-            sheet_name = f"{day}.{month}.{year[2:]}"
-        except:
-            sheet_name = date
+                sheet_name = date
+            
+            ws = wb.create_sheet(title=sheet_name)
+            create_sheet(ws, sheet_name, payments_by_date[date], show_date_col=True)
         
-        ws = wb.create_sheet(title=sheet_name)
-        create_sheet(ws, sheet_name, payments_by_date[date], show_date_col=True)
+        # Сохраняем и отправляем
+        wb.save(filepath)
+        conn_temp.close()
     
-    # Сохраняем и отправляем
-    club_str = '_'.join([c.lower() for c in clubs])
-    filename = f"zp_{club_str}_{date_from}_{date_to}.xlsx"
-    wb.save(filename)
+    await asyncio.to_thread(build_workbook)
     
-    with open(filename, 'rb') as f:
+    with open(filepath, 'rb') as f:
         await update.message.reply_document(
             document=f,
             filename=filename,
             caption=f"💵 Отчёт ЗП: {club_names}\nПериод: {date_from} .. {date_to}"
         )
     
-    # Закрываем соединение
-    conn_temp.close()
-    
     import os
-    os.remove(filename)
+    os.remove(filepath)
+
+
+# Кнопки выбора клуба -> название клуба
+CLUB_CALLBACKS = {
+    'club_moskvich': 'Москвич',
+    'club_anora': 'Анора'
+}
+
+
+async def handle_club_select_callback(query, state: UserState, club: str):
+    """Выбор клуба кнопкой: загрузка файла, загрузка ЗП или обычный старт"""
+    if state.mode == 'awaiting_upload_club':
+        state.upload_file_club = club
+        await query.edit_message_text(
+            f"📎 ЗАГРУЗКА ФАЙЛА\n"
+            f"🏢 Клуб: {club}\n\n"
+            f"📅 Введите дату для этих данных:\n"
+            f"Формат: 3,11 или 30,10"
+        )
+        state.mode = 'awaiting_upload_date'
+    elif state.mode == 'awaiting_payments_upload_club':
+        state.payments_upload_club = club
+        await query.edit_message_text(
+            f"💰 ЗАГРУЗКА ЗП\n"
+            f"🏢 Клуб: {club}\n\n"
+            f"📅 Введите дату (формат: 30,10 или 28,12,25):"
+        )
+        state.mode = 'awaiting_payments_upload_date'
+    else:
+        state.club = club
+        state.current_date = get_current_date()
+        state.reset_input()
+        
+        await query.edit_message_text(
+            f"✅ Выбран клуб: {club}\n"
+            f"📅 Дата: {state.current_date}"
+        )
+        await query.message.reply_text(
+            "Используйте кнопки ниже для работы:",
+            reply_markup=MAIN_KEYBOARD
+        )
 
 
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -7065,7 +7264,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     
     user_id = update.effective_user.id
-    state = get_user_state(user_id)
+    state = get_user_state(context, user_id)
     
     # Проверка авторизации
     if not db.is_admin(user_id) and not state.employee_mode and not state.owner_mode and not state.limited_access:
@@ -7086,81 +7285,13 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     # Выбор клуба при старте
-    if query.data == 'club_moskvich':
-        # Блокируем для ограниченного доступа
-        if state.limited_access:
-            await query.answer("❌ Доступ запрещён", show_alert=True)
-            return
-        
-        # Проверяем режим - загрузка файла, загрузка ЗП или обычный старт
-        if state.mode == 'awaiting_upload_club':
-            state.upload_file_club = 'Москвич'
-            await query.edit_message_text(
-                f"📎 ЗАГРУЗКА ФАЙЛА\n"
-                f"🏢 Клуб: Москвич\n\n"
-                f"📅 Введите дату для этих данных:\n"
-                f"Формат: 3,11 или 30,10"
-            )
-            state.mode = 'awaiting_upload_date'
-        elif state.mode == 'awaiting_payments_upload_club':
-            state.payments_upload_club = 'Москвич'
-            await query.edit_message_text(
-                f"💰 ЗАГРУЗКА ЗП\n"
-                f"🏢 Клуб: Москвич\n\n"
-                f"📅 Введите дату (формат: 30,10 или 28,12,25):"
-            )
-            state.mode = 'awaiting_payments_upload_date'
-        else:
-            state.club = 'Москвич'
-            state.current_date = get_current_date()
-            state.reset_input()
-            
-            await query.edit_message_text(
-                f"✅ Выбран клуб: Москвич\n"
-                f"📅 Дата: {state.current_date}"
-            )
-            await query.message.reply_text(
-                "Используйте кнопки ниже для работы:",
-                reply_markup=get_main_keyboard()
-            )
-    
-    elif query.data == 'club_anora':
+    if query.data in CLUB_CALLBACKS:
         # Блокируем для ограниченного доступа
         if state.limited_access:
             await query.answer("❌ Доступ запрещён", show_alert=True)
             return
         
-        # Проверяем режим - загрузка файла, загрузка ЗП или обычный старт
-        if state.mode == 'awaiting_upload_club':
-            state.upload_file_club = 'Анора'
-            await query.edit_message_text(
-                f"📎 ЗАГРУЗКА ФАЙЛА\n"
-                f"🏢 Клуб: Анора\n\n"
-                f"📅 Введите дату для этих данных:\n"
-                f"Формат: 3,11 или 30,10"
-            )
-            state.mode = 'awaiting_upload_date'
-        elif state.mode == 'awaiting_payments_upload_club':
-            state.payments_upload_club = 'Анора'
-            await query.edit_message_text(
-                f"💰 ЗАГРУЗКА ЗП\n"
-                f"🏢 Клуб: Анора\n\n"
-                f"📅 Введите дату (формат: 30,10 или 28,12,25):"
-            )
-            state.mode = 'awaiting_payments_upload_date'
-        else:
-            state.club = 'Анора'
-            state.current_date = get_current_date()
-            state.reset_input()
-            
-            await query.edit_message_text(
-                f"✅ Выбран клуб: Анора\n"
-                f"📅 Дата: {state.current_date}"
-            )
-            await query.message.reply_text(
-                "Используйте кнопки ниже для работы:",
-                reply_markup=get_main_keyboard()
-            )
+        await handle_club_select_callback(query, state, CLUB_CALLBACKS[query.data])
     
     # Выбор режима удаления
     elif query.data == 'delete_mode_employee':
@@ -7177,7 +7308,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         state.mode = 'awaiting_delete_mass_club'
         await query.edit_message_text(
             "🏢 Выберите клуб для удаления:",
-            reply_markup=get_club_report_keyboard()
+            reply_markup=CLUB_REPORT_KEYBOARD
         )
     
     # Меню управления сотрудниками
@@ -7186,7 +7317,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text(
             "🔗 ОБЪЕДИНЕНИЕ СОТРУДНИКОВ\n\n"
             "Выберите клуб:",
-            reply_markup=get_club_employees_keyboard()
+            reply_markup=CLUB_EMPLOYEES_KEYBOARD
         )
     
     elif query.data == 'employees_add':
@@ -7234,7 +7365,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text(
             "👥 УПРАВЛЕНИЕ СОТРУДНИКАМИ\n\n"
             "Выберите действие:",
-            reply_markup=get_employees_menu_keyboard()
+            reply_markup=EMPLOYEES_MENU_KEYBOARD
         )
     
     elif query.data == 'employees_cancel':
@@ -7286,7 +7417,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime
         cursor.execute("""
             UPDATE employees
             SET telegram_user_id = NULL, updated_at = ?
@@ -7295,6 +7425,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         await query.edit_message_text(
             f"✅ ДОСТУП УДАЛЁН\n\n"
@@ -7338,7 +7469,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime
         today = datetime.now().strftime('%Y-%m-%d')
         
         cursor.execute("""
@@ -7349,6 +7479,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         await query.edit_message_text(
             f"✅ СОТРУДНИК УВОЛЕН\n\n"
@@ -7374,7 +7505,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime
         cursor.execute("""
             UPDATE employees
             SET is_active = 1, fired_date = NULL, updated_at = ?
@@ -7383,6 +7513,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         await query.edit_message_text(
             f"✅ СОТРУДНИК ВОЗВРАЩЁН\n\n"
@@ -7417,18 +7548,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         await query.edit_message_text("⏳ Сохраняю данные в базу...")
         
-        # СНАЧАЛА УДАЛЯЕМ ВСЕ СТАРЫЕ ЗАПИСИ ДЛЯ ЭТОЙ ДАТЫ И КЛУБА
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            DELETE FROM payments 
-            WHERE club = ? AND date = ?
-        """, (state.payments_upload_club, state.payments_upload_date))
-        conn.commit()
-        conn.close()
-        
-        print(f"DEBUG: Deleted old payments for {state.payments_upload_club} {state.payments_upload_date}")
-        
         # При сохранении применяем КАНОНИЧЕСКИЕ имена (из БД)
         if state.name_changes_data:
             for change in state.name_changes_data:
@@ -7438,28 +7557,14 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                         pay['name'] = change['old_name']  # ← ИМЯ ИЗ БД!
                         print(f"DEBUG: Applied canonical name: {change['code']} '{change['new_name']}' → '{change['old_name']}'")
         
-        # ПОТОМ ВСТАВЛЯЕМ НОВЫЕ
-        saved_count = 0
-        for payment in state.payments_preview_data:
-            db.add_payment(
-                club=state.payments_upload_club,
-                date=state.payments_upload_date,
-                code=payment['code'],
-                name=payment['name'],
-                stavka=payment['stavka'],
-                lm_3=payment['lm_3'],
-                percent_5=payment['percent_5'],
-                promo=payment['promo'],
-                crz=payment['crz'],
-                cons=payment['cons'],
-                tips=payment['tips'],
-                fines=payment['fines'],
-                total_shift=payment['total_shift'],
-                debt=payment['debt'],
-                debt_nal=payment['debt_nal'],
-                to_pay=payment['to_pay']
-            )
-            saved_count += 1
+        # Удаляем старые записи за дату и клуб и вставляем новые одной транзакцией
+        saved_count = await asyncio.to_thread(
+            db.replace_payments,
+            state.payments_upload_club,
+            state.payments_upload_date,
+            state.payments_preview_data
+        )
+        print(f"DEBUG: Replaced payments for {state.payments_upload_club} {state.payments_upload_date}")
         
         # ============================================
         # АВТОМАТИЧЕСКОЕ ДОБАВЛЕНИЕ НОВЫХ СОТРУДНИКОВ
@@ -7480,7 +7585,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                     
                     if cursor.fetchone() is None:
                         # Добавляем нового сотрудника
-                        from datetime import datetime
                         cursor.execute("""
                             INSERT INTO employees 
                             (code, club, full_name, hired_date, is_active, created_at)
@@ -7495,6 +7599,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             
             conn.commit()
             conn.close()
+            db.invalidate_identity_cache()
             
             if added_count > 0:
                 print(f"[INFO] Автоматически добавлено новых сотрудников: {added_count}")
@@ -7715,7 +7820,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime
         today = datetime.now().strftime('%Y-%m-%d')
         now = datetime.now().isoformat()
         
@@ -7763,7 +7867,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         conn = db.get_connection()
         cursor = conn.cursor()
         
-        from datetime import datetime, timedelta
         file_date = datetime.strptime(state.payments_upload_date, '%Y-%m-%d')
         yesterday = (file_date - timedelta(days=1)).strftime('%Y-%m-%d')
         today = file_date.strftime('%Y-%m-%d')
@@ -7792,6 +7895,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         conn.commit()
         conn.close()
+        db.invalidate_identity_cache()
         
         # Переходим к следующему (тот же код что в name_change_same)
         state.name_changes_index += 1
@@ -7999,7 +8103,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     elif query.data == 'stylist_done':
         # Кнопка ГОТОВО для стилистов
         user_id = update.effective_user.id
-        state = get_user_state(user_id)
+        state = get_user_state(context, user_id)
         
         if state.mode != 'awaiting_stylist_data':
             await query.answer("⚠️ Режим ввода данных стилистов не активен", show_alert=True)
@@ -8066,7 +8170,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             period_to = parts[-1]
             
             user_id = query.from_user.id
-            state = get_user_state(user_id)
+            state = get_user_state(context, user_id)
             state.stylist_view_club = club
             state.stylist_view_from = period_from
             state.stylist_view_to = period_to
@@ -8091,7 +8195,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             period_to = parts[-1]
             
             user_id = query.from_user.id
-            state = get_user_state(user_id)
+            state = get_user_state(context, user_id)
             state.stylist_view_club = club
             state.stylist_view_from = period_from
             state.stylist_view_to = period_to
@@ -8321,54 +8425,39 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     
     elif query.data == 'merge_show_list':
         if state.mode == 'awaiting_merge_confirm' and state.merge_candidates:
-            # Показываем список частями (по 15 записей)
+            # Показываем список частями (до TELEGRAM_CHUNK_SIZE символов в сообщении)
             await query.answer("📄 Отправляю список...")
-            candidates = state.merge_candidates
-            chunk_size = 15
-            
-            for chunk_start in range(0, len(candidates), chunk_size):
-                chunk = candidates[chunk_start:chunk_start + chunk_size]
-                response = [f"📋 Совпадения ({chunk_start + 1}-{min(chunk_start + chunk_size, len(candidates))} из {len(candidates)}):\n"]
-                
-                for i, candidate in enumerate(chunk, chunk_start + 1):
-                    response.append(f"{i}. {candidate['name']} {candidate['code']}")
-                    response.append(f"   • Москвич: НАЛ {candidate['moskvich']['nal']:.0f}, БЕЗНАЛ {candidate['moskvich']['beznal']:.0f}")
-                    response.append(f"   • Анора: НАЛ {candidate['anora']['nal']:.0f}, БЕЗНАЛ {candidate['anora']['beznal']:.0f}")
-                    response.append("")
-                
-                await query.message.reply_text('\n'.join(response))
+            records = [
+                f"{i}. {candidate['name']} {candidate['code']}\n"
+                f"   • Москвич: НАЛ {candidate['moskvich']['nal']:.0f}, БЕЗНАЛ {candidate['moskvich']['beznal']:.0f}\n"
+                f"   • Анора: НАЛ {candidate['anora']['nal']:.0f}, БЕЗНАЛ {candidate['anora']['beznal']:.0f}\n\n"
+                for i, candidate in enumerate(state.merge_candidates, 1)
+            ]
+            await reply_text_chunks(query.message, chunk_records(records, "📋 Совпадения ({start}-{end} из {total}):\n\n"))
         elif state.mode == 'awaiting_sb_merge_confirm' and state.sb_merge_data:
             # Показываем список СБ частями
             await query.answer("📄 Отправляю список...")
-            sb_duplicates = state.sb_merge_data['sb_duplicates']
-            chunk_size = 15
+            records = []
             
-            for chunk_start in range(0, len(sb_duplicates), chunk_size):
-                chunk = sb_duplicates[chunk_start:chunk_start + chunk_size]
-                response = [f"📋 СБ с похожими именами ({chunk_start + 1}-{min(chunk_start + chunk_size, len(sb_duplicates))} из {len(sb_duplicates)}):\n"]
+            for i, group in enumerate(state.sb_merge_data['sb_duplicates'], 1):
+                similarity_pct = int(group['similarity'] * 100)
+                buf = io.StringIO()
+                buf.write(f"{i}. Группа: {group['main_name']} (Похожесть: {similarity_pct}%)\n")
                 
-                for i, group in enumerate(chunk, chunk_start + 1):
-                    similarity_pct = int(group['similarity'] * 100)
-                    response.append(f"{i}. Группа: {group['main_name']} (Похожесть: {similarity_pct}%)")
-                    
-                    # Группируем операции по именам
-                    by_name = {}
-                    for op in group['operations']:
-                        name = op['name']
-                        if name not in by_name:
-                            by_name[name] = {'nal': 0, 'beznal': 0}
-                        if op['channel'] == 'нал':
-                            by_name[name]['nal'] += op['amount']
-                        else:
-                            by_name[name]['beznal'] += op['amount']
-                    
-                    for name in group['names']:
-                        if name in by_name:
-                            response.append(f"   • {name}: НАЛ {by_name[name]['nal']:.0f}, БЕЗНАЛ {by_name[name]['beznal']:.0f}")
-                    response.append(f"   ИТОГО: НАЛ {group['total_nal']:.0f}, БЕЗНАЛ {group['total_beznal']:.0f}")
-                    response.append("")
+                # Суммы по именам посчитаны при поиске группы
+                by_name = group['by_name']
                 
-                await query.message.reply_text('\n'.join(response))
+                # Большую группу обрезаем, чтобы запись поместилась в одно сообщение
+                for name in group['names'][:SB_GROUP_NAMES_SHOWN]:
+                    if name in by_name:
+                        buf.write(f"   • {name}: НАЛ {by_name[name]['nal']:.0f}, БЕЗНАЛ {by_name[name]['beznal']:.0f}\n")
+                hidden = len(group['names']) - SB_GROUP_NAMES_SHOWN
+                if hidden > 0:
+                    buf.write(f"   … и ещё {hidden} (полный список в файле)\n")
+                buf.write(f"   ИТОГО: НАЛ {group['total_nal']:.0f}, БЕЗНАЛ {group['total_beznal']:.0f}\n\n")
+                records.append(buf.getvalue())
+            
+            await reply_text_chunks(query.message, chunk_records(records, "📋 СБ с похожими именами ({start}-{end} из {total}):\n\n"))
         else:
             await query.answer("❌ Ошибка: данные не найдены", show_alert=True)
     
@@ -8384,7 +8473,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         cursor.execute("""
             SELECT date, club, stavka, lm_3, percent_5, promo, crz, cons, tips, 
-                   fines, total_shift, debt, debt_nal, to_pay
+                   fines, total_shift, COALESCE(debt, 0), COALESCE(debt_nal, 0), COALESCE(to_pay, 0)
             FROM payments
             WHERE code = ?
             ORDER BY date DESC
@@ -8401,39 +8490,14 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             )
             return
         
-        date, club, stavka, lm_3, percent_5, promo, crz, cons, tips, fines, total_shift, debt, debt_nal, to_pay = row
-        
-        # Пересчитываем К выплате
-        vychet_10 = round(debt * 0.1) if debt else 0
-        k_vyplate = round((debt_nal or 0) + (debt or 0) - vychet_10)
-        
-        msg = (
+        date, club = row[0], row[1]
+        msg = format_salary_message(
             f"💰 ВАША ПОСЛЕДНЯЯ ЗП\n\n"
             f"📅 Дата: {date}\n"
             f"🏢 Клуб: {club}\n"
             f"💼 Код: {state.employee_code}\n"
-            f"👤 {state.employee_name}\n\n"
-            f"━━━━━━━━━━━━━━━━━━━\n"
-            f"💵 Ставка: {int(stavka)}\n"
-            f"📊 3% ЛМ: {int(lm_3)}\n"
-            f"📊 5%: {int(percent_5)}\n"
-            f"🎉 Промо: {int(promo)}\n"
-            f"🍽 CRZ: {int(crz)}\n"
-            f"🥂 Cons: {int(cons)}\n"
-            f"💸 Чаевые: {int(tips)}\n"
-        )
-        
-        if fines:
-            msg += f"⚠️ Штрафы: {int(fines)}\n"
-        
-        msg += (
-            f"━━━━━━━━━━━━━━━━━━━━━\n"
-            f"💰 ИТОГО выплат: {int(total_shift)}\n"
-            f"💵 Получила на смене: {int(to_pay or 0)}\n"
-            f"📋 Долг БН: {int(debt or 0)}\n"
-            f"📋 Долг НАЛ: {int(debt_nal or 0)}\n"
-            f"━━━━━━━━━━━━━━━━━━━\n"
-            f"💎 К ВЫПЛАТЕ: {k_vyplate} ₽\n"
+            f"👤 {state.employee_name}\n\n",
+            *row[2:], wide_rule=True
         )
         
         await query.edit_message_text(msg)
@@ -8589,7 +8653,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         cursor.execute("""
             SELECT date, club, stavka, lm_3, percent_5, promo, crz, cons, tips, 
-                   fines, total_shift, debt, debt_nal, to_pay
+                   fines, total_shift, COALESCE(debt, 0), COALESCE(debt_nal, 0), COALESCE(to_pay, 0)
             FROM payments
             WHERE code = ? AND date = ?
             ORDER BY club
@@ -8610,39 +8674,14 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Обрабатываем все записи (может быть несколько клубов)
         for idx, row in enumerate(rows):
-            date, club, stavka, lm_3, percent_5, promo, crz, cons, tips, fines, total_shift, debt, debt_nal, to_pay = row
-            
-            # Пересчитываем К выплате
-            vychet_10 = round(debt * 0.1) if debt else 0
-            k_vyplate = round((debt_nal or 0) + (debt or 0) - vychet_10)
-            
-            msg = (
+            date, club = row[0], row[1]
+            msg = format_salary_message(
                 f"💰 ЗП ЗА {date_str}\n\n"
                 f"🏢 Клуб: {club}\n"
                 f"📅 Дата: {date}\n"
                 f"💼 Код: {state.employee_code}\n"
-                f"👤 {state.employee_name}\n\n"
-                f"━━━━━━━━━━━━━━━━━━━\n"
-                f"💵 Ставка: {int(stavka)}\n"
-                f"📊 3% ЛМ: {int(lm_3)}\n"
-                f"📊 5%: {int(percent_5)}\n"
-                f"🎉 Промо: {int(promo)}\n"
-                f"🍽 CRZ: {int(crz)}\n"
-                f"🥂 Cons: {int(cons)}\n"
-                f"💸 Чаевые: {int(tips)}\n"
-            )
-            
-            if fines:
-                msg += f"⚠️ Штрафы: {int(fines)}\n"
-            
-            msg += (
-                f"━━━━━━━━━━━━━━━━━━━\n"
-                f"💰 ИТОГО выплат: {int(total_shift)}\n"
-                f"💵 Получила на смене: {int(to_pay or 0)}\n"
-                f"📋 Долг БН: {int(debt or 0)}\n"
-                f"📋 Долг НАЛ: {int(debt_nal or 0)}\n"
-                f"━━━━━━━━━━━━━━━━━━━\n"
-                f"💎 К ВЫПЛАТЕ: {k_vyplate} ₽\n"
+                f"👤 {state.employee_name}\n\n",
+                *row[2:]
             )
             
             # Первую запись редактируем в текущем сообщении, остальные отправляем отдельными
@@ -8999,7 +9038,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Генерируем полный Excel
         from excel_processor import ExcelProcessor
-        from datetime import datetime
         excel_processor = ExcelProcessor()
         
         # Конвертируем date_str в datetime
@@ -10110,22 +10148,25 @@ def format_report_summary(totals: Dict, club_name: str, period: str,
     employee_count: количество сотрудников
     merged_count: количество объединённых дубликатов (если есть)
     """
-    lines = []
-    lines.append("✅ ОТЧЁТ ГОТОВ!\n")
-    lines.append(f"🏢 Клуб: {club_name}")
-    lines.append(f"📅 Период: {period}")
-    lines.append(f"👥 Сотрудников: {employee_count}")
+    lines = [
+        "✅ ОТЧЁТ ГОТОВ!\n",
+        f"🏢 Клуб: {club_name}",
+        f"📅 Период: {period}",
+        f"👥 Сотрудников: {employee_count}",
+    ]
     
     if merged_count > 0:
         lines.append(f"🔄 Объединено дубликатов: {merged_count}")
     
-    lines.append("\n💰 ИТОГО:")
-    lines.append(f"   НАЛ:      {totals['nal']:,.0f}".replace(',', ' '))
-    lines.append(f"   БЕЗНАЛ:   {totals['beznal']:,.0f}".replace(',', ' '))
-    lines.append(f"   10%:      {totals['minus10']:,.0f}".replace(',', ' '))
-    lines.append(f"   {'─' * 25}")
-    lines.append(f"   ИТОГО:    {totals['itog']:,.0f}".replace(',', ' '))
-    lines.append("\n📄 Детальный отчёт в Excel файле ⬇️")
+    lines += (
+        "\n💰 ИТОГО:",
+        f"   НАЛ:      {format_amount(totals['nal'])}",
+        f"   БЕЗНАЛ:   {format_amount(totals['beznal'])}",
+        f"   10%:      {format_amount(totals['minus10'])}",
+        f"   {'─' * 25}",
+        f"   ИТОГО:    {format_amount(totals['itog'])}",
+        "\n📄 Детальный отчёт в Excel файле ⬇️",
+    )
     
     return '\n'.join(lines)
 
@@ -10262,7 +10303,7 @@ async def handle_self_employed_command(update: Update, context: ContextTypes.DEF
     
     await update.message.reply_text(
         message,
-        reply_markup=get_self_employed_action_keyboard()
+        reply_markup=SELF_EMPLOYED_KEYBOARD
     )
 
 
@@ -10498,7 +10539,7 @@ async def handle_stylist_confirm(update: Update, state: UserState, text_lower: s
             f"📅 Период: {state.stylist_period_from} - {state.stylist_period_to}\n"
             f"📝 Записей: {success_count}\n"
             f"💰 Итого: {total_amount}₽",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
         
         # Очищаем state
@@ -10902,6 +10943,15 @@ async def restore_sb_names_command(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text(f"❌ Ошибка при восстановлении: {str(e)}")
 
 
+# Иконка и шаблон текста для типов действий журнала
+JOURNAL_ACTIONS = {
+    'delete': ("🗑️", "Удалено: {old_value:.0f}"),
+    'manual_update': ("✏️", "Исправлено: {old_value:.0f} → {new_value:.0f}"),
+    'update': ("➕", "Добавлено: {old_value:.0f} + ... = {new_value:.0f}"),
+    'replace': ("🔄", "Заменено: {old_value:.0f} → {new_value:.0f}"),
+}
+
+
 async def handle_journal_command(update: Update, context: ContextTypes.DEFAULT_TYPE, 
                                  state: UserState, text: str):
     """Обработка команды журнал"""
@@ -10916,16 +10966,11 @@ async def handle_journal_command(update: Update, context: ContextTypes.DEFAULT_T
     # Примеры: журнал, журнал 50, журнал Д7, журнал 3,10, журнал Д7 3,10
     
     if len(parts) >= 2:
-        # Проверяем второй параметр
-        if parts[1].isdigit():
-            limit = int(parts[1])
-            if limit > 100:
-                limit = 100  # Максимум 100
-        else:
+        # Проверяем второй параметр: число - это количество записей
+        try:
+            limit = min(max(int(parts[1]), 1), 100)  # От 1 до 100
+        except ValueError:
             # Это может быть код или дата
-            from parser import DataParser
-            from utils import parse_short_date
-            
             # Пробуем как код
             if DataParser.is_code(parts[1]):
                 code = DataParser.normalize_code(parts[1])
@@ -10937,9 +10982,6 @@ async def handle_journal_command(update: Update, context: ContextTypes.DEFAULT_T
     
     if len(parts) >= 3:
         # Третий параметр
-        from parser import DataParser
-        from utils import parse_short_date
-        
         if DataParser.is_code(parts[2]):
             code = DataParser.normalize_code(parts[2])
         else:
@@ -10982,22 +11024,14 @@ async def handle_journal_command(update: Update, context: ContextTypes.DEFAULT_T
         
         action_type = log['action']
         
-        # Определяем иконку по типу действия
-        if 'merge' in action_type:
-            icon = "🔄"
-            action_text = log['action'].replace('merge_name: ', '')
-        elif action_type == 'delete':
-            icon = "🗑️"
-            action_text = f"Удалено: {log['old_value']:.0f}"
-        elif action_type == 'manual_update':
-            icon = "✏️"
-            action_text = f"Исправлено: {log['old_value']:.0f} → {log['new_value']:.0f}"
-        elif action_type == 'update':
-            icon = "➕"
-            action_text = f"Добавлено: {log['old_value']:.0f} + ... = {log['new_value']:.0f}"
-        elif action_type == 'replace':
+        # Определяем иконку и текст по типу действия
+        known = JOURNAL_ACTIONS.get(action_type)
+        if known:
+            icon, template = known
+            action_text = template.format_map(log)
+        elif action_type.startswith('merge_name: '):
             icon = "🔄"
-            action_text = f"Заменено: {log['old_value']:.0f} → {log['new_value']:.0f}"
+            action_text = action_type[len('merge_name: '):]
         else:
             icon = "📝"
             action_text = action_type
@@ -11022,31 +11056,56 @@ def check_internal_duplicates(nal_data: list, beznal_data: list) -> list:
     Проверка дубликатов внутри вводимых данных
     Возвращает список дубликатов (один код с именем и без имени)
     """
-    from collections import defaultdict
-    
-    all_data = nal_data + beznal_data
-    by_code = defaultdict(lambda: {'with_name': [], 'without_name': []})
-    
-    for item in all_data:
-        code = item['code']
-        if item['name']:
-            by_code[code]['with_name'].append(item)
-        else:
-            by_code[code]['without_name'].append(item)
+    # код -> (записи с именем, записи без имени)
+    by_code = {}
+    for item in chain(nal_data, beznal_data):
+        bucket = by_code.get(item['code'])
+        if bucket is None:
+            bucket = by_code[item['code']] = ([], [])
+        bucket[0 if item['name'] else 1].append(item)
     
     # Ищем коды где есть И с именем И без имени
     duplicates = []
-    for code, data in by_code.items():
-        if data['with_name'] and data['without_name']:
+    for code, (with_name, without_name) in by_code.items():
+        if with_name and without_name:
             duplicates.append({
                 'code': code,
-                'with_name': data['with_name'],
-                'without_name': data['without_name']
+                'with_name': with_name,
+                'without_name': without_name
             })
     
     return duplicates
 
 
+# Строка предпросмотра: "  N. КОД Имя — сумма"
+_PREVIEW_ROW = "  {}. {} {} — {:.0f}".format
+
+
+def format_preview_rows(items: list, start: int = 1) -> List[str]:
+    """Строки предпросмотра с нумерацией с start"""
+    return [_PREVIEW_ROW(idx, item['code'], item['name'], item['amount'])
+            for idx, item in enumerate(items, start)]
+
+
+def get_preview_duplicates(state: UserState) -> list:
+    """
+    check_internal_duplicates с кэшем на состоянии пользователя:
+    повторный показ предпросмотра без изменений строк не пересчитывает дубликаты
+    """
+    rows = list(chain(state.temp_nal_data, state.temp_beznal_data))
+    # id строки + поля, от которых зависит результат; сами строки храним в кэше,
+    # поэтому их id не могут быть переиспользованы, пока кэш жив
+    signature = tuple((id(item), item['code'], bool(item['name'])) for item in rows)
+    
+    cached = state.preview_dup_cache
+    if cached and cached[0] == signature:
+        return cached[2]
+    
+    duplicates = check_internal_duplicates(state.temp_nal_data, state.temp_beznal_data)
+    state.preview_dup_cache = (signature, rows, duplicates)
+    return duplicates
+
+
 async def show_data_preview(update: Update, state: UserState, show_duplicates: bool = True):
     """Показать предпросмотр данных перед записью"""
     response_parts = []
@@ -11056,35 +11115,43 @@ async def show_data_preview(update: Update, state: UserState, show_duplicates: b
     if state.preview_date:
         response_parts.append(f"Дата: {state.preview_date}\n")
     
-    # Показываем все данные с номерами строк
-    line_num = 1
-    total_nal = 0
-    total_beznal = 0
+    # Показываем все данные с номерами строк (сквозная нумерация: сначала НАЛ, потом БЕЗНАЛ)
+    total_nal = sum(item['amount'] for item in state.temp_nal_data)
+    total_beznal = sum(item['amount'] for item in state.temp_beznal_data)
     
     if state.temp_nal_data:
         response_parts.append("📗 НАЛ:")
-        for item in state.temp_nal_data:
-            response_parts.append(f"  {line_num}. {item['code']} {item['name']} — {item['amount']:.0f}")
-            total_nal += item['amount']
-            line_num += 1
+        response_parts.extend(format_preview_rows(state.temp_nal_data))
         response_parts.append(f"  Итого НАЛ: {total_nal:.0f}\n")
     
     if state.temp_beznal_data:
         response_parts.append("📘 БЕЗНАЛ:")
-        for item in state.temp_beznal_data:
-            response_parts.append(f"  {line_num}. {item['code']} {item['name']} — {item['amount']:.0f}")
-            total_beznal += item['amount']
-            line_num += 1
+        response_parts.extend(format_preview_rows(state.temp_beznal_data, len(state.temp_nal_data) + 1))
         response_parts.append(f"  Итого БЕЗНАЛ: {total_beznal:.0f}\n")
     
     response_parts.append(f"💰 Всего: {total_nal + total_beznal:.0f}\n")
     
     # Проверка на дубликаты
     if show_duplicates:
-        duplicates = check_internal_duplicates(state.temp_nal_data, state.temp_beznal_data)
+        duplicates = get_preview_duplicates(state)
         
         if duplicates:
             response_parts.append("⚠️ ВНИМАНИЕ! Найдены возможные дубликаты:\n")
+            # Принадлежность записи к НАЛ/БЕЗНАЛ проверяем по id, а не поиском в списке
+            nal_ids = {id(item) for item in state.temp_nal_data}
+            bez_ids = {id(item) for item in state.temp_beznal_data}
+            
+            def channel_sums(items):
+                """Суммы НАЛ и БЕЗНАЛ за один проход по записям"""
+                nal_sum = bez_sum = 0
+                for item in items:
+                    item_id = id(item)
+                    if item_id in nal_ids:
+                        nal_sum += item['amount']
+                    elif item_id in bez_ids:
+                        bez_sum += item['amount']
+                return nal_sum, bez_sum
+            
             for i, dup in enumerate(duplicates, 1):
                 response_parts.append(f"{i}. Код: {dup['code']}")
                 
@@ -11092,13 +11159,11 @@ async def show_data_preview(update: Update, state: UserState, show_duplicates: b
                 names_with = set(item['name'] for item in dup['with_name'])
                 for name in names_with:
                     items = [item for item in dup['with_name'] if item['name'] == name]
-                    nal_sum = sum(item['amount'] for item in items if item in state.temp_nal_data)
-                    bez_sum = sum(item['amount'] for item in items if item in state.temp_beznal_data)
+                    nal_sum, bez_sum = channel_sums(items)
                     response_parts.append(f"   • {name}: НАЛ {nal_sum:.0f}, БЕЗНАЛ {bez_sum:.0f}")
                 
                 # Без имени
-                nal_no = sum(item['amount'] for item in dup['without_name'] if item in state.temp_nal_data)
-                bez_no = sum(item['amount'] for item in dup['without_name'] if item in state.temp_beznal_data)
+                nal_no, bez_no = channel_sums(dup['without_name'])
                 response_parts.append(f"   • (без имени): НАЛ {nal_no:.0f}, БЕЗНАЛ {bez_no:.0f}")
                 response_parts.append("")
             
@@ -11233,7 +11298,8 @@ async def handle_edit_line_number(update: Update, state: UserState, text: str):
         line_num = int(text.strip())
         
         # Проверяем диапазон
-        total_lines = len(state.temp_nal_data) + len(state.temp_beznal_data)
+        nal_len = len(state.temp_nal_data)
+        total_lines = nal_len + len(state.temp_beznal_data)
         
         if line_num < 1 or line_num > total_lines:
             await update.message.reply_text(
@@ -11242,14 +11308,14 @@ async def handle_edit_line_number(update: Update, state: UserState, text: str):
             return
         
         # Находим строку
-        if line_num <= len(state.temp_nal_data):
-            item = state.temp_nal_data[line_num - 1]
-            channel = 'нал'
+        if line_num <= nal_len:
             index = line_num - 1
+            item = state.temp_nal_data[index]
+            channel = 'нал'
         else:
-            item = state.temp_beznal_data[line_num - len(state.temp_nal_data) - 1]
+            index = line_num - nal_len - 1
+            item = state.temp_beznal_data[index]
             channel = 'безнал'
-            index = line_num - len(state.temp_nal_data) - 1
         
         # Показываем текущие данные
         await update.message.reply_text(
@@ -11284,13 +11350,14 @@ async def handle_edit_line_data(update: Update, state: UserState, text: str):
     
     # Определяем в каком списке находится строка
     line_num = state.edit_line_number
+    nal_len = len(state.temp_nal_data)
     
-    if line_num <= len(state.temp_nal_data):
+    if line_num <= nal_len:
         # Обновляем в НАЛ
         state.temp_nal_data[line_num - 1] = data
     else:
         # Обновляем в БЕЗНАЛ
-        index = line_num - len(state.temp_nal_data) - 1
+        index = line_num - nal_len - 1
         state.temp_beznal_data[index] = data
     
     await update.message.reply_text(
@@ -11312,33 +11379,14 @@ async def save_preview_data(update: Update, state: UserState):
         await update.message.reply_text("❌ Дата не указана")
         return
     
-    saved_count = 0
-    
-    for item in state.temp_nal_data:
-        db.add_or_update_operation(
-            club=state.club,
-            date=state.preview_date,
-            code=item['code'],
-            name=item['name'],
-            channel='нал',
-            amount=item['amount'],
-            original_line=item['original_line'],
-            aggregate=True
-        )
-        saved_count += 1
-    
-    for item in state.temp_beznal_data:
-        db.add_or_update_operation(
-            club=state.club,
-            date=state.preview_date,
-            code=item['code'],
-            name=item['name'],
-            channel='безнал',
-            amount=item['amount'],
-            original_line=item['original_line'],
-            aggregate=True
-        )
-        saved_count += 1
+    # Все строки пишем одной транзакцией
+    rows = [
+        (state.club, state.preview_date, item['code'], item['name'], channel,
+         item['amount'], item['original_line'])
+        for channel, items in (('нал', state.temp_nal_data), ('безнал', state.temp_beznal_data))
+        for item in items
+    ]
+    saved_count = await asyncio.to_thread(db.add_or_update_operations_bulk, rows, aggregate=True)
     
     state.reset_input()
     
@@ -11351,14 +11399,14 @@ async def save_preview_data(update: Update, state: UserState):
         f"• Введите новые данные: НАЛ / БЕЗНАЛ\n"
         f"• Посмотрите отчёт: ОТЧЁТ\n"
         f"• Или используйте другие команды ⬇️",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка загруженных документов (Excel файлы)"""
     user_id = update.effective_user.id
-    state = get_user_state(user_id)
+    state = get_user_state(context, user_id)
     
     # Проверка авторизации (только админы)
     if not db.is_admin(user_id):
@@ -11383,15 +11431,16 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             # Скачиваем файл
             file = await context.bot.get_file(document.file_id)
-            file_bytes = await file.download_as_bytearray()
+            buf = io.BytesIO()
+            await file.download_to_memory(buf)
             
             # Сохраняем файл в state для парсинга итогового листа
-            state.uploaded_file_bytes = bytes(file_bytes)
+            state.uploaded_file_bytes = buf.getvalue()
             
             # Парсим ЛИСТ ВЫПЛАТ
             excel_processor = ExcelProcessor()
             result = excel_processor.extract_payments_sheet(
-                bytes(file_bytes), 
+                buf, 
                 db, 
                 state.payments_upload_club,
                 state.payments_upload_date
@@ -11487,11 +11536,12 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Скачиваем файл
         file = await context.bot.get_file(document.file_id)
-        file_bytes = await file.download_as_bytearray()
+        buf = io.BytesIO()
+        await file.download_to_memory(buf)
         
-        # Парсим Excel
+        # Парсим Excel прямо из буфера, без копирования в bytes
         excel_processor = ExcelProcessor()
-        notes_data = excel_processor.extract_notes_entries(bytes(file_bytes))
+        notes_data = excel_processor.extract_notes_entries(buf)
         
         if not notes_data or (not notes_data.get('безнал') and not notes_data.get('нал')):
             await update.message.reply_text(
@@ -11574,6 +11624,48 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         state.mode = None
 
 
+def _append_additional_block(tag: str, analysis: dict, out: list, merge_counter: int) -> int:
+    """
+    Добавить в out блок доплат одного канала (БЕЗНАЛ/НАЛ) для предпросмотра файла.
+    Объединениям присваивается сквозной merge_id; возвращает новое значение счётчика
+    """
+    if not analysis:
+        return merge_counter
+    
+    merges = analysis.get('merges', [])
+    not_found = analysis.get('not_found', [])
+    no_code = analysis.get('no_code', [])
+    
+    if merges:
+        out.append(f"🔀 ДОПЛАТЫ {tag}:")
+        out.append("")
+        for merge in merges:
+            merge_counter += 1
+            merge['merge_id'] = merge_counter  # Присваиваем ID
+            add_item = merge['additional_item']
+            
+            out.append(f"[{merge_counter}] Код: {merge['code']}")
+            for main in merge['main_items']:
+                out.append(f"     Основная: {main['name']} — {main['amount']:.0f}")
+            out.append(f"     Доплата: {add_item['original_line']} — {add_item['amount']:.0f}")
+            out.append(f"     ИТОГО: {merge['total_amount']:.0f}")
+            out.append("")
+    
+    if not_found:
+        out.append(f"⚠️ {tag} - Доплаты без основной записи:")
+        for item in not_found:
+            out.append(f"  • {item['original_line']} (код {item['code']} не найден)")
+        out.append("")
+    
+    if no_code:
+        out.append(f"❓ {tag} - Доплаты без кода:")
+        for item in no_code:
+            out.append(f"  • {item['original_line']}")
+        out.append("")
+    
+    return merge_counter
+
+
 async def show_file_preview(update: Update, state: UserState):
     """Показать предпросмотр данных из файла"""
     data = state.upload_file_data
@@ -11595,10 +11687,8 @@ async def show_file_preview(update: Update, state: UserState):
     beznal_text = []
     if beznal_list:
         beznal_text.append(f"📘 БЕЗНАЛ ({len(beznal_list)} записей):")
-        total_beznal = 0
-        for idx, item in enumerate(beznal_list, 1):
-            beznal_text.append(f"  {idx}. {item['code']} {item['name']} — {item['amount']:.0f}")
-            total_beznal += item['amount']
+        beznal_text.extend(format_preview_rows(beznal_list))
+        total_beznal = sum(item['amount'] for item in beznal_list)
         beznal_text.append(f"  💰 Итого безнал: {total_beznal:.0f}")
         beznal_text.append("")
     
@@ -11606,10 +11696,8 @@ async def show_file_preview(update: Update, state: UserState):
     nal_text = []
     if nal_list:
         nal_text.append(f"📗 НАЛ ({len(nal_list)} записей):")
-        total_nal = 0
-        for idx, item in enumerate(nal_list, 1):
-            nal_text.append(f"  {idx}. {item['code']} {item['name']} — {item['amount']:.0f}")
-            total_nal += item['amount']
+        nal_text.extend(format_preview_rows(nal_list))
+        total_nal = sum(item['amount'] for item in nal_list)
         nal_text.append(f"  💰 Итого нал: {total_nal:.0f}")
         nal_text.append("")
     
@@ -11627,77 +11715,8 @@ async def show_file_preview(update: Update, state: UserState):
     additional_text = []
     merge_counter = 0  # Сквозная нумерация для всех объединений
     
-    # БЕЗНАЛ
-    if beznal_analysis:
-        beznal_merges = beznal_analysis.get('merges', [])
-        beznal_not_found = beznal_analysis.get('not_found', [])
-        beznal_no_code = beznal_analysis.get('no_code', [])
-        
-        if beznal_merges:
-            additional_text.append("🔀 ДОПЛАТЫ БЕЗНАЛ:")
-            additional_text.append("")
-            for merge in beznal_merges:
-                merge_counter += 1
-                merge['merge_id'] = merge_counter  # Присваиваем ID
-                code = merge['code']
-                main_items = merge['main_items']
-                add_item = merge['additional_item']
-                total = merge['total_amount']
-                
-                additional_text.append(f"[{merge_counter}] Код: {code}")
-                for main in main_items:
-                    additional_text.append(f"     Основная: {main['name']} — {main['amount']:.0f}")
-                additional_text.append(f"     Доплата: {add_item['original_line']} — {add_item['amount']:.0f}")
-                additional_text.append(f"     ИТОГО: {total:.0f}")
-                additional_text.append("")
-        
-        if beznal_not_found:
-            additional_text.append("⚠️ БЕЗНАЛ - Доплаты без основной записи:")
-            for item in beznal_not_found:
-                additional_text.append(f"  • {item['original_line']} (код {item['code']} не найден)")
-            additional_text.append("")
-            
-        if beznal_no_code:
-            additional_text.append("❓ БЕЗНАЛ - Доплаты без кода:")
-            for item in beznal_no_code:
-                additional_text.append(f"  • {item['original_line']}")
-            additional_text.append("")
-    
-    # НАЛ
-    if nal_analysis:
-        nal_merges = nal_analysis.get('merges', [])
-        nal_not_found = nal_analysis.get('not_found', [])
-        nal_no_code = nal_analysis.get('no_code', [])
-        
-        if nal_merges:
-            additional_text.append("🔀 ДОПЛАТЫ НАЛ:")
-            additional_text.append("")
-            for merge in nal_merges:
-                merge_counter += 1
-                merge['merge_id'] = merge_counter  # Присваиваем ID
-                code = merge['code']
-                main_items = merge['main_items']
-                add_item = merge['additional_item']
-                total = merge['total_amount']
-                
-                additional_text.append(f"[{merge_counter}] Код: {code}")
-                for main in main_items:
-                    additional_text.append(f"     Основная: {main['name']} — {main['amount']:.0f}")
-                additional_text.append(f"     Доплата: {add_item['original_line']} — {add_item['amount']:.0f}")
-                additional_text.append(f"     ИТОГО: {total:.0f}")
-                additional_text.append("")
-        
-        if nal_not_found:
-            additional_text.append("⚠️ НАЛ - Доплаты без основной записи:")
-            for item in nal_not_found:
-                additional_text.append(f"  • {item['original_line']} (код {item['code']} не найден)")
-            additional_text.append("")
-            
-        if nal_no_code:
-            additional_text.append("❓ НАЛ - Доплаты без кода:")
-            for item in nal_no_code:
-                additional_text.append(f"  • {item['original_line']}")
-            additional_text.append("")
+    merge_counter = _append_additional_block('БЕЗНАЛ', beznal_analysis, additional_text, merge_counter)
+    merge_counter = _append_additional_block('НАЛ', nal_analysis, additional_text, merge_counter)
     
     # Финал
     footer = []
@@ -11715,34 +11734,11 @@ async def show_file_preview(update: Update, state: UserState):
         footer.append("  • ЗАПИСАТЬ - сохранить в базу")
         footer.append("  • ОТМЕНА - отменить")
     
-    # Объединяем весь текст
-    full_text = '\n'.join(header + beznal_text + nal_text + errors_text + additional_text + footer)
-    
-    # Разбиваем на части по 4000 символов если нужно
-    max_length = 4000
-    if len(full_text) <= max_length:
-        await update.message.reply_text(full_text)
-    else:
-        # Разбиваем на куски
-        parts = []
-        current_part = []
-        
-        for line in (header + beznal_text + nal_text + errors_text + additional_text + footer):
-            test_part = '\n'.join(current_part + [line])
-            if len(test_part) > max_length and current_part:
-                # Сохраняем текущую часть и начинаем новую
-                parts.append('\n'.join(current_part))
-                current_part = [line]
-            else:
-                current_part.append(line)
-        
-        # Добавляем последнюю часть
-        if current_part:
-            parts.append('\n'.join(current_part))
-        
-        # Отправляем все части
-        for part in parts:
-            await update.message.reply_text(part)
+    # Отправляем частями по 4000 символов (короткий текст уйдёт одним сообщением)
+    await reply_lines_chunked(
+        update.message,
+        chain(header, beznal_text, nal_text, errors_text, additional_text, footer)
+    )
 
 
 async def save_file_data_continue(message, state: UserState):
@@ -11791,6 +11787,27 @@ async def show_merge_warning(update: Update, state: UserState, found_merges: Lis
     )
 
 
+def collect_file_merges(merges: list, selected_merges) -> dict:
+    """
+    Объединения доплат одного канала, которые нужно применить при записи файла:
+    ключ -> (итоговая сумма, имя)
+    selected_merges: None = все, иначе только merge_id из списка
+    ВАЖНО: Для СБ ключ code_name, чтобы разные СБ не объединялись
+    """
+    if selected_merges is not None:
+        selected = frozenset(selected_merges)  # выбор приходит списком - проверка in за O(1)
+        merges = [merge for merge in merges if merge.get('merge_id') in selected]
+    
+    merge_dict = {}
+    for merge in merges:
+        code = merge['code']
+        name = merge['main_items'][0]['name'] if merge['main_items'] else ''
+        merge_key = f"{code}_{name}" if code == 'СБ' and name else code
+        merge_dict[merge_key] = (merge['total_amount'], name)
+    
+    return merge_dict
+
+
 async def save_file_data(update: Update, state: UserState):
     """Сохранение данных из файла в БД с учетом объединений доплат"""
     data = state.upload_file_data
@@ -11800,6 +11817,10 @@ async def save_file_data(update: Update, state: UserState):
     nal_analysis = data.get('nal_analysis', {})
     selected_merges = data.get('selected_merges')  # None = все, [1,2] = только указанные
     
+    # Доплаты (is_additional=True) уже учтены в объединениях - отбрасываем их один раз
+    beznal_main = [item for item in beznal_list if not item.get('is_additional', False)]
+    nal_main = [item for item in nal_list if not item.get('is_additional', False)]
+    
     # Сохраняем значения до очистки
     club = state.upload_file_club
     date = state.upload_file_date
@@ -11807,12 +11828,11 @@ async def save_file_data(update: Update, state: UserState):
     # НОВАЯ ЛОГИКА: Проверяем объединённых сотрудников
     if not data.get('merge_check_done'):
         found_merges = []
+        check_merge = db.check_employee_merge  # метод вызывается на каждую строку
         
         # Проверяем безнал
-        for item in beznal_list:
-            if item.get('is_additional', False):
-                continue
-            merge_info = db.check_employee_merge(club, item['code'], item['name'])
+        for item in beznal_main:
+            merge_info = check_merge(club, item['code'], item['name'])
             if merge_info:
                 found_merges.append({
                     'channel': 'безнал',
@@ -11823,10 +11843,8 @@ async def save_file_data(update: Update, state: UserState):
                 })
         
         # Проверяем нал
-        for item in nal_list:
-            if item.get('is_additional', False):
-                continue
-            merge_info = db.check_employee_merge(club, item['code'], item['name'])
+        for item in nal_main:
+            merge_info = check_merge(club, item['code'], item['name'])
             if merge_info:
                 found_merges.append({
                     'channel': 'нал',
@@ -11846,70 +11864,14 @@ async def save_file_data(update: Update, state: UserState):
         data['merge_check_done'] = True
     
     # Создаем словари для объединений ОТДЕЛЬНО ДЛЯ БЕЗНАЛ И НАЛ
-    beznal_merge_dict = {}
-    nal_merge_dict = {}
-    
-    # БЕЗНАЛ - собираем объединения которые нужно применить
-    # ВАЖНО: Для СБ используем ключ code_name, чтобы разные СБ не объединялись
-    beznal_merges = beznal_analysis.get('merges', [])
-    for merge in beznal_merges:
-        merge_id = merge.get('merge_id')
-        # Проверяем, нужно ли применять это объединение
-        should_apply = False
-        if selected_merges is None:
-            should_apply = True  # Применяем все
-        elif merge_id in selected_merges:
-            should_apply = True  # Применяем только выбранные
-        
-        if should_apply:
-            code = merge['code']
-            name = merge['main_items'][0]['name'] if merge['main_items'] else ''
-            
-            # Для СБ используем комбинацию code_name как ключ
-            if code == 'СБ' and name:
-                merge_key = f"{code}_{name}"
-            else:
-                merge_key = code
-            
-            beznal_merge_dict[merge_key] = {
-                'amount': merge['total_amount'],
-                'name': name
-            }
-    
-    # НАЛ - собираем объединения которые нужно применить
-    # ВАЖНО: Для СБ используем ключ code_name, чтобы разные СБ не объединялись
-    nal_merges = nal_analysis.get('merges', [])
-    for merge in nal_merges:
-        merge_id = merge.get('merge_id')
-        # Проверяем, нужно ли применять это объединение
-        should_apply = False
-        if selected_merges is None:
-            should_apply = True  # Применяем все
-        elif merge_id in selected_merges:
-            should_apply = True  # Применяем только выбранные
-        
-        if should_apply:
-            code = merge['code']
-            name = merge['main_items'][0]['name'] if merge['main_items'] else ''
-            
-            # Для СБ используем комбинацию code_name как ключ
-            if code == 'СБ' and name:
-                merge_key = f"{code}_{name}"
-            else:
-                merge_key = code
-            
-            nal_merge_dict[merge_key] = {
-                'amount': merge['total_amount'],
-                'name': name
-            }
+    beznal_merge_dict = collect_file_merges(beznal_analysis.get('merges', []), selected_merges)
+    nal_merge_dict = collect_file_merges(nal_analysis.get('merges', []), selected_merges)
     
     # ПРИМЕНЯЕМ КАНОНИЧЕСКИЕ ИМЕНА (приоритет выше чем объединения)
     canonical_replacements = {}
-    for item in beznal_list + nal_list:
-        if item.get('is_additional', False):
-            continue
-        
-        canonical = db.get_canonical_name(item['code'], club, date)
+    get_canonical = db.get_canonical_name
+    for item in chain(beznal_main, nal_main):
+        canonical = get_canonical(item['code'], club, date)
         if canonical:
             key = f"{item['code']}_{item['name']}"
             canonical_replacements[key] = {
@@ -11931,26 +11893,20 @@ async def save_file_data(update: Update, state: UserState):
                 'name': merge['merged_name']
             }
     
-    saved_count = 0
-    
-    # Сохраняем безнал
-    for item in beznal_list:
-        # Пропускаем доплаты (is_additional=True) - они уже учтены
-        if item.get('is_additional', False):
-            continue
-            
+    # Собираем строки безнал и нал одним проходом и пишем их одной транзакцией
+    rows = []
+    tagged_items = chain(
+        ((item, 'безнал', beznal_merge_dict) for item in beznal_main),
+        ((item, 'нал', nal_merge_dict) for item in nal_main)
+    )
+    for item, channel, merge_dict in tagged_items:
         code = item['code']
         name = item.get('name', '') or ''  # Убеждаемся что name не None
         
-        # Проверяем каноническое имя (приоритет 1)
+        # Проверяем каноническое имя (приоритет 1), иначе объединения (приоритет 2)
         key = f"{code}_{name}"
-        if key in canonical_replacements:
-            replacement = canonical_replacements[key]
-            code = replacement['code']
-            name = replacement['name']
-        # Иначе проверяем объединения (приоритет 2)
-        elif key in employee_replacements:
-            replacement = employee_replacements[key]
+        replacement = canonical_replacements.get(key) or employee_replacements.get(key)
+        if replacement is not None:
             code = replacement['code']
             name = replacement['name']
         
@@ -11961,73 +11917,17 @@ async def save_file_data(update: Update, state: UserState):
         else:
             merge_key = code
         
-        if merge_key in beznal_merge_dict:
-            # Используем сумму и имя из объединения
-            amount = beznal_merge_dict[merge_key]['amount']
-            name = beznal_merge_dict[merge_key]['name']  # ВАЖНО: обновляем имя из объединения
+        merged = merge_dict.get(merge_key)
+        if merged is not None:
+            # Используем сумму и имя из объединения (ВАЖНО: имя тоже обновляем)
+            amount, name = merged
         else:
-            amount = item['amount']
             # Для СБ без доплат сохраняем имя как есть
-            
-        db.add_or_update_operation(
-            club=club,
-            date=date,
-            code=code,
-            name=name,
-            channel='безнал',
-            amount=amount,
-            original_line=item['original_line'],
-            aggregate=True
-        )
-        saved_count += 1
-    
-    # Сохраняем нал
-    for item in nal_list:
-        # Пропускаем доплаты (is_additional=True) - они уже учтены
-        if item.get('is_additional', False):
-            continue
-            
-        code = item['code']
-        name = item.get('name', '') or ''  # Убеждаемся что name не None
-        
-        # Проверяем каноническое имя (приоритет 1)
-        key = f"{code}_{name}"
-        if key in canonical_replacements:
-            replacement = canonical_replacements[key]
-            code = replacement['code']
-            name = replacement['name']
-        # Иначе проверяем объединения (приоритет 2)
-        elif key in employee_replacements:
-            replacement = employee_replacements[key]
-            code = replacement['code']
-            name = replacement['name']
-        
-        # Если код объединяется (доплаты) - используем итоговую сумму
-        # Для СБ проверяем по комбинации code_name
-        if code == 'СБ' and name:
-            merge_key = f"{code}_{name}"
-        else:
-            merge_key = code
-        
-        if merge_key in nal_merge_dict:
-            # Используем сумму и имя из объединения
-            amount = nal_merge_dict[merge_key]['amount']
-            name = nal_merge_dict[merge_key]['name']  # ВАЖНО: обновляем имя из объединения
-        else:
             amount = item['amount']
-            # Для СБ без доплат сохраняем имя как есть
-            
-        db.add_or_update_operation(
-            club=club,
-            date=date,
-            code=code,
-            name=name,
-            channel='нал',
-            amount=amount,
-            original_line=item['original_line'],
-            aggregate=True
-        )
-        saved_count += 1
+        
+        rows.append((club, date, code, name, channel, amount, item['original_line']))
+    
+    saved_count = await asyncio.to_thread(db.add_or_update_operations_bulk, rows, aggregate=True)
     
     # Очищаем состояние
     state.upload_file_club = None
@@ -12041,10 +11941,120 @@ async def save_file_data(update: Update, state: UserState):
         f"📅 Дата: {date}\n"
         f"📊 Записей: {saved_count}\n\n"
         f"Используйте кнопки меню ⬇️",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
+    )
+
+
+async def setup_default_executor(application: Application):
+    """Ограниченный пул потоков для синхронной работы с БД и отчётами (asyncio.to_thread)"""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS)
     )
 
 
+# Обработчики режимов ввода: state.mode -> async (update, context, state, text, text_lower).
+# Один поиск в словаре вместо цепочки сравнений state.mode на каждом сообщении.
+INPUT_MODE_HANDLERS = {
+    'awaiting_delete_mass_club': lambda u, c, s, t, tl: handle_delete_mass_club_input(u, s, t, tl),
+    'awaiting_delete_mass_period': lambda u, c, s, t, tl: handle_delete_mass_period_input(u, s, t, tl),
+    'awaiting_delete_mass_confirm': lambda u, c, s, t, tl: handle_delete_mass_confirm_text(u, s, tl),
+    'awaiting_delete_employee_input': lambda u, c, s, t, tl: handle_delete_employee_input(u, c, s, t),
+    'awaiting_upload_date': lambda u, c, s, t, tl: handle_upload_date_input(u, s, t, tl),
+    'awaiting_payments_upload_club': lambda u, c, s, t, tl: handle_payments_upload_club_input(u, s, t, tl),
+    'awaiting_payments_upload_date': lambda u, c, s, t, tl: handle_payments_upload_date_input(u, s, t, tl),
+    'awaiting_preview_date': lambda u, c, s, t, tl: handle_preview_date_input(u, s, t, tl),
+    'awaiting_preview_action': lambda u, c, s, t, tl: handle_preview_action(u, s, t, tl),
+    'awaiting_edit_line_number': lambda u, c, s, t, tl: handle_edit_line_number(u, s, t),
+    'awaiting_edit_line_data': lambda u, c, s, t, tl: handle_edit_line_data(u, s, t),
+}
+
+# Режимы, доступные при ограниченном доступе (код 0001)
+LIMITED_ACCESS_HANDLERS = {
+    'awaiting_payments_input': handle_limited_payments_input,
+}
+
+STYLIST_MODE_HANDLERS = {
+    'awaiting_stylist_period': lambda u, c, s, t, tl: handle_stylist_period_input(u, s, t, tl),
+    'awaiting_stylist_data': lambda u, c, s, t, tl: handle_stylist_data_input(u, s, t, tl),
+    'awaiting_stylist_confirm': lambda u, c, s, t, tl: handle_stylist_confirm(u, s, tl),
+    'awaiting_stylist_edit_data': lambda u, c, s, t, tl: handle_stylist_edit_data(u, s, t),
+    'awaiting_stylist_clarification': lambda u, c, s, t, tl: handle_stylist_clarification(u, s, t),
+    'awaiting_stylist_view_delete': lambda u, c, s, t, tl: handle_stylist_view_delete(u, s, t),
+    'awaiting_stylist_view_edit': lambda u, c, s, t, tl: handle_stylist_view_edit_number(u, s, t),
+    'awaiting_stylist_view_edit_data': lambda u, c, s, t, tl: handle_stylist_view_edit_data(u, s, t),
+}
+
+# Команды проверяются в handle_message в разных местах (порядок относительно режимов важен):
+# COMMAND_HANDLERS - до режимов отчёта/списка/исправления, MENU_COMMAND_HANDLERS - после них
+COMMAND_HANDLERS = {
+    'нал': lambda u, c, s, t, tl: handle_cash_mode_command(u, s, 'нал'),
+    'безнал': lambda u, c, s, t, tl: handle_cash_mode_command(u, s, 'безнал'),
+    'загрузить файл': lambda u, c, s, t, tl: handle_upload_start_command(
+        u, s, 'awaiting_upload_club', "📎 ЗАГРУЗКА EXCEL ФАЙЛА"),
+    'загрузить зп': lambda u, c, s, t, tl: handle_upload_start_command(
+        u, s, 'awaiting_payments_upload_club', "💰 ЗАГРУЗКА ЛИСТА ВЫПЛАТ"),
+}
+
+MENU_COMMAND_HANDLERS = {
+    'самозанятые': lambda u, c, s, t, tl: handle_self_employed_command(u, c, s),
+    'сотрудники': lambda u, c, s, t, tl: handle_employees_menu_command(u),
+    'стилисты': lambda u, c, s, t, tl: handle_stylists_menu_command(u),
+    'владельцы': lambda u, c, s, t, tl: handle_owners_command(u),
+    '👔 владельцы': lambda u, c, s, t, tl: handle_owners_command(u),
+    'итоговые отчёты': lambda u, c, s, t, tl: handle_final_reports_command(u, s),
+    'итоговые отчеты': lambda u, c, s, t, tl: handle_final_reports_command(u, s),
+    '📈 итоговые отчёты': lambda u, c, s, t, tl: handle_final_reports_command(u, s),
+    '📈 итоговые отчеты': lambda u, c, s, t, tl: handle_final_reports_command(u, s),
+}
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов разных пользователей.
+    Апдейты одного пользователя идут строго по очереди: его UserState - это конечный автомат,
+    и параллельная обработка двух сообщений одного пользователя сломала бы режимы ввода.
+    Ждущие апдейты пользователя стоят в его очереди и не занимают общие слоты
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # Очереди пользователей, чьи апдейты сейчас обрабатываются
+        self._user_queues: Dict[int, deque] = {}
+    
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        
+        queue = self._user_queues.get(user.id)
+        if queue is not None:
+            # Обработка пользователя уже идёт: ставим апдейт в его очередь и сразу отдаём слот
+            queue.append(coroutine)
+            return
+        
+        # Первый апдейт занимает один слот и разбирает всю очередь пользователя
+        queue = self._user_queues[user.id] = deque([coroutine])
+        try:
+            while queue:
+                current = queue.popleft()
+                try:
+                    await current
+                except Exception:
+                    logger.exception("Ошибка обработки апдейта пользователя %s", user.id)
+        finally:
+            # Очередь разобрана (или задачу отменили) - удаляем, чтобы словарь не рос без предела
+            del self._user_queues[user.id]
+            for pending in queue:
+                pending.close()
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+
 def main():
     """Запуск бота"""
     # Проверяем токен
@@ -12054,19 +12064,32 @@ def main():
         print("или измените значение в config.py")
         return
     
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s', level=logging.WARNING)
+    logger.setLevel(config.LOG_LEVEL)
+    
     # Инициализация списка самозанятых (только если таблица пустая)
-    initial_self_employed = [
-        'Д4', 'Д5', 'Д11', 'Д15', 'Д18', 'Д20', 'Д23', 'Д33', 'Д35', 'Д38',
-        'Д66', 'ОФ1', 'ОФ3', 'ОФ4', 'Б13', 'Б52', 'К2', 'К4', 'К21'
-    ]
-    added = db.init_self_employed_list(initial_self_employed)
-    if added > 0:
-        print(f"[OK] Инициализирован список самозанятых: {added} кодов")
-    else:
+    if db.has_self_employed():
         print(f"[OK] Список самозанятых уже существует, инициализация пропущена")
+    else:
+        initial_self_employed = [
+            'Д4', 'Д5', 'Д11', 'Д15', 'Д18', 'Д20', 'Д23', 'Д33', 'Д35', 'Д38',
+            'Д66', 'ОФ1', 'ОФ3', 'ОФ4', 'Б13', 'Б52', 'К2', 'К4', 'К21'
+        ]
+        added = db.init_self_employed_list(initial_self_employed)
+        print(f"[OK] Инициализирован список самозанятых: {added} кодов")
+    
+    if not config.QUICK_ACCESS_USER_IDS:
+        print("[INFO] Быстрый доступ к выплатам (код 0001) выключен: QUICK_ACCESS_USER_IDS не задан")
     
     # Создаем приложение
-    app = Application.builder().token(config.BOT_TOKEN).build()
+    # Апдейты разных пользователей обрабатываются параллельно, одного - по очереди
+    app = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(setup_default_executor)
+        .build()
+    )
     
     # Регистрируем обработчики
     app.add_handler(CommandHandler("start", start_command))
@@ -12078,7 +12101,19 @@ def main():
     # Запускаем бота
     print("[BOT] Бот запущен!")
     print("Для остановки нажмите Ctrl+C")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if config.WEBHOOK_URL:
+        # Webhook: Telegram сам присылает апдейты, без цикла long polling
+        print(f"[BOT] Режим webhook: {config.WEBHOOK_URL}")
+        app.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=config.WEBHOOK_URL,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 async def handle_stylist_view_delete(update: Update, state: UserState, text: str):
@@ -12244,7 +12279,6 @@ async def handle_stylist_view_edit_data(update: Update, state: UserState, text:
     ))
     
     # Добавляем новую
-    from datetime import datetime
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     cursor.execute("""
         INSERT INTO stylist_expenses 
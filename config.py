@@ -30,3 +30,20 @@ CHANNELS = {
 # База данных
 DATABASE_PATH = 'bot_data.db'
 
+# Быстрый доступ к выплатам (код 0001): Telegram ID через запятую, например "123456,789012".
+# Код открывает выгрузку выплат любого сотрудника, поэтому работает только для этих ID;
+# если список пуст - быстрый доступ выключен
+QUICK_ACCESS_USER_IDS = frozenset(
+    int(user_id) for user_id in os.getenv('QUICK_ACCESS_USER_IDS', '').split(',') if user_id.strip()
+)
+
+# Уровень логов бота (DEBUG - печатать каждую полученную команду)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Webhook (необязательно). Если задан TELEGRAM_WEBHOOK_URL - бот принимает апдейты
+# через webhook вместо long polling (нужен пакет python-telegram-bot[webhooks])
+WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET') or None
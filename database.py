@@ -3,24 +3,111 @@
 """
 import sqlite3
 import re
+import sys
+import threading
+import time
 from datetime import datetime
+from itertools import groupby
 from typing import List, Dict, Optional, Tuple
 import config
 
 
+# Время жизни кэша прав доступа (админ/владелец/сотрудник), секунд
+IDENTITY_CACHE_TTL = 60
+
+# Сколько свободных соединений держать в пуле каждого потока
+MAX_POOLED_CONNECTIONS = 4
+
+# Размер кэша подготовленных запросов на соединение: разных SQL-запросов в боте
+# больше 128 (значение sqlite3 по умолчанию), и они вытесняли бы друг друга
+STATEMENT_CACHE_SIZE = 256
+
+
+class PooledConnection:
+    """
+    Соединение из пула потока. close() не закрывает файл БД, а откатывает
+    незавершённую транзакцию (как это сделал бы настоящий close) и
+    возвращает соединение в пул
+    """
+    
+    __slots__ = ('_conn', '_pool')
+    
+    def __init__(self, conn: sqlite3.Connection, pool: list):
+        self._conn = conn
+        self._pool = pool
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return  # повторный close
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        if len(self._pool) < MAX_POOLED_CONNECTIONS:
+            self._pool.append(conn)
+        else:
+            conn.close()
+
+
 class Database:
     """Класс для работы с базой данных"""
     
     def __init__(self, db_path: str = config.DATABASE_PATH):
         self.db_path = db_path
+        # (вид, telegram_user_id) -> (момент устаревания, значение)
+        self._identity_cache: Dict[Tuple[str, int], Tuple[float, object]] = {}
+        self._identity_cache_pruned_at = time.monotonic()
+        # Свободные соединения по потокам (sqlite3 не разрешает делить соединение между потоками)
+        self._local = threading.local()
         self.init_database()
         
         # Проверяем и создаём таблицу employees если нужно
         self.migrate_to_employees()
     
     def get_connection(self):
-        """Получить соединение с БД"""
-        return sqlite3.connect(self.db_path)
+        """Получить соединение с БД (из пула текущего потока или новое)"""
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = []
+        if pool:
+            return PooledConnection(pool.pop(), pool)
+        
+        conn = sqlite3.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE)
+        # Настройки действуют на соединение; в режиме WAL synchronous=NORMAL
+        # не делает fsync на каждый commit и не рискует целостностью базы
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # Соединения живут в пуле, поэтому кэш страниц переживает отдельные запросы;
+        # до 20 МБ (память выделяется по мере надобности)
+        conn.execute("PRAGMA cache_size=-20000")
+        return PooledConnection(conn, pool)
+    
+    def _cached_identity(self, kind: str, telegram_user_id: int, loader):
+        """Значение прав доступа из кэша или из БД через loader"""
+        key = (kind, telegram_user_id)
+        now = time.monotonic()
+        cached = self._identity_cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        
+        # Раз в TTL удаляем устаревшие записи, чтобы сообщения посторонних не копились в кэше
+        if now - self._identity_cache_pruned_at > IDENTITY_CACHE_TTL:
+            self._identity_cache_pruned_at = now
+            for stale_key in [k for k, (expires, _) in self._identity_cache.items() if expires <= now]:
+                del self._identity_cache[stale_key]
+        
+        value = loader(telegram_user_id)
+        self._identity_cache[key] = (now + IDENTITY_CACHE_TTL, value)
+        return value
+    
+    def invalidate_identity_cache(self):
+        """Сбросить кэш прав доступа (после изменения admins/owners/employees)"""
+        self._identity_cache.clear()
     
     @staticmethod
     def normalize_sb_code(code: str) -> str:
@@ -47,6 +134,9 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Журнал WAL - настройка самой базы (сохраняется в файле), ставим один раз
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # Таблица операций (основные данные)
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS operations (
@@ -224,6 +314,12 @@ class Database:
             ON payments(club, date)
         """)
         
+        # Личный кабинет сотрудника ищет выплаты по коду (без клуба) и диапазону дат
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_payments_code_date 
+            ON payments(code, date)
+        """)
+        
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_canonical_names_lookup 
             ON employee_canonical_names(code, club, valid_from, valid_to)
@@ -695,6 +791,100 @@ class Database:
         """
         conn = self.get_connection()
         cursor = conn.cursor()
+        action = self._upsert_operation(cursor, club, date, code, name, channel,
+                                        amount, original_line, aggregate)
+        conn.commit()
+        conn.close()
+        return action
+    
+    def add_or_update_operations_bulk(self, rows: List[Tuple], aggregate: bool = True) -> int:
+        """
+        Добавить или обновить пачку операций в одной транзакции
+        rows: кортежи (club, date, code, name, channel, amount, original_line)
+        Возвращает количество обработанных строк
+        """
+        # СБ обрабатываем по одной записи: для них своя логика с учётом имени
+        plain_rows = [row for row in rows if row[2] != 'СБ']
+        sb_rows = [row for row in rows if row[2] == 'СБ']
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            if plain_rows:
+                self._upsert_plain_operations(cursor, plain_rows, aggregate)
+            for club, date, code, name, channel, amount, original_line in sb_rows:
+                self._upsert_operation(cursor, club, date, code, name, channel,
+                                       amount, original_line, aggregate)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(rows)
+    
+    def _upsert_plain_operations(self, cursor, rows: List[Tuple], aggregate: bool):
+        """
+        Пакетный upsert операций (не СБ) на переданном курсоре (без commit).
+        Существующие записи читаются одним запросом на (клуб, дата), изменения
+        пишутся через executemany; результат тот же, что у _upsert_operation по строкам
+        """
+        # (club, date, code, channel) -> [id (None - новая), amount, name, original_line, created_at]
+        records = {}
+        for club, date in {(row[0], row[1]) for row in rows}:
+            cursor.execute("""
+                SELECT id, code, channel, amount, name_snapshot FROM operations 
+                WHERE club = ? AND date = ?
+            """, (club, date))
+            for record_id, code, channel, amount, name in cursor.fetchall():
+                records[(club, date, code, channel)] = [record_id, amount, name, None, None]
+        
+        touched = {}  # изменённые ключи в порядке появления
+        log_rows = []
+        log_action = 'update' if aggregate else 'replace'
+        for club, date, code, name, channel, amount, original_line in rows:
+            created_at = datetime.now().isoformat()
+            key = (club, date, code, channel)
+            touched[key] = None
+            record = records.get(key)
+            if record is None:
+                records[key] = [None, amount, name, original_line, created_at]
+                continue
+            
+            old_amount = record[1]
+            new_amount = old_amount + amount if aggregate else amount
+            # Имя обновляем только если оно передано
+            record[1:] = [new_amount, name if name else record[2], original_line, created_at]
+            log_rows.append((club, date, code, channel, log_action, old_amount, new_amount, created_at))
+        
+        inserts = []
+        updates = []
+        for key in touched:
+            record_id, amount, name, original_line, created_at = records[key]
+            club, date, code, channel = key
+            if record_id is None:
+                inserts.append((club, date, code, name, channel, amount, original_line, created_at))
+            else:
+                updates.append((amount, name, original_line, created_at, record_id))
+        
+        cursor.executemany("""
+            INSERT INTO operations (club, date, code, name_snapshot, channel, amount, original_line, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, inserts)
+        cursor.executemany("""
+            UPDATE operations 
+            SET amount = ?, name_snapshot = ?, original_line = ?, created_at = ?
+            WHERE id = ?
+        """, updates)
+        cursor.executemany("""
+            INSERT INTO edit_log (club, date, code, channel, action, old_value, new_value, edited_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, log_rows)
+    
+    def _upsert_operation(self, cursor, club: str, date: str, code: str,
+                          name: str, channel: str, amount: float,
+                          original_line: str, aggregate: bool) -> str:
+        """Добавить или обновить одну операцию на переданном курсоре (без commit)"""
         created_at = datetime.now().isoformat()
         
         # Для СБ проверка существования должна учитывать имя
@@ -810,8 +1000,6 @@ class Database:
                 """, (club, date, code, name, channel, amount, original_line, created_at))
                 action = f"Добавлена новая запись: {amount}"
         
-        conn.commit()
-        conn.close()
         return action
     
     def get_operations_by_date(self, club: str, date: str) -> List[Dict]:
@@ -829,11 +1017,12 @@ class Database:
         rows = cursor.fetchall()
         conn.close()
         
+        # Канал интернируем: сравнения op['channel'] == 'нал' сводятся к сравнению указателей
         return [
             {
                 'code': self.normalize_sb_code(row[0]),
                 'name': row[1],
-                'channel': row[2],
+                'channel': sys.intern(row[2]),
                 'amount': row[3],
                 'original_line': row[4],
                 'created_at': row[5]
@@ -856,17 +1045,50 @@ class Database:
         rows = cursor.fetchall()
         conn.close()
         
+        # Код и канал интернируем: они многократно повторяются и сравниваются в отчётах
         return [
             {
-                'code': self.normalize_sb_code(row[0]),
+                'code': sys.intern(self.normalize_sb_code(row[0])),
                 'name': row[1],
-                'channel': row[2],
+                'channel': sys.intern(row[2]),
                 'amount': row[3],
                 'date': row[4]
             }
             for row in rows
         ]
     
+    def get_operations_by_period_for_clubs(self, clubs: List[str], date_from: str,
+                                           date_to: str) -> Dict[str, List[Dict]]:
+        """Операции нескольких клубов за период одним запросом: {клуб: операции}"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        placeholders = ','.join('?' * len(clubs))
+        cursor.execute(f"""
+            SELECT club, code, name_snapshot, channel, amount, date
+            FROM operations
+            WHERE club IN ({placeholders}) AND date >= ? AND date <= ?
+            ORDER BY club, date, code, channel
+        """, (*clubs, date_from, date_to))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        # Клубы без операций - пустые списки
+        result = {club: [] for club in clubs}
+        for club, club_rows in groupby(rows, key=lambda row: row[0]):
+            result[club] = [
+                {
+                    'code': sys.intern(self.normalize_sb_code(row[1])),
+                    'name': row[2],
+                    'channel': sys.intern(row[3]),
+                    'amount': row[4],
+                    'date': row[5]
+                }
+                for row in club_rows
+            ]
+        return result
+    
     def update_operation(self, club: str, date: str, code: str, 
                         channel: str, new_amount: float) -> Tuple[bool, str]:
         """Исправить сумму операции"""
@@ -1093,9 +1315,9 @@ class Database:
         
         return [
             {
-                'club': row[0],
+                'club': sys.intern(row[0]),
                 'date': row[1],
-                'channel': row[2],
+                'channel': sys.intern(row[2]),
                 'amount': row[3],
                 'name': row[4]
             }
@@ -1237,6 +1459,15 @@ class Database:
         conn.close()
         return codes
     
+    def has_self_employed(self) -> bool:
+        """Есть ли в таблице самозанятых хотя бы одна запись"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM self_employed LIMIT 1")
+        found = cursor.fetchone() is not None
+        conn.close()
+        return found
+    
     def init_self_employed_list(self, codes: List[str]) -> int:
         """
         Инициализация списка самозанятых (ТОЛЬКО если таблица пустая)
@@ -1245,29 +1476,28 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Проверяем: есть ли уже записи в таблице
-        cursor.execute("SELECT COUNT(*) FROM self_employed")
-        count = cursor.fetchone()[0]
+        # Если таблица НЕ пустая - ничего не делаем (полный COUNT не нужен)
+        cursor.execute("SELECT 1 FROM self_employed LIMIT 1")
+        if cursor.fetchone() is not None:
+            conn.close()
+            return 0
         
-        # Если таблица НЕ пустая - ничего не делаем
-        if count > 0:
+        # Таблица пустая - инициализируем список одним запросом (повторы кодов пропускаются)
+        if not codes:
             conn.close()
             return 0
         
-        # Таблица пустая - инициализируем список
         now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        added = 0
-        
+        params = []
         for code in codes:
-            code = code.upper().strip()
-            try:
-                cursor.execute(
-                    "INSERT INTO self_employed (code, marked_at) VALUES (?, ?)",
-                    (code, now)
-                )
-                added += 1
-            except:
-                continue
+            params += (code.upper().strip(), now)
+        
+        cursor.execute(
+            "INSERT OR IGNORE INTO self_employed (code, marked_at) VALUES "
+            + ", ".join(["(?, ?)"] * len(codes)),
+            params
+        )
+        added = cursor.rowcount
         
         conn.commit()
         conn.close()
@@ -1452,6 +1682,7 @@ class Database:
             conn.commit()
             print(f"DEBUG: Commit successful, total_updated={total_updated}")
             conn.close()
+            self.invalidate_identity_cache()
             return total_updated
         except Exception as e:
             print(f"DEBUG: EXCEPTION in merge_employees: {e}")
@@ -1557,6 +1788,7 @@ class Database:
             conn.commit()
             print(f"[SPLIT] Complete! Total records updated: {total_split}")
             conn.close()
+            self.invalidate_identity_cache()
             return total_split
             
         except Exception as e:
@@ -1716,6 +1948,40 @@ class Database:
         conn.commit()
         conn.close()
 
+    def replace_payments(self, club: str, date: str, payments: List[Dict]) -> int:
+        """
+        Заменить все выплаты клуба за дату одной транзакцией:
+        удалить старые записи и вставить новые (поля как у add_payment)
+        """
+        created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [
+            (club, date, p['code'], p['name'], p['stavka'], p['lm_3'], p['percent_5'],
+             p['promo'], p['crz'], p['cons'], p['tips'], p['fines'], p['total_shift'],
+             p['debt'], p['debt_nal'], p['to_pay'], created_at)
+            for p in payments
+        ]
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                DELETE FROM payments 
+                WHERE club = ? AND date = ?
+            """, (club, date))
+            cursor.executemany("""
+                INSERT OR REPLACE INTO payments 
+                (club, date, code, name, stavka, lm_3, percent_5, promo, crz, cons, 
+                 tips, fines, total_shift, debt, debt_nal, to_pay, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(rows)
+    
     def get_payments(self, club: str, date_from: str, date_to: str):
         """Получить все выплаты за период"""
         conn = self.get_connection()
@@ -1732,6 +1998,41 @@ class Database:
         
         return rows
     
+    def get_employee_payments_by_date(self, code: str, date: str):
+        """Строки ЗП сотрудника за дату по всем клубам (для личного кабинета)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT date, club, stavka, lm_3, percent_5, promo, crz, cons, tips, 
+                   fines, total_shift, COALESCE(debt, 0), COALESCE(debt_nal, 0), COALESCE(to_pay, 0)
+            FROM payments
+            WHERE code = ? AND date = ?
+            ORDER BY club
+        """, (code, date))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return rows
+    
+    def get_employee_payments_by_period(self, code: str, date_from: str, date_to: str):
+        """Все строки ЗП сотрудника за период по обоим клубам (фильтр по коду в SQL)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT * FROM payments
+            WHERE club IN ('Москвич', 'Анора') AND code = ?
+              AND date >= ? AND date <= ?
+            ORDER BY date, club, id
+        """, (code, date_from, date_to))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return rows
+    
     def debug_payments(self, club: str, date: str):
         """Показать все записи payments для клуба и даты"""
         conn = self.get_connection()
@@ -2091,6 +2392,12 @@ class Database:
         Returns:
             Словарь с данными или None
         """
+        employee = self._cached_identity('employee', telegram_user_id, self._load_employee_by_telegram_id)
+        # Копия, чтобы правки вызывающего кода не попадали в кэш
+        return dict(employee) if employee else None
+    
+    def _load_employee_by_telegram_id(self, telegram_user_id: int) -> Optional[Dict]:
+        """Загрузить сотрудника по Telegram ID из БД"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -2185,6 +2492,7 @@ class Database:
             
             conn.commit()
             conn.close()
+            self.invalidate_identity_cache()
             return True
         except Exception as e:
             print(f"Ошибка добавления доступа: {e}")
@@ -2227,6 +2535,7 @@ class Database:
             cursor.execute(query, tuple(values))
             conn.commit()
             conn.close()
+            self.invalidate_identity_cache()
             return True
         except Exception as e:
             print(f"Ошибка обновления доступа: {e}")
@@ -2257,6 +2566,7 @@ class Database:
             
             conn.commit()
             conn.close()
+            self.invalidate_identity_cache()
             return True
         except Exception as e:
             print(f"Ошибка удаления доступа: {e}")
@@ -2319,6 +2629,10 @@ class Database:
     
     def is_admin(self, telegram_user_id: int) -> bool:
         """Проверить является ли пользователь админом"""
+        return self._cached_identity('admin', telegram_user_id, self._load_is_admin)
+    
+    def _load_is_admin(self, telegram_user_id: int) -> bool:
+        """Проверить админа по таблице admins"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -2349,6 +2663,7 @@ class Database:
             
             conn.commit()
             conn.close()
+            self.invalidate_identity_cache()
             return True
         except Exception as e:
             print(f"Ошибка добавления админа: {e}")
@@ -2368,6 +2683,7 @@ class Database:
             
             conn.commit()
             conn.close()
+            self.invalidate_identity_cache()
             return True
         except Exception as e:
             print(f"Ошибка добавления владельца: {e}")
@@ -2383,6 +2699,7 @@ class Database:
             cursor.execute("DELETE FROM owners WHERE telegram_user_id = ?", (telegram_user_id,))
             conn.commit()
             conn.close()
+            self.invalidate_identity_cache()
             return True
         except Exception as e:
             print(f"Ошибка удаления владельца: {e}")
@@ -2391,6 +2708,10 @@ class Database:
 
     def is_owner(self, telegram_user_id: int) -> bool:
         """Проверить является ли пользователь владельцем"""
+        return self._cached_identity('owner', telegram_user_id, self._load_is_owner)
+
+    def _load_is_owner(self, telegram_user_id: int) -> bool:
+        """Проверить владельца по таблице owners"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
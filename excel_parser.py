@@ -6,13 +6,63 @@ import logging
 import sys
 sys.path.append('.')
 from typing import Dict, List, Any
-from difflib import SequenceMatcher
 import pandas as pd
+from rapidfuzz import fuzz
 from parser import DataParser
 
 logger = logging.getLogger(__name__)
 
 
+def _to_buffer(file_content):
+    """Байты или файловый объект -> объект для чтения с начала (без лишней копии)"""
+    if hasattr(file_content, 'read'):
+        file_content.seek(0)
+        return file_content
+    return io.BytesIO(file_content)
+
+
+def _sheet_value(value):
+    """Значение ячейки в том же виде, что отдаёт pd.read_excel (пусто -> NaN, 5.0 -> 5)"""
+    if value is None or value == '':
+        return float('nan')
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _read_first_sheet_rows(file_content) -> List[list]:
+    """Значения первого листа построчно (см. _sheet_rows)"""
+    from openpyxl import load_workbook
+    
+    wb = load_workbook(_to_buffer(file_content), read_only=True, data_only=True)
+    try:
+        return _sheet_rows(wb.worksheets[0])
+    finally:
+        wb.close()
+
+
+def _sheet_rows(ws) -> List[list]:
+    """
+    Значения листа построчно (openpyxl read_only + values_only, без объектов Cell).
+    Форма таблицы как у pd.read_excel(header=None): хвостовые пустые строки
+    отброшены, строки дополнены NaN до общей ширины
+    """
+    rows = []
+    last_row_with_data = -1
+    for values in ws.iter_rows(values_only=True):
+        row = list(values)
+        while row and (row[-1] is None or row[-1] == ''):
+            row.pop()
+        if row:
+            last_row_with_data = len(rows)
+        rows.append(row)
+    
+    del rows[last_row_with_data + 1:]
+    width = max((len(row) for row in rows), default=0)
+    nan = float('nan')
+    return [[_sheet_value(v) for v in row] + [nan] * (width - len(row)) for row in rows]
+
+
 def name_similarity(name1: str, name2: str) -> float:
     """
     Вычисление похожести двух имен с приоритетом фамилии (0.0 - 1.0)
@@ -35,7 +85,7 @@ def name_similarity(name1: str, name2: str) -> float:
     
     # Если одно из имен содержит только одно слово - обычное сравнение
     if len(parts1) == 1 or len(parts2) == 1:
-        return SequenceMatcher(None, name1_clean, name2_clean).ratio()
+        return fuzz.ratio(name1_clean, name2_clean) / 100
     
     # Извлекаем фамилию (последнее слово) и имя (остальное)
     surname1 = parts1[-1]
@@ -79,10 +129,10 @@ def name_similarity(name1: str, name2: str) -> float:
     firstname2_normalized = name_abbreviations.get(firstname2.lower(), firstname2.lower())
     
     # Сравниваем фамилии
-    surname_similarity = SequenceMatcher(None, surname1, surname2).ratio()
+    surname_similarity = fuzz.ratio(surname1, surname2) / 100
     
     # Сравниваем имена (с учетом нормализации)
-    firstname_similarity = SequenceMatcher(None, firstname1_normalized, firstname2_normalized).ratio()
+    firstname_similarity = fuzz.ratio(firstname1_normalized, firstname2_normalized) / 100
     
     # Взвешенная сумма: фамилия 70%, имя 30%
     weighted_similarity = surname_similarity * 0.7 + firstname_similarity * 0.3
@@ -104,7 +154,7 @@ class ExcelProcessor:
         except (ValueError, AttributeError):
             return 0.0
     
-    def extract_notes_entries(self, file_content: bytes) -> Dict[str, List[Dict[str, Any]]]:
+    def extract_notes_entries(self, file_content) -> Dict[str, List[Dict[str, Any]]]:
         """
         Извлечение блока «Примечание» из Excel файла
         
@@ -116,21 +166,23 @@ class ExcelProcessor:
         }
         """
         try:
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=0, header=None, engine='openpyxl')
+            # Читаем только значения, потоково: для поиска блока объекты ячеек не нужны
+            rows = _read_first_sheet_rows(file_content)
         except Exception as e:
             logger.error(f"Error reading Excel for notes block: {e}")
             return {}
         
-        if df.empty:
+        width = len(rows[0]) if rows else 0
+        if not width:
             return {}
         
         # Ищем заголовок "Примечания" в любой колонке
         start_row = None
         notes_col = None
         
-        for row_idx in range(len(df)):
-            for col_idx in range(df.shape[1]):
-                cell = df.iloc[row_idx, col_idx]
+        for row_idx in range(len(rows)):
+            for col_idx in range(width):
+                cell = rows[row_idx][col_idx]
                 if isinstance(cell, str) and 'примечан' in cell.strip().lower():
                     start_row = row_idx + 1
                     notes_col = col_idx
@@ -145,9 +197,9 @@ class ExcelProcessor:
         
         # Ищем строку с заголовками ("долг") или начинаем со следующей строки
         column_headers_row = None
-        for row_idx in range(start_row, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
-            right_cell = df.iloc[row_idx, notes_col + 1] if df.shape[1] > notes_col + 1 else None
+        for row_idx in range(start_row, len(rows)):
+            left_cell = rows[row_idx][notes_col] if width > notes_col else None
+            right_cell = rows[row_idx][notes_col + 1] if width > notes_col + 1 else None
             
             if left_cell is None and right_cell is None:
                 continue
@@ -172,9 +224,9 @@ class ExcelProcessor:
         left_done = False
         right_done = False
         
-        for row_idx in range(start_row, len(df)):
-            left_cell = df.iloc[row_idx, notes_col] if df.shape[1] > notes_col else None
-            right_cell = df.iloc[row_idx, notes_col + 1] if df.shape[1] > notes_col + 1 else None
+        for row_idx in range(start_row, len(rows)):
+            left_cell = rows[row_idx][notes_col] if width > notes_col else None
+            right_cell = rows[row_idx][notes_col + 1] if width > notes_col + 1 else None
             
             if left_cell is None and right_cell is None:
                 continue
@@ -248,7 +300,7 @@ class ExcelProcessor:
             'extra': extra_notes
         }
     
-    def extract_payments_sheet(self, file_content: bytes, db, club: str, date: str) -> Dict:
+    def extract_payments_sheet(self, file_content, db, club: str, date: str) -> Dict:
         """
         Извлечение данных из листа 'ЛИСТ ВЫПЛАТ'
         
@@ -270,7 +322,7 @@ class ExcelProcessor:
         - Столбец O: к выплате
         
         Args:
-            file_content: содержимое Excel файла
+            file_content: содержимое Excel файла (bytes или файловый объект)
             db: объект Database для проверки объединений сотрудников
             club: название клуба (Москвич/Анора)
             date: дата для проверки канонических имен
@@ -286,30 +338,32 @@ class ExcelProcessor:
         # Пытаемся найти лист с разным регистром
         sheet_name = None
         try:
-            # Получаем список всех листов
-            import pandas as pd
-            excel_file = pd.ExcelFile(io.BytesIO(file_content), engine='openpyxl')
-            sheet_names = excel_file.sheet_names
-            
-            # Ищем лист с названием содержащим "лист" и "выплат" (любой регистр)
-            for name in sheet_names:
-                name_lower = name.lower().strip()
-                if 'лист' in name_lower and 'выплат' in name_lower:
-                    sheet_name = name
-                    break
-            
-            if not sheet_name:
-                logger.error("Sheet with 'лист выплат' not found in file")
-                return []
-            
-            df = pd.read_excel(io.BytesIO(file_content), sheet_name=sheet_name, header=None, engine='openpyxl')
+            # Книгу читаем потоково (read_only): лист сразу в список строк, без DataFrame
+            from openpyxl import load_workbook
+            wb = load_workbook(_to_buffer(file_content), read_only=True, data_only=True)
+            try:
+                # Ищем лист с названием содержащим "лист" и "выплат" (любой регистр)
+                for name in wb.sheetnames:
+                    name_lower = name.lower().strip()
+                    if 'лист' in name_lower and 'выплат' in name_lower:
+                        sheet_name = name
+                        break
+                
+                if not sheet_name:
+                    logger.error("Sheet with 'лист выплат' not found in file")
+                    return []
+                
+                rows = _sheet_rows(wb[sheet_name])
+            finally:
+                wb.close()
+            width = len(rows[0]) if rows else 0
             
             # Печатаем первые 30 строк для отладки
             print("=== DEBUG: First 30 rows of sheet ===")
-            for idx in range(min(30, len(df))):
+            for idx in range(min(30, len(rows))):
                 row_data = []
-                for col_idx in range(min(5, df.shape[1])):
-                    cell = df.iloc[idx, col_idx]
+                for col_idx in range(min(5, width)):
+                    cell = rows[idx][col_idx]
                     row_data.append(str(cell)[:20] if not pd.isna(cell) else "")
                 print(f"Row {idx}: {row_data}")
             print("=== END DEBUG ===")
@@ -318,7 +372,7 @@ class ExcelProcessor:
             logger.error(f"Error reading payments sheet: {e}")
             return {'payments': [], 'name_changes': [], 'new_employees': []}
         
-        if df.empty:
+        if not rows:
             return {'payments': [], 'name_changes': [], 'new_employees': []}
         
         payments = []
@@ -326,12 +380,13 @@ class ExcelProcessor:
         new_employees = []  # Список новых сотрудников для автоматического добавления
         
         # Проходим по строкам (пропускаем первые 2 строки с заголовками)
-        for row_idx in range(2, len(df)):
+        for row_idx in range(2, len(rows)):
+            sheet_row = rows[row_idx]
             # ПРОВЕРКА НА ИТОГО И ПРОЧИЕ РАСХОДЫ - останавливаем парсинг ПЕРЕД try-except
             # Проверяем ВСЕ первые 5 столбцов на наличие стоп-слов
             should_stop = False
-            for col_idx in range(min(5, df.shape[1])):
-                cell = df.iloc[row_idx, col_idx]
+            for col_idx in range(min(5, width)):
+                cell = sheet_row[col_idx]
                 if not pd.isna(cell):
                     cell_str = str(cell).strip().lower()
                     for stop_word in ['итого', 'промоутер', 'такси', 'прочие', 'стилист', 'нал:', 'безнал:', '%', 'процент']:
@@ -348,8 +403,8 @@ class ExcelProcessor:
             
             try:
                 # Столбцы A и B - код
-                category = df.iloc[row_idx, 0]  # A
-                number = df.iloc[row_idx, 1]    # B
+                category = sheet_row[0]  # A
+                number = sheet_row[1]    # B
                 
                 category = str(category).strip() if not pd.isna(category) else ""
                 number = str(number).strip() if not pd.isna(number) else ""
@@ -378,7 +433,7 @@ class ExcelProcessor:
                 # 2. Есть категория, НЕТ номера
                 elif category and not number:
                     # Берём ПОЛНОЕ имя из столбца C
-                    name_full = df.iloc[row_idx, 2] if not pd.isna(df.iloc[row_idx, 2]) else ""
+                    name_full = sheet_row[2] if not pd.isna(sheet_row[2]) else ""
                     name_full = str(name_full).strip()
                     
                     if name_full:
@@ -389,7 +444,7 @@ class ExcelProcessor:
                 
                 # 3. НЕТ категории (A пусто)
                 elif not category:
-                    name_full = df.iloc[row_idx, 2] if not pd.isna(df.iloc[row_idx, 2]) else ""
+                    name_full = sheet_row[2] if not pd.isna(sheet_row[2]) else ""
                     name_full = str(name_full).strip()
                     
                     if name_full:
@@ -407,7 +462,7 @@ class ExcelProcessor:
                 code = DataParser.normalize_code(code)
                 
                 # Имя ВСЕГДА берём из столбца C (независимо от типа кода)
-                name = df.iloc[row_idx, 2] if not pd.isna(df.iloc[row_idx, 2]) else ""
+                name = sheet_row[2] if not pd.isna(sheet_row[2]) else ""
                 name = str(name).strip()
                 name_from_file = name  # Сохраняем оригинал
                 
@@ -491,18 +546,18 @@ class ExcelProcessor:
                                 name = existing_names[0]
                 
                 # Извлекаем числовые данные
-                stavka = self._parse_decimal(df.iloc[row_idx, 3])       # D
-                lm_3 = self._parse_decimal(df.iloc[row_idx, 4])         # E
-                percent_5 = self._parse_decimal(df.iloc[row_idx, 5])    # F
-                promo = self._parse_decimal(df.iloc[row_idx, 6])        # G
-                crz = self._parse_decimal(df.iloc[row_idx, 7])          # H
-                cons = self._parse_decimal(df.iloc[row_idx, 8])         # I
-                tips = self._parse_decimal(df.iloc[row_idx, 9])         # J
-                fines = self._parse_decimal(df.iloc[row_idx, 10])       # K
-                total_shift = self._parse_decimal(df.iloc[row_idx, 11]) # L
-                debt = self._parse_decimal(df.iloc[row_idx, 12])        # M (Долг БН)
-                debt_nal = self._parse_decimal(df.iloc[row_idx, 13])    # N (Долг НАЛ)
-                to_pay = self._parse_decimal(df.iloc[row_idx, 14])      # O (получила на смене)
+                stavka = self._parse_decimal(sheet_row[3])       # D
+                lm_3 = self._parse_decimal(sheet_row[4])         # E
+                percent_5 = self._parse_decimal(sheet_row[5])    # F
+                promo = self._parse_decimal(sheet_row[6])        # G
+                crz = self._parse_decimal(sheet_row[7])          # H
+                cons = self._parse_decimal(sheet_row[8])         # I
+                tips = self._parse_decimal(sheet_row[9])         # J
+                fines = self._parse_decimal(sheet_row[10])       # K
+                total_shift = self._parse_decimal(sheet_row[11]) # L
+                debt = self._parse_decimal(sheet_row[12])        # M (Долг БН)
+                debt_nal = self._parse_decimal(sheet_row[13])    # N (Долг НАЛ)
+                to_pay = self._parse_decimal(sheet_row[14])      # O (получила на смене)
                 
                 # Пропускаем строки где все значения = 0
                 if all(v == 0 for v in [stavka, lm_3, percent_5, promo, crz, cons, tips, total_shift]):
@@ -2,6 +2,8 @@
 Модуль парсинга блочного ввода данных
 """
 import re
+from collections import Counter
+from functools import lru_cache
 from typing import List, Dict, Tuple
 
 
@@ -11,49 +13,47 @@ class DataParser:
     # Специальные коды (только буквы, без цифр)
     SPECIAL_CODES = ['СБ', 'СБН', 'УБОРЩИЦА']
     
+    # Карта замены латиница → кириллица для normalize_code
+    LAT_TO_CYR = str.maketrans({
+        'A': 'А', 'a': 'а',
+        'B': 'В', 'b': 'в', 
+        'C': 'С', 'c': 'с',
+        'E': 'Е', 'e': 'е',
+        'H': 'Н', 'h': 'н',
+        'K': 'К', 'k': 'к',
+        'M': 'М', 'm': 'м',
+        'O': 'О', 'o': 'о',
+        'P': 'Р', 'p': 'р',
+        'T': 'Т', 't': 'т',
+        'X': 'Х', 'x': 'х',
+        'Y': 'У', 'y': 'у',
+    })
+    
     @staticmethod
+    @lru_cache(maxsize=8192)
     def normalize_code(code: str) -> str:
         """
         Нормализация кода сотрудника:
         1. Trim пробелов
         2. ВЕРХНИЙ РЕГИСТР
         3. Латиница → кириллица (Dj → ДЖ, A → А, и т.д.)
+        Коды повторяются постоянно, поэтому результат кешируется
         """
         if not code:
             return ''
         
         code = code.strip()
         
-        # Карта замены латиница → кириллица
-        lat_to_cyr = {
-            'A': 'А', 'a': 'а',
-            'B': 'В', 'b': 'в', 
-            'C': 'С', 'c': 'с',
-            'E': 'Е', 'e': 'е',
-            'H': 'Н', 'h': 'н',
-            'K': 'К', 'k': 'к',
-            'M': 'М', 'm': 'м',
-            'O': 'О', 'o': 'о',
-            'P': 'Р', 'p': 'р',
-            'T': 'Т', 't': 'т',
-            'X': 'Х', 'x': 'х',
-            'Y': 'У', 'y': 'у',
-        }
-        
         # Специальные случаи (двухбуквенные)
         code = code.replace('Dj', 'ДЖ')
         code = code.replace('DJ', 'ДЖ')
         code = code.replace('dj', 'ДЖ')
         
-        # Посимвольная замена
-        result = []
-        for char in code:
-            result.append(lat_to_cyr.get(char, char))
-        
-        # ВЕРХНИЙ РЕГИСТР
-        return ''.join(result).upper()
+        # Посимвольная замена и ВЕРХНИЙ РЕГИСТР
+        return code.translate(DataParser.LAT_TO_CYR).upper()
     
     @staticmethod
+    @lru_cache(maxsize=512)
     def is_code(text: str) -> bool:
         """
         Проверка, является ли текст кодом
@@ -169,7 +169,7 @@ class DataParser:
                     total_amount = amount1 + amount2
                     
                     # Парсим код и имя
-                    before_parts = re.split(r'\s+', before_dash)
+                    before_parts = before_dash.split()
                     code = None
                     name_parts = []
                     
@@ -216,7 +216,7 @@ class DataParser:
                 return False, {}, f"Строка {line_number}: {error}. Строка: '{line}'"
             
             # Разбиваем часть до дефиса
-            before_parts = re.split(r'\s+', before_dash)
+            before_parts = before_dash.split()
             
             # Ищем код
             code = None
@@ -237,7 +237,7 @@ class DataParser:
             
         else:
             # Формат без дефиса: "код имя сумма"
-            parts = re.split(r'\s+', line)
+            parts = line.split()
             
             if len(parts) < 2:
                 return False, {}, f"Строка {line_number}: недостаточно элементов. Строка: '{line}'"
@@ -299,8 +299,6 @@ class DataParser:
             return line, 0  # Слишком мало частей, дублей быть не может
         
         # Ищем повторяющиеся коды
-        from collections import Counter
-        
         # Собираем все части которые могут быть кодами
         potential_codes = []
         for part in parts:
@@ -2,9 +2,10 @@
 Модуль генерации отчетов
 """
 from typing import List, Dict, Tuple, Optional
-from collections import defaultdict
 import csv
+from collections import defaultdict
 from io import StringIO
+import xlsxwriter
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 
@@ -23,8 +24,9 @@ class ReportGenerator:
         """
         # Группируем по сотрудникам
         # Для СБ группируем по (код, имя), для остальных по коду
+        # names - dict вместо set: имена в порядке появления, первое встреченное идёт в отчёт
         employee_data = defaultdict(lambda: {
-            'names': set(),
+            'names': {},
             'nal': 0.0,
             'beznal': 0.0,
             'stylist': 0.0
@@ -34,6 +36,9 @@ class ReportGenerator:
         total_nal_raw = 0.0
         total_beznal_raw = 0.0
         
+        # Ключи объединений считаем один раз, а не на каждой операции
+        merge_keys = frozenset(sb_name_merges) if sb_name_merges else frozenset()
+        
         for op in operations:
             code = op['code']
             name = op['name']
@@ -41,7 +46,7 @@ class ReportGenerator:
             amount = op['amount']
             
             # Применяем объединение имен СБ (только для отчета)
-            if sb_name_merges and code == 'СБ' and name in sb_name_merges:
+            if code == 'СБ' and name in merge_keys:
                 name = sb_name_merges[name]
             
             # ДЛЯ СБ группируем по комбинации (код + имя), чтобы разные СБ не объединялись
@@ -50,7 +55,7 @@ class ReportGenerator:
             else:
                 group_key = code
             
-            employee_data[group_key]['names'].add(name)
+            employee_data[group_key]['names'][name] = None
             
             if channel == 'нал':
                 employee_data[group_key]['nal'] += amount
@@ -258,120 +263,85 @@ class ReportGenerator:
         Генерация XLSX файла
         db: экземпляр Database для проверки статуса самозанятости
         """
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Отчет"
-        
-        # Стили
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=11)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-        
-        # Заголовок
-        ws['A1'] = f"Отчет по клубу {club}"
-        ws['A1'].font = Font(bold=True, size=14)
-        ws['A2'] = f"Период: {period}"
-        ws['A2'].font = Font(size=11)
-        
-        # Шапка таблицы
+        numeric_keys = ['nal', 'beznal', 'minus10', 'stylist', 'itog']
         headers = [
             'Имя', 'Код', 'Нал', 'Безнал', '10% от безнала', 'Стилисты',
             'ИТОГО', 'Самозанятость', 'К выплате (самозанятый)'
         ]
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=4, column=col, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.border = border
         
-        # Данные
-        row_num = 5
+        # Список самозанятых читаем один раз, а не запросом на каждую строку
+        self_employed = set(db.get_all_self_employed()) if db else set()
+        
+        # Готовим значения строк заранее: в режиме constant_memory строки пишутся
+        # строго по порядку, а ширину столбцов нужно знать до записи
+        data_rows = []
         for row_data in report_rows:
-            # Имя (текст, выравнивание влево)
-            cell = ws.cell(row=row_num, column=1, value=row_data['name'])
-            cell.alignment = Alignment(horizontal='left', vertical='center')
-            cell.border = border
-            
-            # Код (текст, выравнивание влево)
-            cell = ws.cell(row=row_num, column=2, value=row_data['code'])
-            cell.alignment = Alignment(horizontal='left', vertical='center')
-            cell.border = border
-            
-            # Числовые колонки (выравнивание вправо)
-            for col, key in enumerate(['nal', 'beznal', 'minus10', 'stylist', 'itog'], 3):
-                cell = ws.cell(row=row_num, column=col, value=row_data[key])
-                cell.alignment = Alignment(horizontal='right', vertical='center')
-                cell.border = border
-            
-            # Проверяем статус самозанятости
-            if db:
-                normalized_code = row_data['code'].upper().strip()
-                is_self_employed = db.is_self_employed(normalized_code)
-                if is_self_employed:
-                    cell = ws.cell(row=row_num, column=8, value='✓')
-                    cell.alignment = Alignment(horizontal='center', vertical='center')
-                    cell.border = border
-                    
-                    payout = round(row_data['itog'] / 0.94, 2)
-                    cell = ws.cell(row=row_num, column=9, value=payout)
-                    cell.alignment = Alignment(horizontal='right', vertical='center')
-                    cell.border = border
-                else:
-                    cell = ws.cell(row=row_num, column=8, value='')
-                    cell.border = border
-                    cell = ws.cell(row=row_num, column=9, value='')
-                    cell.border = border
+            values = [row_data['name'], row_data['code']] + [row_data[key] for key in numeric_keys]
+            if row_data['code'].upper().strip() in self_employed:
+                values += ['✓', round(row_data['itog'] / 0.94, 2)]
             else:
-                cell = ws.cell(row=row_num, column=8, value='')
-                cell.border = border
-                cell = ws.cell(row=row_num, column=9, value='')
-                cell.border = border
-            
-            row_num += 1
+                values += ['', '']
+            data_rows.append(values)
+        
+        totals_row = ['ИТОГО', ''] + [totals[key] for key in numeric_keys] + ['', '']
+        
+        # Автоматическая подгонка ширины столбцов (по самому длинному значению)
+        widths = [0] * len(headers)
+        for values in [[f"Отчет по клубу {club}"], [f"Период: {period}"], headers] + data_rows + [totals_row]:
+            for col, value in enumerate(values):
+                if value:
+                    widths[col] = max(widths[col], len(str(value)))
+        
+        wb = xlsxwriter.Workbook(filename, {'constant_memory': True})
+        ws = wb.add_worksheet("Отчет")
+        
+        # Стили (создаются один раз на книгу)
+        border = {'border': 1}
+        title_format = wb.add_format({'bold': True, 'font_size': 14})
+        period_format = wb.add_format({'font_size': 11})
+        header_format = wb.add_format({
+            'bold': True, 'font_color': '#FFFFFF', 'font_size': 11, 'bg_color': '#4472C4',
+            'align': 'center', 'valign': 'vcenter', **border
+        })
+        text_format = wb.add_format({'align': 'left', 'valign': 'vcenter', **border})
+        number_format = wb.add_format({'align': 'right', 'valign': 'vcenter', **border})
+        mark_format = wb.add_format({'align': 'center', 'valign': 'vcenter', **border})
+        empty_format = wb.add_format(border)
+        total_text_format = wb.add_format({'bold': True, 'align': 'left', 'valign': 'vcenter', **border})
+        total_number_format = wb.add_format({'bold': True, 'align': 'right', 'valign': 'vcenter', **border})
         
-        # Итоги
-        cell = ws.cell(row=row_num, column=1, value='ИТОГО')
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal='left', vertical='center')
-        cell.border = border
+        for col, width in enumerate(widths):
+            ws.set_column(col, col, width + 2)
         
-        cell = ws.cell(row=row_num, column=2, value='')
-        cell.border = border
+        # Заголовок
+        ws.write_string(0, 0, f"Отчет по клубу {club}", title_format)
+        ws.write_string(1, 0, f"Период: {period}", period_format)
         
-        for col, key in enumerate(['nal', 'beznal', 'minus10', 'stylist', 'itog'], 3):
-            cell = ws.cell(row=row_num, column=col, value=totals[key])
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(horizontal='right', vertical='center')
-            cell.border = border
+        # Шапка таблицы
+        ws.write_row(3, 0, headers, header_format)
         
-        # Пустые ячейки в строке итогов
-        for col in [8, 9]:
-            cell = ws.cell(row=row_num, column=col, value='')
-            cell.border = border
+        # Данные
+        row_num = 4
+        for values in data_rows:
+            ws.write_row(row_num, 0, values[:2], text_format)
+            ws.write_row(row_num, 2, values[2:7], number_format)
+            if values[7]:
+                ws.write_string(row_num, 7, values[7], mark_format)
+                ws.write_number(row_num, 8, values[8], number_format)
+            else:
+                ws.write_blank(row_num, 7, None, empty_format)
+                ws.write_blank(row_num, 8, None, empty_format)
+            row_num += 1
         
-        # Автоматическая подгонка ширины столбцов
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if cell.value:
-                        cell_length = len(str(cell.value))
-                        if cell_length > max_length:
-                            max_length = cell_length
-                except:
-                    pass
-            adjusted_width = max_length + 2
-            ws.column_dimensions[column_letter].width = adjusted_width
+        # Итоги
+        ws.write_string(row_num, 0, 'ИТОГО', total_text_format)
+        ws.write_blank(row_num, 1, None, empty_format)
+        ws.write_row(row_num, 2, totals_row[2:7], total_number_format)
+        ws.write_blank(row_num, 7, None, empty_format)
+        ws.write_blank(row_num, 8, None, empty_format)
         
         # Сохраняем
-        wb.save(filename)
+        wb.close()
         return filename
     
     @staticmethod
@@ -2,6 +2,7 @@
 Утилиты для работы с датами и командами
 """
 from datetime import datetime, timedelta
+from functools import lru_cache
 import pytz
 import re
 from typing import Tuple, Optional
@@ -21,13 +22,15 @@ def parse_short_date(date_str: str, timezone_str: str = config.TIMEZONE) -> Tupl
     - 28,12,25 или 28.12.25 -> 2025-12-28 (с указанным годом)
     Возвращает: (успех, дата, сообщение об ошибке)
     """
-    date_str = date_str.strip().replace(',', '.')
-    
+    # Текущий год входит в ключ кэша, чтобы результат не устаревал при смене года
+    tz = pytz.timezone(timezone_str)
+    return _parse_short_date_cached(date_str.strip().replace(',', '.'), datetime.now(tz).year)
+
+
+@lru_cache(maxsize=512)
+def _parse_short_date_cached(date_str: str, current_year: int) -> Tuple[bool, Optional[str], str]:
+    """Разбор короткой даты (уже нормализованной) для заданного текущего года"""
     try:
-        # Получаем текущий год
-        tz = pytz.timezone(timezone_str)
-        current_year = datetime.now(tz).year
-        
         # Разбиваем на части
         parts = date_str.split('.')
         
@@ -93,13 +96,16 @@ def parse_date_range(range_str: str, timezone_str: str = config.TIMEZONE) -> Tup
     if len(parts) != 2:
         return False, "", "", f"Неверный формат диапазона: '{range_str}'. Используйте формат: 30,10-1,11"
     
+    # Обе даты разбираем через общий кэш с одним текущим годом (часовой пояс - один раз)
+    current_year = datetime.now(pytz.timezone(timezone_str)).year
+    
     # Парсим начальную дату
-    success1, date_from, error1 = parse_short_date(parts[0], timezone_str)
+    success1, date_from, error1 = _parse_short_date_cached(parts[0].strip().replace(',', '.'), current_year)
     if not success1:
         return False, "", "", error1
     
     # Парсим конечную дату
-    success2, date_to, error2 = parse_short_date(parts[1], timezone_str)
+    success2, date_to, error2 = _parse_short_date_cached(parts[1].strip().replace(',', '.'), current_year)
     if not success2:
         return False, "", "", error2
     